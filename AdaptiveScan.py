@@ -0,0 +1,163 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import numpy as np
+
+
+class AdaptiveScan:
+    shape = (0, 0) # (# x pixels, # y pixels) of the full-resolution grid.
+    coarse_step = 8 # Pixels between the points of the first (coarse) pass.
+    refine_factor = 2.0 # Cells brighter than this many times the background are refined.
+    int_time = 0 # (s) Integration time per point, for the shot noise of the background.
+    values = None # Measured counts/s [x][y] (only meaningful where measured is True).
+    measured = None # Bool [x][y]: True for pixels that were actually measured.
+    leaves = None # Cells (x0, x1, y0, y1, parent) of the quadtree that haven't been subdivided; corners are pixel indices.
+    background = None # Counts/s of the background, from the coarse pass.
+    threshold = None # Counts/s above which a cell corner counts as bright.
+
+    def __init__(self, shape, int_time, coarse_step=8, refine_factor=2.0):
+        ##
+        ## PLANS AN ADAPTIVE SCAN OF A shape = (n_x, n_y) GRID: A COARSE PASS EVERY coarse_step PIXELS, THEN
+        ## QUADTREE REFINEMENT OF ONLY THE CELLS WITH A BRIGHT CORNER, DOWN TO SINGLE PIXELS.
+        ## USE: points = getCoarsePoints(); THEN, UNTIL points IS EMPTY, MEASURE THEM (record) AND
+        ## points = refine(). getImage() GIVES THE FULL GRID WITH THE UNMEASURED PIXELS INTERPOLATED.
+        ##
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.int_time = int_time
+        self.coarse_step = max(1, int(coarse_step))
+        self.refine_factor = refine_factor
+        self.values = np.zeros(self.shape, dtype=np.float32)
+        self.measured = np.zeros(self.shape, dtype=bool)
+        x_cells = self.getCells(self.getCoarseIndices(self.shape[0]))
+        y_cells = self.getCells(self.getCoarseIndices(self.shape[1]))
+        self.leaves = [(x0, x1, y0, y1, None) for x0, x1 in x_cells for y0, y1 in y_cells]
+
+    def getCoarseIndices(self, n):
+        ##
+        ## EVERY coarse_step-TH INDEX, ALWAYS INCLUDING THE LAST ONE.
+        ##
+        indices = list(range(0, n, self.coarse_step))
+        if indices[-1] != n - 1:
+            indices.append(n - 1)
+        return indices
+
+    def getCells(self, indices):
+        ##
+        ## (START, END) OF THE CELLS BETWEEN CONSECUTIVE INDICES. A SINGLE INDEX (ONE PIXEL WIDE) IS ONE FLAT CELL.
+        ##
+        if len(indices) == 1:
+            return [(indices[0], indices[0])]
+        return list(zip(indices[:-1], indices[1:]))
+
+    def getCoarsePoints(self):
+        xs = self.getCoarseIndices(self.shape[0])
+        ys = self.getCoarseIndices(self.shape[1])
+        return self.orderPoints({(x, y) for x in xs for y in ys})
+
+    def record(self, x_i, y_i, value):
+        self.values[x_i, y_i] = value
+        self.measured[x_i, y_i] = True
+
+    def getThreshold(self):
+        ##
+        ## refine_factor x THE BACKGROUND, BUT AT LEAST 5 SIGMA OF SHOT NOISE ABOVE IT, SO THAT A FEW STRAY
+        ## PHOTONS ON A DARK BACKGROUND DON'T TRIGGER A REFINEMENT. THE BACKGROUND IS THE MEAN OF THE COARSE
+        ## PASS WITHOUT ITS BRIGHTEST 10% (A MEDIAN IS 0 WHEN THERE IS LESS THAN ~1 PHOTON PER DWELL).
+        ##
+        if self.threshold is None:
+            coarse = self.values[self.measured]
+            self.background = float(coarse[coarse <= np.percentile(coarse, 90)].mean())
+            noise = np.sqrt(max(self.background, 1) / self.int_time) if self.int_time > 0 else 0
+            self.threshold = max(self.refine_factor * self.background, self.background + 5 * noise)
+        return self.threshold
+
+    def isBright(self, cell):
+        x0, x1, y0, y1, _ = cell
+        return max(self.values[x, y] for x in (x0, x1) for y in (y0, y1)) > self.getThreshold()
+
+    def refine(self):
+        ##
+        ## SUBDIVIDES EVERY BRIGHT LEAF CELL INTO (UP TO) 4 AND RETURNS THE NEW CORNERS TO MEASURE,
+        ## IN SERPENTINE ORDER. RETURNS AN EMPTY LIST WHEN THERE IS NOTHING LEFT TO REFINE.
+        ##
+        leaves = []
+        points = set()
+        for cell in self.leaves:
+            x0, x1, y0, y1, _ = cell
+            if (x1 - x0 <= 1 and y1 - y0 <= 1) or not self.isBright(cell):
+                leaves.append(cell)
+                continue
+            x_splits = [x0, (x0 + x1) // 2, x1] if x1 - x0 > 1 else [x0, x1]
+            y_splits = [y0, (y0 + y1) // 2, y1] if y1 - y0 > 1 else [y0, y1]
+            for xa, xb in zip(x_splits[:-1], x_splits[1:]):
+                for ya, yb in zip(y_splits[:-1], y_splits[1:]):
+                    leaves.append((xa, xb, ya, yb, cell))
+                    points.update((x, y) for x in (xa, xb) for y in (ya, yb))
+        self.leaves = leaves
+        return self.orderPoints([p for p in points if not self.measured[p]])
+
+    def orderPoints(self, points):
+        ##
+        ## SORTS (x, y) INDICES COLUMN BY COLUMN, ALTERNATING THE y DIRECTION, TO KEEP MIRROR MOVES SHORT.
+        ##
+        if len(points) == 0:
+            return []
+        points = np.array(sorted(points))
+        _, column = np.unique(points[:, 0], return_inverse=True)
+        y_key = np.where(column % 2 == 0, points[:, 1], -points[:, 1])
+        return [tuple(int(i) for i in p) for p in points[np.lexsort((y_key, points[:, 0]))]]
+
+    def getImage(self, band=256):
+        ##
+        ## RETURNS THE FULL-RESOLUTION GRID: MEASURED PIXELS AS MEASURED, THE REST BILINEARLY INTERPOLATED
+        ## FROM THE CORNERS OF THE QUADTREE CELL THEY'RE IN (ITS PARENT, IF THE CELL ISN'T FULLY MEASURED YET).
+        ## WORKED OUT band COLUMNS AT A TIME TO KEEP THE TEMPORARY ARRAYS SMALL.
+        ##
+        cells = np.array([cell[:4] for cell in self.leaves])
+        m = self.measured
+        complete = m[cells[:, 0], cells[:, 2]] & m[cells[:, 1], cells[:, 2]] & m[cells[:, 0], cells[:, 3]] & m[cells[:, 1], cells[:, 3]]
+        for i in np.flatnonzero(~complete): # Only after an interrupted refinement.
+            x0, x1, y0, y1, parent = self.leaves[i]
+            while parent is not None and not all(m[x, y] for x in (x0, x1) for y in (y0, y1)):
+                x0, x1, y0, y1, parent = parent
+            cells[i] = (x0, x1, y0, y1)
+        # Which cell each pixel gets its corners from.
+        owner = np.zeros(self.shape, dtype=np.int64)
+        for i, (x0, x1, y0, y1) in enumerate(cells.tolist()):
+            owner[x0:x1+1, y0:y1+1] = i
+
+        image = np.zeros(self.shape, dtype=np.float32)
+        v = self.values
+        y = np.arange(self.shape[1])[np.newaxis, :]
+        for first in range(0, self.shape[0], band):
+            x = np.arange(first, min(first + band, self.shape[0]))[:, np.newaxis]
+            x0, x1, y0, y1 = (cells[owner[first:first+band], k] for k in range(4))
+            tx = (x - x0) / np.maximum(x1 - x0, 1)
+            ty = (y - y0) / np.maximum(y1 - y0, 1)
+            image[first:first+band] = ((1-tx)*(1-ty)*v[x0, y0] + tx*(1-ty)*v[x1, y0]
+                                       + (1-tx)*ty*v[x0, y1] + tx*ty*v[x1, y1])
+        image[m] = v[m]
+        return image
+
+    def getSummary(self):
+        ##
+        ## WHAT WAS DONE, FOR save_data.
+        ##
+        return {
+            "coarse_step": self.coarse_step,
+            "refine_factor": self.refine_factor,
+            "background": self.background,
+            "threshold": self.threshold,
+            "pixels_measured": int(self.measured.sum()),
+            "fraction_measured": float(self.measured.mean())
+        }
@@ -0,0 +1,119 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import threading
+import numpy as np
+
+
+class CustomLoop:
+    DAQ = None # Dictionary that hosts the hardware (see ScanCore.makeDAQ).
+    x_coords = [] # X coordinates (V) of the custom points.
+    y_coords = [] # Y coordinates (V) of the custom points.
+    order = None # Indices of the points in the order they're visited (default: file order).
+    interrupt_event = None # threading.Event that stops the loop.
+    drift_tracker = None # DriftTracker that keeps the points on target over many loops, or None.
+    track_every = 1 # The drift is re-measured every this many loops.
+    loop = 0 # Number of loops started so far (1 for the first loop).
+    save_data = None # The save_data["custom_points"] entries: the points, the counts/s of every loop, the drift...
+
+    def __init__(self, DAQ, x_coords, y_coords, interrupt_event=None, order=None, drift_tracker=None, track_every=1):
+        ##
+        ## THE HARDWARE LOOP OVER A LIST OF CUSTOM POINTS, WITHOUT ANY GUI (THE POPOUT PLOT AND THE JOB QUEUE
+        ## BOTH RUN IT): EVERY LOOP VISITS EACH POINT ONCE, IN order, OFFSET BY THE DRIFT SO FAR IF A
+        ## drift_tracker IS GIVEN. THE COUNTS ARE KEPT IN save_data IN FILE ORDER, WITH THE ROUTE TAKEN.
+        ##
+        self.DAQ = DAQ
+        self.x_coords = list(x_coords)
+        self.y_coords = list(y_coords)
+        self.interrupt_event = threading.Event() if interrupt_event is None else interrupt_event
+        self.order = list(range(len(self.x_coords))) if order is None else [int(i) for i in order]
+        self.drift_tracker = drift_tracker
+        self.track_every = max(1, int(track_every))
+        self.save_data = {"x_coords": self.x_coords, "y_coords": self.y_coords}
+        if order is not None:
+            # Data stays in file order; this records the route that was actually taken.
+            self.save_data["visit_order"] = self.order
+
+    def isTrackingDue(self):
+        ##
+        ## TRUE IF THE NEXT LOOP SHOULD RE-MEASURE THE DRIFT FIRST.
+        ##
+        if self.drift_tracker is None:
+            return False
+        return self.drift_tracker.origin is None or self.loop % self.track_every == 0
+
+    def runLoop(self, int_time, track=None, post=None):
+        ##
+        ## [Worker thread] VISITS EVERY POINT ONCE (AFTER RE-MEASURING THE DRIFT, IF track; None MEANS WHEN IT'S
+        ## DUE), int_time (s) PER POINT. post(message) IS CALLED WITH ("tracked", found), ("offset", dx, dy) AND
+        ## ("point", i, COUNTS/s) AS THEY HAPPEN. RETURNS THE COUNTS/s IN FILE ORDER (0 FOR THE POINTS AN
+        ## INTERRUPT SKIPPED), WHICH ARE ALSO KEPT IN save_data.
+        ##
+        if track is None:
+            track = self.isTrackingDue()
+        self.loop += 1
+        counts = np.zeros(len(self.x_coords))
+        try:
+            dx, dy = 0, 0
+            if self.drift_tracker is not None:
+                if track:
+                    offset = self.drift_tracker.track(lambda x, y: self.measurePoint(x, y, int_time), self.interrupt_event)
+                    found = offset is not None
+                    self.recordDrift(tracked=found)
+                    if post is not None:
+                        post(("tracked", found))
+                dx, dy = self.drift_tracker.offset
+                self.recordDrift(offset=(dx, dy))
+                if post is not None:
+                    post(("offset", dx, dy))
+            for i in self.order:
+                if self.interrupt_event.is_set():
+                    break
+                counts[i] = self.measurePoint(self.x_coords[i] + dx, self.y_coords[i] + dy, int_time)
+                if post is not None:
+                    post(("point", i, counts[i]))
+        finally:
+            self.save_data[self.loop] = counts.tolist() # Also what was measured before an error.
+        return counts
+
+    def measurePoint(self, x_coord, y_coord, int_time):
+        ##
+        ## [Worker thread] MOVES TO (x_coord, y_coord) AND RETURNS THE COUNTS/s THERE.
+        ##
+        self.DAQ["Scanning Mirror"].moveTo(x_coord, y_coord)
+        return self.DAQ["Photon Counter"].readCounts(integration_time=int_time)
+
+    def recordDrift(self, tracked=None, offset=None):
+        ##
+        ## RECORDS, FOR THIS LOOP, WHETHER THE DRIFT WAS RE-MEASURED (AND FOUND) AND THE OFFSET APPLIED.
+        ##
+        tracker = self.drift_tracker
+        if "drift_tracking" not in self.save_data:
+            self.save_data["drift_tracking"] = {
+                "reference": list(tracker.reference), # (V) Where the tracked emitter was supposed to be.
+                "step": tracker.step, # (V) Local scan pixel size.
+                "radius": tracker.radius, # Local scan is (2*radius+1)^2 pixels.
+                "every": self.track_every, # Loops between drift measurements.
+                "tracked": {}, # Loop # -> True if the drift was measured (False if the emitter was lost).
+                "offset_x": {}, # Loop # -> (V) x offset added to every point.
+                "offset_y": {}
+            }
+        drift_data = self.save_data["drift_tracking"]
+        drift_data["every"] = self.track_every
+        if tracker.origin is not None:
+            drift_data["origin"] = list(tracker.origin) # (V) Where the emitter was found the first time.
+        if tracked is not None:
+            drift_data["tracked"][self.loop] = tracked
+        if offset is not None:
+            drift_data["offset_x"][self.loop] = float(offset[0])
+            drift_data["offset_y"][self.loop] = float(offset[1])
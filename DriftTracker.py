@@ -0,0 +1,87 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import numpy as np
+from PeakFitting import PeakFitter
+
+
+class DriftTracker:
+    reference = (0, 0) # (x, y) voltages of the emitter that is tracked.
+    step = 0.01 # (V) Pixel size of the local scan.
+    radius = 5 # The local scan is (2*radius+1) x (2*radius+1) pixels around the tracked emitter.
+    voltage_range = None # (min, max) voltages the local scan is kept inside, or None.
+    origin = None # (x, y) voltages the emitter was found at the first time; offsets are measured from here.
+    offset = (0.0, 0.0) # (dx, dy) voltages the emitter has drifted by, added to every move.
+    min_contrast = 3 # The brightest pixel has to be this many times the local scan's median to count as found.
+    fitter = None # PeakFitter that locates the emitter to sub-pixel accuracy.
+
+    def __init__(self, reference, step, radius=5, voltage_range=None):
+        ##
+        ## KEEPS A LONG CUSTOM-POINT LOOP ON TARGET: NOW AND THEN, A SMALL SCAN AROUND A REFERENCE EMITTER FINDS
+        ## WHERE IT HAS DRIFTED TO (GAUSSIAN FIT), AND EVERY POINT IS THEN VISITED AT ITS COORDINATES PLUS THAT
+        ## OFFSET. THE FIRST TRACKING SETS WHERE THE EMITTER IS (origin), SO reference NEEDN'T BE EXACTLY ON IT.
+        ##
+        self.reference = (float(reference[0]), float(reference[1]))
+        self.step = float(step)
+        self.radius = max(2, int(radius))
+        self.voltage_range = voltage_range
+        self.fitter = PeakFitter("gaussian", radius=2, n_workers=1)
+
+    def getLocalAxes(self):
+        ##
+        ## x & y VOLTAGES OF THE LOCAL SCAN, CENTERED ON WHERE THE EMITTER SHOULD BE NOW.
+        ##
+        offsets = self.step * np.arange(-self.radius, self.radius + 1)
+        x_axis = self.reference[0] + self.offset[0] + offsets
+        y_axis = self.reference[1] + self.offset[1] + offsets
+        if self.voltage_range is not None:
+            x_axis = np.clip(x_axis, *self.voltage_range)
+            y_axis = np.clip(y_axis, *self.voltage_range)
+        return x_axis, y_axis
+
+    def track(self, measure, interrupt_event=None):
+        ##
+        ## SCANS AROUND THE EMITTER WITH measure(x, y) -> COUNTS/s (ONE PIXEL, SERPENTINE ORDER) AND UPDATES offset.
+        ## RETURNS THE NEW offset, OR None (offset UNCHANGED) IF THE EMITTER WASN'T FOUND OR THE SCAN WAS INTERRUPTED.
+        ##
+        x_axis, y_axis = self.getLocalAxes()
+        image = np.zeros((len(x_axis), len(y_axis)))
+        for x_i in range(len(x_axis)):
+            y_indices = range(len(y_axis)) if x_i % 2 == 0 else range(len(y_axis) - 1, -1, -1)
+            for y_i in y_indices:
+                if interrupt_event is not None and interrupt_event.is_set():
+                    return None
+                image[x_i, y_i] = measure(x_axis[x_i], y_axis[y_i])
+        position = self.locate(image, x_axis, y_axis)
+        if position is None:
+            return None
+        if self.origin is None:
+            self.origin = position
+        self.offset = (position[0] - self.origin[0], position[1] - self.origin[1])
+        return self.offset
+
+    def locate(self, image, x_axis, y_axis):
+        ##
+        ## (x, y) VOLTAGES OF THE BRIGHTEST EMITTER IN THE LOCAL SCAN, OR None IF THERE ISN'T A CLEAR ONE
+        ## (TOO DIM, THE FIT FAILED, OR IT'S ON THE EDGE, i.e. IT HAS DRIFTED FURTHER THAN THE SCAN REACHES).
+        ##
+        peak_x, peak_y = np.unravel_index(np.argmax(image), image.shape)
+        if image[peak_x, peak_y] < self.min_contrast * max(np.median(image), 1):
+            return None
+        if peak_x in (0, image.shape[0] - 1) or peak_y in (0, image.shape[1] - 1):
+            return None
+        fit = self.fitter.fit(image, [peak_x], [peak_y])
+        if not fit["converged"][0]:
+            return None
+        indices = np.arange(len(x_axis))
+        return float(np.interp(fit["x"][0], indices, x_axis)), float(np.interp(fit["y"][0], indices, y_axis))
@@ -0,0 +1,137 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import json
+import queue
+import threading
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from ScanFile import ScanFile
+
+
+class ExportWorker:
+    jobs = None # Queue of (description, function, args) waiting to run.
+    results = None # Queue of ("done"/"failed", description, error) for the Tk side to report.
+    thread = None # Worker thread that runs the jobs one after the other.
+    band = 256 # Columns written to a .h5 file at a time.
+
+    def __init__(self):
+        ##
+        ## RUNS SAVES (DATA FILES & PNG PLOTS) IN A BACKGROUND THREAD, SO THE UI STAYS RESPONSIVE.
+        ## JOBS WORK ON A SNAPSHOT OF THE SCAN (ScanWindow.takeSnapshot) AND DRAW ON THEIR OWN OFF-SCREEN
+        ## Agg FIGURES, SO THE LIVE CANVAS IS NEVER TOUCHED.
+        ##
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, description, function, *args):
+        self.jobs.put((description, function, args))
+
+    def run(self):
+        while True:
+            description, function, args = self.jobs.get()
+            try:
+                function(*args)
+                self.results.put(("done", description, None))
+            except Exception as e:
+                self.results.put(("failed", description, e))
+            finally:
+                self.jobs.task_done()
+
+    def getResults(self):
+        ##
+        ## RETURNS (AND CLEARS) THE RESULTS OF THE JOBS THAT HAVE FINISHED SINCE THE LAST CALL.
+        ##
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def isBusy(self):
+        return self.jobs.unfinished_tasks > 0
+
+    def waitUntilDone(self):
+        ##
+        ## BLOCKS UNTIL EVERY SUBMITTED JOB HAS FINISHED (e.g. BEFORE QUITTING).
+        ##
+        self.jobs.join()
+
+    def writeScanFile(self, snapshot, path, compression="gzip"):
+        ##
+        ## WRITES THE SNAPSHOT'S DATA AND METADATA TO path + ".h5".
+        ##
+        with ScanFile(path+".h5", "w") as scan_file:
+            scan_file.create(snapshot["x_axis"], snapshot["y_axis"], snapshot["save_data"], compression=compression)
+            # Write in bands so that a TileStore scan never has to be in RAM all at once.
+            scan_data = snapshot["scan_data"]
+            for x0 in range(0, len(snapshot["x_axis"]), self.band):
+                scan_file.writeColumns(x0, np.asarray(scan_data[x0:x0+self.band]),
+                                       done=snapshot["columns_done"][x0:x0+self.band])
+            if snapshot.get("measured") is not None:
+                scan_file.writeMeasured(snapshot["measured"])
+
+    def writeJson(self, snapshot, path):
+        ##
+        ## WRITES THE SNAPSHOT AS A .json FILE. THE SCAN IS ONLY TURNED INTO LISTS HERE, FOR WRITING.
+        ##
+        save_data = dict(snapshot["save_data"])
+        save_data["scan_data"] = np.asarray(snapshot["scan_data"]).tolist()
+        if snapshot.get("measured") is not None:
+            save_data["measured"] = snapshot["measured"].tolist()
+        with open(path+".json", "w") as file:
+            file.write(json.dumps(save_data, indent=4, default=float))
+
+    def renderScan(self, snapshot, path):
+        ##
+        ## DRAWS THE SNAPSHOT'S IMAGE (WITH ITS ANNOTATIONS, IF ANY) ON AN OFF-SCREEN FIGURE AND SAVES IT AS A PNG.
+        ##
+        fig = Figure(figsize=snapshot["figsize"], dpi=snapshot["dpi"])
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        image = ax.imshow(snapshot["image"],
+                          extent=snapshot["extent"],
+                          aspect=snapshot["aspectratio"],
+                          origin='lower',
+                          cmap=snapshot["palette"],
+                          vmin=snapshot["clim"][0],
+                          vmax=snapshot["clim"][1])
+        fig.colorbar(image, ax=ax)
+        for line in snapshot["lines"]:
+            ax.plot(line["xdata"], line["ydata"], **line["style"])
+        ax.set_xlim(snapshot["xlim"])
+        ax.set_ylim(snapshot["ylim"])
+        fig.savefig(path, dpi=snapshot["dpi"])
+
+    def renderScatter(self, snapshot, path):
+        ##
+        ## DRAWS A CUSTOM POINTS SNAPSHOT (PopoutPlot.takeSnapshot) OFF-SCREEN AND SAVES IT AS A PNG.
+        ##
+        fig = Figure(figsize=snapshot["figsize"], dpi=snapshot["dpi"])
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        ax.scatter(snapshot["x_coords"],
+                   snapshot["y_coords"],
+                   s=100,
+                   marker='H',
+                   linewidths=0,
+                   c=snapshot["scan_data"],
+                   cmap="inferno")
+        ax.set_xlim(snapshot["xlim"])
+        ax.set_ylim(snapshot["ylim"])
+        ax.set_facecolor("black")
+        fig.savefig(path, dpi=snapshot["dpi"])
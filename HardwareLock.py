@@ -0,0 +1,48 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import threading
+
+
+class HardwareLock:
+    owner = None # Who is using the scanning mirror & photon counter (e.g. "scan window", "client"), or None.
+    lock = None # threading.Lock that guards owner.
+
+    def __init__(self):
+        ##
+        ## SAYS WHO IS USING THE HARDWARE. THE GUI AND THE SERVER'S CLIENTS BOTH TAKE IT BEFORE THEY MOVE THE
+        ## MIRROR OR READ THE COUNTER, FOR A SINGLE MOVE OR FOR A WHOLE SCAN. WHOEVER HAS IT KEEPS IT UNTIL THEY
+        ## RELEASE IT; EVERYONE ELSE IS REFUSED RIGHT AWAY INSTEAD OF WAITING, SO THE TK THREAD NEVER BLOCKS.
+        ##
+        self.lock = threading.Lock()
+
+    def acquire(self, owner):
+        ##
+        ## TAKES THE HARDWARE FOR owner. RETURNS FALSE (AND CHANGES NOTHING) IF SOMEONE ALREADY HAS IT.
+        ##
+        with self.lock:
+            if self.owner is not None:
+                return False
+            self.owner = owner
+            return True
+
+    def release(self, owner):
+        ##
+        ## GIVES THE HARDWARE BACK, IF owner HAS IT.
+        ##
+        with self.lock:
+            if self.owner == owner:
+                self.owner = None
+
+    def getOwner(self):
+        return self.owner
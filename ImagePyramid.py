@@ -0,0 +1,125 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import numpy as np
+
+
+class ImagePyramid:
+    source = None # Full-resolution scan data [x][y] (numpy array or TileStore); level 0.
+    shape = (0, 0) # (# x pixels, # y pixels) of the source.
+    levels = None # levels[k] is the source block-averaged over 2^k x 2^k pixels, or None if it isn't kept.
+    max_level_pixels = 16000000 # Levels bigger than this aren't kept in RAM; they are read from the source when needed.
+    min_size = 256 # Levels stop once both sides are smaller than this.
+    dirty = None # [first, last] x indices of the source changed since the last refresh(), or None.
+    band = 256 # Source columns recomputed at a time, so that a TileStore never has to be in RAM all at once.
+
+    def __init__(self, source, n_levels=3):
+        ##
+        ## BLOCK-AVERAGED COPIES OF THE SCAN AT 2x, 4x, 8x... LOWER RESOLUTION, SO THAT THE PLOT ONLY EVER
+        ## HAS TO DRAW ABOUT AS MANY PIXELS AS THERE ARE ON THE SCREEN, HOWEVER BIG THE SCAN IS.
+        ## AT LEAST n_levels LEVELS ARE MADE, AND MORE UNTIL THE COARSEST ONE IS SMALL. THE LEVELS START AT 0
+        ## (LIKE A NEW SCAN); FOR A source THAT ALREADY HAS DATA, markDirty() ALL OF IT. AS DATA ARRIVES,
+        ## markDirty() THE CHANGED COLUMNS AND refresh() ONLY RECOMPUTES THE BLOCKS ABOVE THEM.
+        ##
+        self.source = source
+        self.shape = (int(source.shape[0]), int(source.shape[1]))
+        self.levels = [None]
+        k = 1
+        while k <= n_levels or max(self.getLevelShape(k - 1)) > self.min_size:
+            n_x, n_y = self.getLevelShape(k)
+            self.levels.append(np.zeros((n_x, n_y), dtype=np.float32) if n_x * n_y <= self.max_level_pixels else None)
+            if n_x == 1 and n_y == 1:
+                break
+            k += 1
+
+    def getLevelShape(self, k):
+        f = 2**k
+        return (-(-self.shape[0] // f), -(-self.shape[1] // f)) # Ceiling division.
+
+    def markDirty(self, first, last=None):
+        ##
+        ## RECORDS THAT SOURCE COLUMNS first..last (x INDICES) HAVE CHANGED.
+        ##
+        last = first if last is None else last
+        if self.dirty is None:
+            self.dirty = [first, last]
+        else:
+            self.dirty = [min(self.dirty[0], first), max(self.dirty[1], last)]
+
+    def refresh(self):
+        ##
+        ## RECOMPUTES THE BLOCKS OF EVERY KEPT LEVEL THAT COVER THE DIRTY COLUMNS.
+        ##
+        if self.dirty is None:
+            return
+        first, last = self.dirty
+        self.dirty = None
+        for start in range(first - first % self.band, last + 1, self.band):
+            self.refreshColumns(max(start, first), min(start + self.band - 1, last))
+
+    def refreshColumns(self, first, last):
+        for k in range(1, len(self.levels)):
+            first, last = first // 2, last // 2
+            if self.levels[k] is None:
+                continue
+            # Made from the level below (or straight from the source if that one isn't kept).
+            below = self.getBlock(k - 1, 2*first, min(2*last + 2, self.getLevelShape(k - 1)[0]))
+            self.levels[k][first:last+1] = self.reduce(below)
+
+    def getBlock(self, k, x0, x1):
+        ##
+        ## RETURNS COLUMNS x0..x1-1 OF LEVEL k (ALL y), COMPUTING THEM IF THE LEVEL ISN'T KEPT.
+        ##
+        if k == 0:
+            return np.asarray(self.source[x0:x1], dtype=np.float32)
+        if self.levels[k] is not None:
+            return self.levels[k][x0:x1]
+        return self.reduce(self.getBlock(k - 1, 2*x0, min(2*x1, self.getLevelShape(k - 1)[0])))
+
+    def reduce(self, block):
+        ##
+        ## AVERAGES 2x2 BLOCKS. AN ODD LAST ROW/COLUMN IS AVERAGED WITH ITSELF (EDGE PADDING).
+        ##
+        block = np.pad(block, ((0, block.shape[0] % 2), (0, block.shape[1] % 2)), mode="edge")
+        return block.reshape(block.shape[0]//2, 2, block.shape[1]//2, 2).mean(axis=(1, 3))
+
+    def chooseLevel(self, n_x, n_y, width, height):
+        ##
+        ## THE COARSEST LEVEL THAT STILL HAS AT LEAST ONE PIXEL PER SCREEN PIXEL, WHEN n_x x n_y SOURCE
+        ## PIXELS ARE SHOWN ON width x height SCREEN PIXELS.
+        ##
+        k = 0
+        while k + 1 < len(self.levels) and n_x / 2**(k+1) >= width and n_y / 2**(k+1) >= height:
+            k += 1
+        return k
+
+    def getRegion(self, x0, x1, y0, y1, width, height):
+        ##
+        ## FOR SOURCE PIXELS [x0:x1, y0:y1] SHOWN ON width x height SCREEN PIXELS, RETURNS THE IMAGE TO DRAW
+        ## (FROM THE MATCHING LEVEL) AND THE SOURCE PIXEL RANGE (x0, x1, y0, y1) IT ACTUALLY COVERS.
+        ##
+        k = self.chooseLevel(x1 - x0, y1 - y0, width, height)
+        f = 2**k
+        n_x, n_y = self.getLevelShape(k)
+        i0, i1 = x0 // f, min(-(-x1 // f), n_x)
+        j0, j1 = y0 // f, min(-(-y1 // f), n_y)
+        if k == 0:
+            image = self.source[i0:i1, j0:j1]
+        elif self.levels[k] is not None:
+            image = self.levels[k][i0:i1, j0:j1]
+        elif hasattr(self.source, "read"):
+            # Level too big to keep: subsample the visible part of the (TileStore) source instead.
+            image = self.source.read(i0*f, min(i1*f, self.shape[0]), j0*f, min(j1*f, self.shape[1]), step=f)
+        else:
+            image = self.getBlock(k, i0, i1)[:, j0:j1]
+        return np.asarray(image), (i0*f, min(i1*f, self.shape[0]), j0*f, min(j1*f, self.shape[1]))
@@ -0,0 +1,301 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import os
+import json
+import copy
+import queue
+import threading
+from datetime import datetime
+import numpy as np
+from ScanCore import ScanCore, ScanSpec
+from ScanFile import ScanFile
+from PeakFinding import PeakFinder
+from PeakFitting import getPeakData
+from RouteOptimizer import RouteOptimizer
+from DriftTracker import DriftTracker
+from CustomLoop import CustomLoop
+
+
+class JobQueue:
+    path = "" # .json file the queue is kept in, rewritten after every change.
+    jobs = None # List of job dictionaries, in the order they run.
+    lock = None # Guards jobs & the file (the runner thread and the Tk thread both change them).
+    format_version = 1
+
+    def __init__(self, path):
+        ##
+        ## A LIST OF SCAN JOBS THAT IS KEPT ON DISK, SO THAT AFTER A CRASH OR RESTART THE QUEUE CARRIES ON AT THE
+        ## NEXT JOB THAT ISN'T DONE. A JOB IS A DICTIONARY:
+        ##   "name"         USED FOR ITS OUTPUT FOLDER
+        ##   "scan"         ScanSpec.toDict() SETTINGS ("output" MAY BE LEFT OUT)
+        ##   "folder"       WHERE ITS OUTPUTS GO (DEFAULT: NEXT TO THE QUEUE FILE)
+        ##   "peaks"        OPTIONAL: FIND PEAKS AFTER THE SCAN, {"min_sep", "threshold", "fit"}
+        ##   "custom_loop"  OPTIONAL: THEN VISIT THE PEAKS, {"loops", "integration_time" (ms), "optimize_route"}
+        ## AND THE QUEUE ADDS "id", "status" ("pending", "running", "done" OR "failed"), "attempts", "outputs",
+        ## "error", "started" & "finished".
+        ##
+        self.path = path
+        self.lock = threading.RLock()
+        self.jobs = []
+        if os.path.exists(path):
+            with open(path) as file:
+                self.jobs = json.load(file)["jobs"]
+            for job in self.jobs:
+                if job["status"] == "running":
+                    # The app stopped in the middle of this job; it is run again (its scan resumed, if it can be).
+                    job["status"] = "pending"
+            self.save()
+
+    def save(self):
+        ##
+        ## WRITES THE QUEUE TO A TEMPORARY FILE FIRST, SO THAT A CRASH WHILE SAVING NEVER LEAVES A BROKEN QUEUE.
+        ##
+        with self.lock:
+            temporary = self.path + ".tmp"
+            with open(temporary, "w") as file:
+                json.dump({"format_version": self.format_version, "jobs": self.jobs}, file, indent=4, default=float)
+            os.replace(temporary, self.path)
+
+    def add(self, job):
+        ##
+        ## ADDS A JOB TO THE END OF THE QUEUE. RAISES ValueError IF ITS SCAN SETTINGS ARE INVALID.
+        ##
+        job = copy.deepcopy(job)
+        self.checkJob(job)
+        with self.lock:
+            job["id"] = max([j["id"] for j in self.jobs], default=0) + 1
+            job.setdefault("name", "job")
+            job.setdefault("folder", os.path.dirname(os.path.abspath(self.path)))
+            job.update({"status": "pending", "attempts": 0, "outputs": {}, "error": None, "started": None, "finished": None})
+            self.jobs.append(job)
+            self.save()
+            return job["id"]
+
+    def addFile(self, path):
+        ##
+        ## ADDS EVERY JOB IN A .json JOB FILE ({"jobs": [...]} OR JUST THE LIST). RETURNS THEIR IDs.
+        ## IF ANY OF THEM IS INVALID, NONE OF THEM ARE ADDED.
+        ##
+        with open(path) as file:
+            jobs = json.load(file)
+        if isinstance(jobs, dict):
+            jobs = jobs["jobs"]
+        for i, job in enumerate(jobs):
+            try:
+                self.checkJob(job)
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"job {i+1}: {e}") from e
+        with self.lock:
+            return [self.add(job) for job in jobs]
+
+    @staticmethod
+    def checkJob(job):
+        ##
+        ## RAISES ValueError (OR KeyError/TypeError FOR A JOB WITHOUT SCAN SETTINGS) IF job CAN'T BE RUN.
+        ##
+        ScanSpec.fromDict(job["scan"]) # Check the settings now rather than in the middle of the night.
+
+    def getNext(self):
+        ##
+        ## MARKS THE FIRST PENDING JOB AS RUNNING AND RETURNS (A COPY OF) IT, OR None IF THERE ARE NONE LEFT.
+        ##
+        with self.lock:
+            for job in self.jobs:
+                if job["status"] == "pending":
+                    job["status"] = "running"
+                    job["attempts"] += 1
+                    job["started"] = datetime.now().isoformat(timespec="seconds")
+                    self.save()
+                    return copy.deepcopy(job)
+            return None
+
+    def update(self, job_id, **changes):
+        with self.lock:
+            job = self.getJob(job_id)
+            job.update(changes)
+            if changes.get("status") in ["done", "failed"]:
+                job["finished"] = datetime.now().isoformat(timespec="seconds")
+            self.save()
+
+    def getJob(self, job_id):
+        with self.lock:
+            return next(job for job in self.jobs if job["id"] == job_id)
+
+    def getCounts(self):
+        ##
+        ## HOW MANY JOBS HAVE EACH STATUS.
+        ##
+        with self.lock:
+            counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+            for job in self.jobs:
+                counts[job["status"]] += 1
+            return counts
+
+    def clearFinished(self):
+        with self.lock:
+            self.jobs = [job for job in self.jobs if job["status"] not in ["done", "failed"]]
+            self.save()
+
+
+class JobRunner:
+    DAQ = None # DAQ dictionary that hosts the hardware.
+    job_queue = None # JobQueue that the jobs are taken from.
+    interrupt_event = None # Set to stop (the current job is run again next time, resuming its scan).
+    events = None # Queue of ("started", job) / ("done", job) / ("failed", job, error) / ("idle",) for the UI.
+    thread = None # Worker thread that runs the jobs.
+    peak_finder = None # PeakFinder for the peak finding step of jobs.
+
+    def __init__(self, DAQ, job_queue, interrupt_event=None):
+        ##
+        ## RUNS THE PENDING JOBS OF job_queue BACK TO BACK ON THE HARDWARE, IN A WORKER THREAD, UNTIL THERE ARE NONE
+        ## LEFT OR IT'S INTERRUPTED. EACH JOB WRITES ITS OUTPUTS TO <folder>/<id>_<name>/.
+        ##
+        self.DAQ = DAQ
+        self.job_queue = job_queue
+        self.interrupt_event = threading.Event() if interrupt_event is None else interrupt_event
+        self.events = queue.Queue()
+        self.peak_finder = PeakFinder(cache_size=2)
+
+    def start(self):
+        self.interrupt_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def getEvents(self):
+        ##
+        ## RETURNS (AND CLEARS) THE EVENTS SINCE THE LAST CALL.
+        ##
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def run(self):
+        ##
+        ## [Worker thread] TAKES JOBS FROM THE QUEUE UNTIL IT'S EMPTY OR INTERRUPTED.
+        ##
+        while not self.interrupt_event.is_set():
+            job = self.job_queue.getNext()
+            if job is None:
+                break
+            self.events.put(("started", job))
+            try:
+                outputs = self.runJob(job)
+            except Exception as e:
+                self.job_queue.update(job["id"], status="failed", error=str(e))
+                self.events.put(("failed", job, e))
+                continue
+            if self.interrupt_event.is_set():
+                # Not finished: it runs again next time, resuming its scan from the checkpoint (see runJob).
+                self.job_queue.update(job["id"], status="pending", outputs=outputs)
+                break
+            self.job_queue.update(job["id"], status="done", outputs=outputs)
+            self.events.put(("done", self.job_queue.getJob(job["id"])))
+        self.events.put(("idle",))
+
+    def runJob(self, job):
+        ##
+        ## [Worker thread] SCANS, THEN (IF ASKED) FINDS PEAKS AND LOOPS OVER THEM. RETURNS THE OUTPUT PATHS.
+        ##
+        folder = os.path.join(job["folder"], f"{job['id']}_{job['name']}")
+        os.makedirs(folder, exist_ok=True)
+        settings = dict(job["scan"])
+        if not settings.get("output"):
+            settings["output"] = os.path.join(folder, "scan.h5")
+        spec = ScanSpec.fromDict(settings)
+        outputs = {"scan": spec.output}
+        if spec.n_frames > 1:
+            outputs["time_lapse"] = spec.getTimeLapseOutput()
+
+        # A job that was cut short carries on with its scan where it stopped.
+        resume = job["attempts"] > 1 and self.canResume(spec)
+        core = ScanCore(self.DAQ, spec, self.interrupt_event, resume=resume).start()
+        for message in core:
+            if message[0] == "error":
+                raise message[1]
+        if self.interrupt_event.is_set():
+            return outputs
+
+        if job.get("peaks") is not None:
+            peak_data = self.findPeaks(job, spec)
+            with ScanFile(spec.output, "r+") as scan_file:
+                save_data = json.loads(scan_file.h5.attrs["save_data"])
+                save_data["peak_finding"] = peak_data
+                scan_file.writeMetadata(save_data)
+            outputs["peaks"] = os.path.join(folder, "peaks.json")
+            with open(outputs["peaks"], "w") as file:
+                json.dump({"x_coord": peak_data["peaks_x_coords"], "y_coord": peak_data["peaks_y_coords"]}, file)
+            if job.get("custom_loop") is not None and len(peak_data["peaks_x_coords"]) > 0:
+                loop_data = self.runCustomLoop(job["custom_loop"], peak_data["peaks_x_coords"], peak_data["peaks_y_coords"], spec)
+                with ScanFile(spec.output, "r+") as scan_file:
+                    save_data = json.loads(scan_file.h5.attrs["save_data"])
+                    save_data["custom_points"] = loop_data
+                    scan_file.writeMetadata(save_data)
+        return outputs
+
+    def canResume(self, spec):
+        ##
+        ## TRUE IF spec.output IS AN AUTOSAVE OF THE SAME SCAN THAT CAN BE CARRIED ON WITH.
+        ##
+        if not os.path.exists(spec.output) or spec.scan_mode == "adaptive" or spec.n_frames > 1:
+            return False
+        try:
+            return ScanSpec.fromCheckpoint(spec.output).toDict() == spec.toDict()
+        except (OSError, ValueError, KeyError):
+            return False # e.g. the file was cut off mid-write by a crash.
+
+    def findPeaks(self, job, spec):
+        ##
+        ## [Worker thread] FINDS PEAKS IN THE FINISHED SCAN LIKE "Find Peaks" IN THE SCAN WINDOW. RETURNS THE
+        ## save_data["peak_finding"] ENTRIES.
+        ##
+        settings = job["peaks"]
+        with ScanFile(spec.output) as scan_file:
+            scan_data = scan_file.getScanData().astype(float)
+        detected_peaks = self.peak_finder.getPeaks(("job", job["id"], job["attempts"]), scan_data,
+                                                   int(settings.get("min_sep", 3)), float(settings.get("threshold", 2)))
+        peak_x, peak_y = np.asarray(detected_peaks, dtype=int).reshape(-1, 2).T
+        return getPeakData(scan_data, peak_x, peak_y, spec.x_axis, spec.y_axis, spec.x_step, spec.y_step,
+                           settings.get("fit", "none"))
+
+    def runCustomLoop(self, settings, x_coords, y_coords, spec):
+        ##
+        ## [Worker thread] VISITS THE POINTS settings["loops"] TIMES, LIKE "Start Loop" (WITH THE ROUTE OPTIMIZED
+        ## AND THE DRIFT TRACKED ON THE FIRST POINT EVERY settings["track_drift_every"] LOOPS, IF ASKED). RETURNS
+        ## THE save_data["custom_points"] ENTRIES (COUNTS/s PER LOOP, IN POINT ORDER).
+        ##
+        mirror = self.DAQ["Scanning Mirror"]
+        int_time = float(settings.get("integration_time", 1)) / 1000
+        order = None
+        if settings.get("optimize_route", False):
+            order = RouteOptimizer(x_coords, y_coords).getOrder(start=(0, 0))
+        drift_tracker = None
+        track_every = int(settings.get("track_drift_every", 0))
+        if track_every > 0:
+            drift_tracker = DriftTracker((x_coords[0], y_coords[0]), min(abs(spec.x_step), abs(spec.y_step)),
+                                         voltage_range=mirror.getVoltageRange())
+        custom_loop = CustomLoop(self.DAQ, x_coords, y_coords, self.interrupt_event, order=order,
+                                 drift_tracker=drift_tracker, track_every=max(1, track_every))
+        for _ in range(int(settings.get("loops", 1))):
+            if self.interrupt_event.is_set():
+                break
+            custom_loop.runLoop(int_time)
+        mirror.moveTo(0, 0)
+        return custom_loop.save_data
@@ -0,0 +1,162 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import numpy as np
+
+
+class LineShift:
+    n_y = 0 # Pixels per column.
+    max_lag = 5 # (pixels) Largest lag that is looked for.
+    min_pairs = 8 # Column pairs needed before the estimate is trusted.
+    min_correlation = 0.2 # The peak (normalized) correlation of neighbouring columns has to reach this.
+    correlation = None # Summed correlation of neighbouring columns, at shifts -2*max_lag..2*max_lag (see pairCorrelation).
+    norm = 0.0 # Summed sqrt(energy x energy) of the pairs, which normalizes correlation to -1..1.
+    n_pairs = 0 # How many column pairs are in correlation.
+    columns = None # Raw columns (by x index) that are waiting for a neighbour.
+    seen = None # Set of the x indices that have been added.
+    band = 256 # Columns handled at a time for whole scans, which bounds the memory a big scan needs.
+
+    def __init__(self, n_y, max_lag=5):
+        ##
+        ## ESTIMATES & CORRECTS THE LINE SHIFT OF SERPENTINE SCANS: THE DETECTOR & MIRROR LAG BEHIND THE SCAN,
+        ## SO EVERY COLUMN IS DISPLACED BY lag PIXELS ALONG ITS SCAN DIRECTION (+y FOR EVEN COLUMNS, -y FOR ODD
+        ## ONES), WHICH SHOWS AS A COMB AT SHORT DWELL TIMES. NEIGHBOURING COLUMNS ARE SHIFTED BY 2 x lag
+        ## RELATIVE TO EACH OTHER, WHICH CROSS-CORRELATING THEM MEASURES (TO SUB-PIXEL, BY A PARABOLA THROUGH
+        ## THE PEAK). COLUMNS CAN BE ADDED ONE AT A TIME DURING A SCAN (add) OR A WHOLE IMAGE AT ONCE (estimate).
+        ##
+        self.n_y = int(n_y)
+        self.max_lag = int(max_lag)
+        self.correlation = np.zeros(4*self.max_lag + 1)
+        self.columns = {}
+        self.seen = set()
+
+    def pairCorrelation(self, first_columns, second_columns, first_x):
+        ##
+        ## SUMMED CROSS-CORRELATION OF EACH COLUMN IN first_columns (x INDICES first_x) WITH THE NEXT COLUMN
+        ## (second_columns), AT SHIFTS -2*max_lag..2*max_lag, ALL PAIRS AT ONCE BY FFT. PAIRS STARTING ON AN ODD
+        ## COLUMN ARE FLIPPED SO THAT EVERY PAIR PEAKS AT -2 x lag; A TILTED SAMPLE THEN CANCELS OUT.
+        ## RETURNS (CORRELATION, NORM).
+        ##
+        a = np.asarray(first_columns, dtype=float)
+        b = np.asarray(second_columns, dtype=float)
+        a = a - a.mean(axis=1, keepdims=True)
+        b = b - b.mean(axis=1, keepdims=True)
+        n_fft = 1 << int(2*self.n_y - 1).bit_length() # Padded so the correlation doesn't wrap around.
+        correlation = np.fft.irfft(np.conj(np.fft.rfft(a, n_fft)) * np.fft.rfft(b, n_fft), n_fft)
+        k = 2*self.max_lag
+        correlation = np.concatenate([correlation[:, -k:], correlation[:, :k+1]], axis=1) # Shifts -k..k.
+        odd = np.asarray(first_x) % 2 == 1
+        correlation[odd] = correlation[odd, ::-1]
+        norm = np.sqrt((a**2).sum(axis=1) * (b**2).sum(axis=1)).sum()
+        return correlation.sum(axis=0), norm
+
+    def add(self, x_i, column):
+        ##
+        ## ADDS A FINISHED (RAW, UNCORRECTED) COLUMN, PAIRING IT WITH ITS NEIGHBOURS IF THEY'RE ALREADY IN.
+        ##
+        column = np.asarray(column, dtype=float)
+        for first, second in [(x_i - 1, x_i), (x_i, x_i + 1)]:
+            other = first if second == x_i else second
+            if other in self.columns:
+                pair = [self.columns[other], column] if other == first else [column, self.columns[other]]
+                correlation, norm = self.pairCorrelation([pair[0]], [pair[1]], [first])
+                self.correlation += correlation
+                self.norm += norm
+                self.n_pairs += 1
+        self.seen.add(x_i)
+        self.columns[x_i] = column.copy()
+        for x in [x_i - 1, x_i, x_i + 1]:
+            # Keep only the columns that can still get a neighbour.
+            if x in self.columns and x - 1 in self.seen and x + 1 in self.seen:
+                del self.columns[x]
+
+    def newFrame(self):
+        ##
+        ## THE SAME COLUMNS ARE ABOUT TO BE SCANNED AGAIN (TIME-LAPSE); THE CORRELATION SO FAR IS KEPT.
+        ##
+        self.columns = {}
+        self.seen = set()
+
+    def getLag(self, correlation=None, norm=None, n_pairs=None):
+        ##
+        ## THE LAG (PIXELS, ALONG THE SCAN DIRECTION) FROM THE COLUMNS SO FAR, OR None IF THERE ISN'T A
+        ## CLEAR ENOUGH PEAK YET (TOO FEW PAIRS, ONLY BACKGROUND, OR A LAG BEYOND max_lag).
+        ##
+        if correlation is None:
+            correlation, norm, n_pairs = self.correlation, self.norm, self.n_pairs
+        if n_pairs < self.min_pairs or norm <= 0:
+            return None
+        peak = int(np.argmax(correlation))
+        if peak in (0, len(correlation) - 1) or correlation[peak] < self.min_correlation * norm:
+            return None
+        left, center, right = correlation[peak - 1], correlation[peak], correlation[peak + 1]
+        curvature = left - 2*center + right
+        offset = 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+        shift = peak + offset - 2*self.max_lag
+        return float(-shift / 2)
+
+    def estimate(self, image, columns_done=None):
+        ##
+        ## THE LAG OF A WHOLE SCAN ([x][y], AN ARRAY OR A TileStore) FROM EVERY PAIR OF NEIGHBOURING (DONE)
+        ## COLUMNS, A BAND OF PAIRS AT ONCE, OR None.
+        ##
+        total, total_norm, n_pairs = np.zeros_like(self.correlation), 0.0, 0
+        for first in range(0, len(image) - 1, self.band):
+            last = min(first + self.band, len(image) - 1) # Pairs first..last-1.
+            block = np.asarray(image[first:last+1], dtype=float)
+            pairs = np.arange(first, last)
+            if columns_done is not None:
+                pairs = pairs[columns_done[first:last] & columns_done[first+1:last+1]]
+            if len(pairs) > 0:
+                correlation, norm = self.pairCorrelation(block[pairs - first], block[pairs - first + 1], pairs)
+                total += correlation
+                total_norm += norm
+                n_pairs += len(pairs)
+        return self.getLag(total, total_norm, n_pairs)
+
+    @staticmethod
+    def correct(columns, x_indices, lag):
+        ##
+        ## SHIFTS EACH COLUMN BACK BY lag PIXELS AGAINST ITS SCAN DIRECTION (LINEAR INTERPOLATION, EDGES
+        ## REPEATED), ALL COLUMNS AT ONCE. columns IS [x][y] (OR ONE COLUMN), x_indices THEIR x INDICES.
+        ##
+        columns = np.asarray(columns, dtype=float)
+        single = columns.ndim == 1
+        columns = np.atleast_2d(columns)
+        x_indices = np.atleast_1d(x_indices)
+        n_y = columns.shape[1]
+        # Forward (even) columns: out[y] = in[y + lag]. Backward (odd) columns: out[y] = in[y - lag].
+        direction = np.where(x_indices % 2 == 0, 1.0, -1.0)[:, np.newaxis]
+        positions = np.clip(np.arange(n_y)[np.newaxis, :] + direction * lag, 0, n_y - 1)
+        below = np.floor(positions).astype(int)
+        above = np.minimum(below + 1, n_y - 1)
+        fraction = positions - below
+        rows = np.arange(len(columns))[:, np.newaxis]
+        corrected = columns[rows, below] * (1 - fraction) + columns[rows, above] * fraction
+        return corrected[0] if single else corrected
+
+    def correctImage(self, image, lag, columns_done=None):
+        ##
+        ## CORRECTS A WHOLE SCAN (OR JUST ITS DONE COLUMNS) IN PLACE, A BAND OF COLUMNS AT A TIME (SO IT ALSO
+        ## WORKS ON A TileStore).
+        ##
+        for first in range(0, len(image), self.band):
+            last = min(first + self.band, len(image))
+            x_indices = np.arange(first, last)
+            if columns_done is not None:
+                x_indices = x_indices[columns_done[first:last]]
+            if len(x_indices) > 0:
+                corrected = self.correct(image[first:last], np.arange(first, last), lag)
+                block = np.asarray(image[first:last], dtype=float)
+                block[x_indices - first] = corrected[x_indices - first]
+                image[first:last] = block
@@ -13,9 +13,16 @@
 
 import json
 import tkinter as tk
+from tkinter import ttk, StringVar
 from tkinter.filedialog import askopenfilename
 from ScanWindow import *
 from PopoutPlot import *
+from ExportWorker import ExportWorker
+from RouteOptimizer import RouteOptimizer
+from PeakFinding import PeakFinder
+from JobQueue import JobQueue, JobRunner
+from ScanServer import ScanServer
+from HardwareLock import HardwareLock
 
 
 class MainApp(tk.Tk):
@@ -23,13 +30,34 @@ class MainApp(tk.Tk):
     scanwindow = None # ScanWindow object that's generated when the Start Scan button is pressed.
     miniplot = None # PopoutPlot object that's generated when running custom coordinates.
     DAQ = None # DAQ dcitionary that hosts the hardware.
+    export_worker = None # ExportWorker that writes data files & plots in the background.
+    export_poll_interval = 200 # ms between checks for finished saves.
+    peak_cache = None # PeakFinder that remembers recent peak searches, by scan & parameters.
+    job_queue_path = "job_queue.json" # Where the job queue is kept between sessions.
+    job_queue = None # JobQueue of scans to run unattended.
+    job_runner = None # JobRunner while the queue is running, or None.
+    job_poll_interval = 500 # ms between checks on the running queue.
+    server = None # ScanServer that other programs can watch & control the scans through, or None.
+    hardware_lock = None # HardwareLock: who (a window, the job queue or a remote client) is using the hardware.
+    client_has_hardware = False # True while a remote client has the hardware (then the hardware controls are disabled).
+    hardware_poll_interval = 200 # ms between checks on who has the hardware.
+    last_autosave = "" # Autosave of the last scan window that was closed before its scan was done ('Resume' carries on with it).
 
     def __init__(self, DAQ, *args, **kwargs):
         tk.Tk.__init__(self, *args, **kwargs)
         self.resizable(False, False)
         self.title("Control Menu")
         self.DAQ = DAQ
+        self.hardware_lock = HardwareLock()
+        self.export_worker = ExportWorker()
+        self.peak_cache = PeakFinder()
+        self.job_queue = JobQueue(self.job_queue_path)
         self.generateControlMenu() # Grid is generated in this method
+        self.showJobQueueStatus()
+        if self.job_queue.getCounts()["pending"] > 0:
+            print(f"{self.job_queue.getCounts()['pending']} job(s) left in the queue; press 'Run Queue' to carry on.")
+        self.after(self.export_poll_interval, self.pollExportsEvent)
+        self.after(self.hardware_poll_interval, self.pollHardwareEvent)
 
     def generateControlMenu(self):
         ##
@@ -116,10 +144,13 @@ class MainApp(tk.Tk):
         widget_frames.append(frm_buttons)
         btn_start = tk.Button(master=frm_buttons, text="Start Scan", command=self.startScanEvent)
         btn_interrupt = tk.Button(master=frm_buttons, text="Interrupt", command=self.interruptScanEvent)
+        btn_resume = tk.Button(master=frm_buttons, text="Resume", command=self.resumeScanEvent)
         self.widgets["start_button"] = btn_start
         self.widgets["interrupt_button"] = btn_interrupt
+        self.widgets["resume_button"] = btn_resume
         btn_start.pack(padx=5, pady=5, side=tk.LEFT)
         btn_interrupt.pack(padx=5, pady=5, side=tk.LEFT)
+        btn_resume.pack(padx=5, pady=5, side=tk.LEFT)
 
         # Fast scan checkbox frame.
         frm_fastscan = tk.Frame(
@@ -132,6 +163,69 @@ class MainApp(tk.Tk):
         chkbox_fastscan = tk.Checkbutton(master=frm_fastscan, text='fast scan', variable=self.widgets["fast_scan_int"])
         self.widgets["fast_scan_checkbox"] = chkbox_fastscan
         chkbox_fastscan.pack(padx=5, pady=5, side=tk.LEFT)
+        self.widgets["line_shift_int"] = tk.IntVar() # 1 to measure & correct the forward/backward column shift.
+        chkbox_lineshift = tk.Checkbutton(master=frm_fastscan, text='correct line shift', variable=self.widgets["line_shift_int"])
+        self.widgets["line_shift_checkbox"] = chkbox_lineshift
+        chkbox_lineshift.pack(padx=5, pady=5, side=tk.LEFT)
+
+        # Scan mode frame.
+        frm_scanmode = tk.Frame(
+            master=self,
+            relief=tk.RAISED,
+            borderwidth=0
+        )
+        widget_frames.append(frm_scanmode)
+        lbl_scanmode = tk.Label(master=frm_scanmode, text="scan mode:", padx=1, pady=1)
+        self.widgets["scan_mode"] = StringVar()
+        # "hardware-timed": mirror & counter share a sample clock.
+        # "free-running": software loop, counter left running for the whole scan.
+        # "per-pixel": software loop, counter started & stopped at every pixel (fallback).
+        # "adaptive": coarse pass, then only the bright regions are refined down to the full resolution.
+        cbox_scanmode = ttk.Combobox(master=frm_scanmode,
+                                     textvariable=self.widgets["scan_mode"],
+                                     values=["hardware-timed", "free-running", "per-pixel", "adaptive"],
+                                     state="readonly",
+                                     width=14)
+        cbox_scanmode.current(0)
+        self.widgets["scan_mode_combobox"] = cbox_scanmode
+        lbl_scanmode.pack(padx=1, pady=5, side=tk.LEFT)
+        cbox_scanmode.pack(padx=1, pady=5, side=tk.LEFT)
+
+        # Adaptive scan settings frame.
+        frm_adaptive = tk.Frame(
+            master=self,
+            relief=tk.RAISED,
+            borderwidth=0
+        )
+        widget_frames.append(frm_adaptive)
+        lbl_coarse = tk.Label(master=frm_adaptive, text="adaptive: coarse step", padx=1, pady=1)
+        ent_coarse = tk.Entry(master=frm_adaptive, width=3)
+        ent_coarse.insert(0, "8")
+        lbl_refine = tk.Label(master=frm_adaptive, text="px, refine >", padx=1, pady=1)
+        ent_refine = tk.Entry(master=frm_adaptive, width=4)
+        ent_refine.insert(0, "2")
+        lbl_bg = tk.Label(master=frm_adaptive, text="x bg", padx=1, pady=1)
+        self.widgets["adaptive_coarse_step"] = ent_coarse
+        self.widgets["adaptive_refine_factor"] = ent_refine
+        lbl_coarse.pack(padx=1, pady=1, side=tk.LEFT)
+        ent_coarse.pack(padx=1, pady=1, side=tk.LEFT)
+        lbl_refine.pack(padx=1, pady=1, side=tk.LEFT)
+        ent_refine.pack(padx=1, pady=1, side=tk.LEFT)
+        lbl_bg.pack(padx=1, pady=1, side=tk.LEFT)
+
+        # Time-lapse settings frame.
+        frm_timelapse = tk.Frame(
+            master=self,
+            relief=tk.RAISED,
+            borderwidth=0
+        )
+        widget_frames.append(frm_timelapse)
+        lbl_frames = tk.Label(master=frm_timelapse, text="time-lapse frames:", padx=1, pady=1)
+        ent_frames = tk.Entry(master=frm_timelapse, width=4)
+        ent_frames.insert(0, "1") # 1 = a single scan; more = the same scan repeated, with drift tracking.
+        self.widgets["timelapse_frames"] = ent_frames
+        lbl_frames.pack(padx=1, pady=1, side=tk.LEFT)
+        ent_frames.pack(padx=1, pady=1, side=tk.LEFT)
 
         # Save folder frame.
         # Save settings frame.
@@ -150,8 +244,11 @@ class MainApp(tk.Tk):
         frm_savebuttons = tk.Frame(master=frm_folder_info, relief=tk.RAISED, borderwidth=0)
         btn_selectfolder = tk.Button(master=frm_savebuttons, text="Select Folder", command=self.selectSaveFolder)
         btn_selectfolder.pack(padx=1, pady=1, side=tk.LEFT)
+        lbl_savestatus = tk.Label(master=frm_folder_info, text="", wraplength=250, padx=1, pady=1)
+        self.widgets["save_status"] = lbl_savestatus
         frm_foldername.pack(padx=1, pady=1)
         frm_savebuttons.pack(padx=1, pady=1)
+        lbl_savestatus.pack(padx=1, pady=1)
 
         # Custom coordinates frame.
         frm_customcoords = tk.Frame(
@@ -164,14 +261,52 @@ class MainApp(tk.Tk):
         btn_uploadjson = tk.Button(master=frm_customcoords, text="Upload .json", state="disabled", command=self.uploadJsonEvent)
         btn_gocustom = tk.Button(master=frm_customcoords, text="Start Loop", state="disabled", command=self.startCustomLoopEvent)
         lbl_jsonfilename = tk.Label(master=frm_customcoords, text="", fg="blue", padx=1, pady=1)
+        self.widgets["optimize_route_int"] = tk.IntVar() # 1 to reorder the points into a short route before looping.
+        chkbox_optimizeroute = tk.Checkbutton(master=frm_customcoords, text='optimize route', variable=self.widgets["optimize_route_int"])
+        frm_drifttrack = tk.Frame(master=frm_customcoords, relief=tk.RAISED, borderwidth=0)
+        self.widgets["drift_track_int"] = tk.IntVar() # 1 to re-center the points on a tracked emitter as they drift.
+        chkbox_drifttrack = tk.Checkbutton(master=frm_drifttrack, text='track drift every', variable=self.widgets["drift_track_int"])
+        ent_drifttrack = tk.Entry(master=frm_drifttrack, width=3)
+        ent_drifttrack.insert(0, "5")
+        lbl_drifttrack = tk.Label(master=frm_drifttrack, text="loops", padx=1, pady=1)
+        self.widgets["drift_track_every"] = ent_drifttrack
+        chkbox_drifttrack.pack(padx=1, pady=1, side=tk.LEFT)
+        ent_drifttrack.pack(padx=1, pady=1, side=tk.LEFT)
+        lbl_drifttrack.pack(padx=1, pady=1, side=tk.LEFT)
         self.widgets["custom_json_button"] = btn_uploadjson
         self.widgets["custom_loop_button"] = btn_gocustom
         self.widgets["custom_coords_path"] = lbl_jsonfilename
         lbl_customcoords.pack(padx=1, pady=1)
         btn_uploadjson.pack(padx=1, pady=1)
+        chkbox_optimizeroute.pack(padx=1, pady=1)
+        frm_drifttrack.pack(padx=1, pady=1)
         btn_gocustom.pack(padx=1, pady=1)
         lbl_jsonfilename.pack(padx=1, pady=1)
 
+        # Job queue frame.
+        frm_jobs = tk.Frame(
+            master=self,
+            relief=tk.RAISED,
+            borderwidth=1
+        )
+        widget_frames.append(frm_jobs)
+        lbl_jobs = tk.Label(master=frm_jobs, text="job queue:", padx=1, pady=1)
+        frm_jobbuttons = tk.Frame(master=frm_jobs, relief=tk.RAISED, borderwidth=0)
+        btn_addjob = tk.Button(master=frm_jobbuttons, text="Add Scan", command=self.addScanJobEvent)
+        btn_loadjobs = tk.Button(master=frm_jobbuttons, text="Load Jobs", command=self.loadJobsEvent)
+        btn_runjobs = tk.Button(master=frm_jobbuttons, text="Run Queue", command=self.runJobQueueEvent)
+        lbl_jobstatus = tk.Label(master=frm_jobs, text="", wraplength=250, padx=1, pady=1)
+        self.widgets["add_job_button"] = btn_addjob
+        self.widgets["load_jobs_button"] = btn_loadjobs
+        self.widgets["run_jobs_button"] = btn_runjobs
+        self.widgets["job_status"] = lbl_jobstatus
+        btn_addjob.pack(padx=1, pady=1, side=tk.LEFT)
+        btn_loadjobs.pack(padx=1, pady=1, side=tk.LEFT)
+        btn_runjobs.pack(padx=1, pady=1, side=tk.LEFT)
+        lbl_jobs.pack(padx=1, pady=1)
+        frm_jobbuttons.pack(padx=1, pady=1)
+        lbl_jobstatus.pack(padx=1, pady=1)
+
         # Add to grid (show).
         self.columnconfigure(0, minsize=300)
         self.rowconfigure([i for i in range(len(widget_frames))], minsize=5)
@@ -189,7 +324,10 @@ class MainApp(tk.Tk):
         ## Disables all widgets in the control menu to user input.
         ##
         self.widgets["start_button"].config(state='disabled')
+        self.widgets["resume_button"].config(state='disabled')
         self.widgets["fast_scan_checkbox"].config(state='disabled')
+        self.widgets["line_shift_checkbox"].config(state='disabled')
+        self.widgets["scan_mode_combobox"].config(state='disabled')
         self.widgets["interrupt_button"].config(state='disabled')
         self.widgets["custom_json_button"].config(state='disabled')
         self.widgets["custom_loop_button"].config(state='disabled')
@@ -200,13 +338,20 @@ class MainApp(tk.Tk):
         self.widgets["y_end"].config(state='readonly')
         self.widgets["y_step"].config(state='readonly')
         self.widgets["int_time"].config(state='readonly')
+        self.widgets["adaptive_coarse_step"].config(state='readonly')
+        self.widgets["adaptive_refine_factor"].config(state='readonly')
+        self.widgets["timelapse_frames"].config(state='readonly')
+        self.widgets["run_jobs_button"].config(state='disabled')
     
     def enableWidgetInputs(self):
         ##
         ## Enables all widgets in the control menu to user input.
         ##
         self.widgets["start_button"].config(state='normal')
+        self.widgets["resume_button"].config(state='normal')
         self.widgets["fast_scan_checkbox"].config(state='normal')
+        self.widgets["line_shift_checkbox"].config(state='normal')
+        self.widgets["scan_mode_combobox"].config(state='readonly')
         self.widgets["interrupt_button"].config(state='normal')
         self.widgets["custom_json_button"].config(state='normal')
         self.widgets["custom_loop_button"].config(state='normal')
@@ -217,6 +362,10 @@ class MainApp(tk.Tk):
         self.widgets["y_end"].config(state='normal')
         self.widgets["y_step"].config(state='normal')
         self.widgets["int_time"].config(state='normal')
+        self.widgets["adaptive_coarse_step"].config(state='normal')
+        self.widgets["adaptive_refine_factor"].config(state='normal')
+        self.widgets["timelapse_frames"].config(state='normal')
+        self.widgets["run_jobs_button"].config(state='normal')
 
     def selectSaveFolder(self):
         ##
@@ -224,38 +373,152 @@ class MainApp(tk.Tk):
         ##
         self.widgets["folder"].config(text=str(askdirectory()))
 
+    def submitExport(self, description, function, *args):
+        ##
+        ## QUEUES A SAVE ON THE EXPORT WORKER; pollExportsEvent REPORTS WHEN IT'S DONE.
+        ##
+        self.export_worker.submit(description, function, *args)
+        self.widgets["save_status"].config(text=f"saving {description}...", fg="black")
+
+    def pollExportsEvent(self):
+        ##
+        ## [Event Handler] REPORTS FINISHED (OR FAILED) SAVES, THEN CHECKS AGAIN LATER.
+        ##
+        results = self.export_worker.getResults()
+        for status, description, error in results:
+            if status == "done":
+                print(f"{description} saved!")
+                self.widgets["save_status"].config(text=f"{description} saved.", fg="black")
+            else:
+                print(f"Saving {description} failed: {error}")
+                self.widgets["save_status"].config(text=f"saving {description} failed: {error}", fg="red")
+        if results and self.export_worker.isBusy():
+            print(f"{self.export_worker.jobs.unfinished_tasks} save(s) still in progress.")
+        self.after(self.export_poll_interval, self.pollExportsEvent)
+
     def startScanEvent(self):
         ##
         ## [Event Handler] STARTS SCAN.
         ##
+        if not self.hardware_lock.acquire("scan window"):
+            print(f"The hardware is busy ({self.hardware_lock.getOwner()}).")
+            return
+        try:
+            self.disableWidgetInputs()
+            self.widgets["interrupt_button"].config(state="normal")
+            self.widgets["custom_coords_path"].config(text="")
+
+            # Make sure the voltage bounds are safe.
+            ws = self.widgets
+            for entry in [ws["x_start"], ws["x_end"], ws["x_step"],
+                           ws["y_start"], ws["y_end"], ws["y_step"]]:
+                self.voltageBoundsEvent(entry)
+
+            print("start")
+            x, y = self.winfo_screenwidth()//4, self.winfo_screenheight()//4
+            if self.scanwindow is not None:
+                x, y = self.scanwindow.winfo_x(), self.scanwindow.winfo_y()
+                self.scanwindow.destroy()
+
+            self.scanwindow = ScanWindow(self, self.DAQ, x, y)
+            self.scanwindow.takeScan()
+        except Exception:
+            self.hardware_lock.release("scan window") # Don't keep the hardware for something that never started.
+            raise
+
+    def resumeScanEvent(self):
+        ##
+        ## [Event Handler] CARRIES ON WITH THE LAST SCAN THAT WAS CUT SHORT (INTERRUPTED, OR ITS WINDOW CLOSED) AT
+        ## ITS NEXT UNMEASURED COLUMN. AFTER A CRASH, ASKS FOR THE SCAN'S autosave_<scan ID>.h5 FILE INSTEAD.
+        ##
+        if self.hardware_lock.getOwner() is not None:
+            print(f"The hardware is busy ({self.hardware_lock.getOwner()}).")
+            return
+        if self.scanwindow is not None and self.scanwindow.isResumable():
+            path = self.scanwindow.autosave_path
+        elif self.scanwindow is None and os.path.exists(self.last_autosave):
+            path = self.last_autosave
+        else:
+            path = askopenfilename(title="Autosave of the scan to resume", filetypes=[("HDF5 files", "*.h5")])
+            if not path:
+                return
+        try:
+            spec = ScanSpec.fromCheckpoint(path)
+            with ScanFile(path) as scan_file:
+                columns_done = scan_file.getColumnsDone()
+            ScanCore(self.DAQ, spec, resume=True) # Checks the scan can be resumed (mode, voltages).
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Can't resume {path}: {e}")
+            return
+        if columns_done.all():
+            print(f"{path} is already complete.")
+            return
+        if not self.hardware_lock.acquire("scan window"): # e.g. a client started a scan while the file dialog was open.
+            print(f"The hardware is busy ({self.hardware_lock.getOwner()}).")
+            return
+
+        if self.scanwindow is None or self.scanwindow.autosave_path != path:
+            # Open a scan window for it, as if it had just been started from the control menu.
+            self.setScanInputs(spec)
+            self.widgets["folder"].config(text=os.path.dirname(os.path.abspath(path)))
+            x, y = self.winfo_screenwidth()//4, self.winfo_screenheight()//4
+            if self.scanwindow is not None:
+                x, y = self.scanwindow.winfo_x(), self.scanwindow.winfo_y()
+                self.scanwindow.destroy()
+            self.scanwindow = ScanWindow(self, self.DAQ, x, y)
+            self.scanwindow.autosave_path = path
+        self.last_autosave = ""
         self.disableWidgetInputs()
         self.widgets["interrupt_button"].config(state="normal")
         self.widgets["custom_coords_path"].config(text="")
+        print("resume")
+        try:
+            self.scanwindow.takeScan(resume=True)
+        except Exception:
+            self.hardware_lock.release("scan window") # Don't keep the hardware for something that never started.
+            raise
 
-        # Make sure the voltage bounds are safe.
+    def setScanInputs(self, spec):
+        ##
+        ## FILLS THE CONTROL MENU IN WITH THE SETTINGS OF spec (A ScanSpec).
+        ##
         ws = self.widgets
-        for entry in [ws["x_start"], ws["x_end"], ws["x_step"],
-                       ws["y_start"], ws["y_end"], ws["y_step"]]:
-            self.voltageBoundsEvent(entry)
-
-        print("start")
-        x, y = self.winfo_screenwidth()//4, self.winfo_screenheight()//4
-        if self.scanwindow is not None:
-            x, y = self.scanwindow.winfo_x(), self.scanwindow.winfo_y()
-            self.scanwindow.destroy()
+        for name in ["x_start", "x_end", "x_step", "y_start", "y_end", "y_step", "integration_time"]:
+            widget = ws["int_time" if name == "integration_time" else name]
+            widget.delete(0, tk.END)
+            widget.insert(0, repr(getattr(spec, name)))
+        ws["scan_mode"].set(spec.scan_mode)
+        ws["timelapse_frames"].delete(0, tk.END)
+        ws["timelapse_frames"].insert(0, str(spec.n_frames))
 
-        self.scanwindow = ScanWindow(self, self.DAQ, x, y)
-        self.scanwindow.takeScan()
-    
     def interruptScanEvent(self):
         ##
-        ## [Event Handler] INTERRUPTS SCAN.
+        ## [Event Handler] INTERRUPTS WHATEVER HAS THE HARDWARE (THE SCAN WINDOW'S SCAN, THE CUSTOM LOOP, THE JOB
+        ## QUEUE OR A REMOTE CLIENT'S SCAN), AND ONLY THAT: EACH OF THEM HAS ITS OWN INTERRUPT EVENT.
+        ##
+        owner = self.hardware_lock.getOwner()
+        if owner == "scan window" and self.scanwindow is not None and self.scanwindow.scan_core is not None:
+            self.scanwindow.scan_core.interrupt()
+        elif owner == "custom loop" and self.miniplot is not None:
+            self.miniplot.custom_loop.interrupt_event.set()
+        elif owner == "job queue" and self.job_runner is not None:
+            self.job_runner.interrupt_event.set()
+        elif self.server is not None and owner == self.server.owner:
+            self.server.interrupt()
+            print("interrupt")
+            return # pollHardwareEvent puts the controls back once the client is done with the hardware.
+        self.resetScanInputs()
+        print("interrupt")
+
+    def resetScanInputs(self):
+        ##
+        ## PUTS THE CONTROL MENU BACK ONCE A SCAN OR LOOP HAS STOPPED (INTERRUPTED OR DONE).
         ##
         self.enableWidgetInputs()
         self.widgets["interrupt_button"].config(state="disabled")
         self.widgets["custom_loop_button"].config(state="disabled")
-        self.scanwindow.currently_scanning = False
-        print("interrupt")
+        if self.scanwindow is not None:
+            self.scanwindow.currently_scanning = False
 
     def voltageBoundsEvent(self, widget):
         ##
@@ -290,24 +553,169 @@ class MainApp(tk.Tk):
             s.placeCrosshair(s.cursor_coordinates[0], s.cursor_coordinates[1])
 
     def startCustomLoopEvent(self):
-        self.widgets["start_button"].config(state="disabled")
-        self.widgets["interrupt_button"].config(state="normal")
-        self.widgets["custom_loop_button"].config(state="disabled")
+        if not self.hardware_lock.acquire("custom loop"):
+            print(f"The hardware is busy ({self.hardware_lock.getOwner()}).")
+            return
+        try:
+            self.widgets["start_button"].config(state="disabled")
+            self.widgets["interrupt_button"].config(state="normal")
+            self.widgets["custom_loop_button"].config(state="disabled")
 
-        coordsfile = json.load(open(self.widgets["custom_coords_path"].cget("text")))
+            coordsfile = json.load(open(self.widgets["custom_coords_path"].cget("text")))
 
-        if self.miniplot == None:
-            self.miniplot = PopoutPlot(self, self.scanwindow, coordsfile["x_coord"], coordsfile["y_coord"])
-            # Replot pattern on the main plot just in case user exited from miniplot but wanted to run again.
-            s = self.scanwindow
-            s.removeCrosshair()
-            s.clearAnnotations()
-            s.plotCustomCoords(coordsfile["x_coord"], coordsfile["y_coord"])
-            if s.crosshair:
-                s.placeCrosshair(s.cursor_coordinates[0], s.cursor_coordinates[1])
-        self.miniplot.takeScan()
+            if self.miniplot == None:
+                order = None
+                if self.widgets["optimize_route_int"].get() == 1:
+                    order = self.optimizeRoute(coordsfile["x_coord"], coordsfile["y_coord"])
+                self.miniplot = PopoutPlot(self, self.scanwindow, coordsfile["x_coord"], coordsfile["y_coord"], order=order)
+                # Replot pattern on the main plot just in case user exited from miniplot but wanted to run again.
+                s = self.scanwindow
+                s.removeCrosshair()
+                s.clearAnnotations()
+                s.plotCustomCoords(coordsfile["x_coord"], coordsfile["y_coord"])
+                if s.crosshair:
+                    s.placeCrosshair(s.cursor_coordinates[0], s.cursor_coordinates[1])
+            self.miniplot.takeScan()
+        except Exception:
+            self.hardware_lock.release("custom loop") # Don't keep the hardware for something that never started.
+            raise
+
+    def optimizeRoute(self, x_coords, y_coords):
+        ##
+        ## RETURNS A SHORT ORDER TO VISIT THE CUSTOM POINTS IN, STARTING NEAR (0, 0) WHERE THE SCAN LEAVES THE MIRROR.
+        ##
+        optimizer = RouteOptimizer(x_coords, y_coords)
+        order = optimizer.getOrder(start=(0, 0))
+        print(f"Route length: {optimizer.getPathLength():.3f} V in file order, {optimizer.getPathLength(order):.3f} V optimized.")
+        return order
+
+    def finishCustomLoopEvent(self):
+        ##
+        ## CALLED BY THE PopoutPlot ONCE ITS LOOP IS OVER: SAVES THE LOOP & RESETS THE BUTTONS.
+        ##
         self.miniplot.saveScan()
 
         self.widgets["interrupt_button"].config(state="disabled")
         self.widgets["start_button"].config(state="normal")
         self.widgets["custom_loop_button"].config(state="normal")
+
+    def getScanJob(self):
+        ##
+        ## A JOB FOR THE SCAN AS SET UP IN THE CONTROL MENU, SAVED IN THE CURRENT FOLDER.
+        ##
+        ws = self.widgets
+        spec = ScanSpec(float(ws["x_start"].get()), float(ws["x_end"].get()), float(ws["x_step"].get()),
+                        float(ws["y_start"].get()), float(ws["y_end"].get()), float(ws["y_step"].get()),
+                        float(ws["int_time"].get()),
+                        scan_mode=ws["scan_mode"].get(),
+                        n_frames=int(ws["timelapse_frames"].get()),
+                        coarse_step=int(ws["adaptive_coarse_step"].get()),
+                        refine_factor=float(ws["adaptive_refine_factor"].get()))
+        return {"name": "scan", "folder": ws["folder"].cget("text"), "scan": spec.toDict()}
+
+    def addScanJobEvent(self):
+        ##
+        ## [Event Handler] ADDS THE SCAN AS SET UP IN THE CONTROL MENU TO THE JOB QUEUE.
+        ##
+        ws = self.widgets
+        for entry in [ws["x_start"], ws["x_end"], ws["x_step"],
+                       ws["y_start"], ws["y_end"], ws["y_step"]]:
+            self.voltageBoundsEvent(entry)
+        try:
+            job_id = self.job_queue.add(self.getScanJob())
+        except ValueError as e:
+            print(f"Could not add the scan to the queue: {e}")
+            return
+        print(f"Added job {job_id} to the queue.")
+        self.showJobQueueStatus()
+
+    def loadJobsEvent(self):
+        ##
+        ## [Event Handler] ADDS THE JOBS IN A .json JOB FILE TO THE JOB QUEUE.
+        ##
+        fn = askopenfilename(filetypes=[("JSON files", "*.json")])
+        if not fn:
+            return
+        try:
+            job_ids = self.job_queue.addFile(fn)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Could not load jobs from {fn}: {e}")
+            return
+        print(f"Added {len(job_ids)} job(s) to the queue.")
+        self.showJobQueueStatus()
+
+    def runJobQueueEvent(self):
+        ##
+        ## [Event Handler] RUNS THE PENDING JOBS BACK TO BACK. 'Interrupt' STOPS THE QUEUE; THE JOB THAT WAS
+        ## RUNNING IS RUN AGAIN NEXT TIME.
+        ##
+        if self.job_queue.getCounts()["pending"] == 0:
+            print("No pending jobs.")
+            return
+        if not self.hardware_lock.acquire("job queue"):
+            print(f"Can't run the queue while the hardware is busy ({self.hardware_lock.getOwner()}).")
+            return
+        self.disableWidgetInputs()
+        self.widgets["interrupt_button"].config(state="normal")
+        self.job_runner = JobRunner(self.DAQ, self.job_queue).start()
+        self.after(self.job_poll_interval, self.pollJobsEvent)
+
+    def pollJobsEvent(self):
+        ##
+        ## [Event Handler] REPORTS JOBS STARTING & FINISHING, UNTIL THE QUEUE STOPS.
+        ##
+        for event in self.job_runner.getEvents():
+            if event[0] == "started":
+                print(f"Job {event[1]['id']} ({event[1]['name']}) started.")
+            elif event[0] == "done":
+                print(f"Job {event[1]['id']} ({event[1]['name']}) done: {event[1]['outputs']}")
+            elif event[0] == "failed":
+                print(f"Job {event[1]['id']} ({event[1]['name']}) failed: {event[2]}")
+            elif event[0] == "idle":
+                self.job_runner = None
+                self.hardware_lock.release("job queue")
+                self.enableIdleInputs()
+                self.showJobQueueStatus()
+                print("Job queue stopped.")
+                return
+        self.showJobQueueStatus()
+        self.after(self.job_poll_interval, self.pollJobsEvent)
+
+    def showJobQueueStatus(self):
+        counts = self.job_queue.getCounts()
+        self.widgets["job_status"].config(text=", ".join(f"{n} {status}" for status, n in counts.items() if n > 0) or "empty")
+
+    def startServer(self, host, port):
+        ##
+        ## LETS OTHER PROGRAMS (ON THIS OR OTHER MACHINES) WATCH THE SCANS & CONTROL THE HARDWARE (ScanServer.py).
+        ##
+        self.server = ScanServer(self.DAQ, host, port, self.hardware_lock).start()
+        print(f"Listening for clients on {host}:{self.server.port}.")
+
+    def pollHardwareEvent(self):
+        ##
+        ## [Event Handler] DISABLES THE CONTROLS THAT USE THE HARDWARE WHILE A REMOTE CLIENT HAS IT (A SCAN, A MOVE
+        ## OR A READING), AND PUTS THEM BACK AFTERWARDS. THE GUI'S OWN SCANS HANDLE THEIR CONTROLS THEMSELVES.
+        ##
+        owner = self.hardware_lock.getOwner()
+        if self.server is not None and owner == self.server.owner and not self.client_has_hardware:
+            self.client_has_hardware = True
+            self.disableWidgetInputs()
+            self.widgets["interrupt_button"].config(state="normal") # Stops the client's scan.
+            if self.scanwindow is not None:
+                self.scanwindow.setHardwareWidgets(False)
+        elif self.client_has_hardware and owner is None:
+            self.client_has_hardware = False
+            self.enableIdleInputs()
+            if self.scanwindow is not None:
+                self.scanwindow.setHardwareWidgets(True)
+        self.after(self.hardware_poll_interval, self.pollHardwareEvent)
+
+    def enableIdleInputs(self):
+        ##
+        ## ENABLES THE CONTROL MENU AGAIN ONCE NOTHING IS USING THE HARDWARE.
+        ##
+        self.enableWidgetInputs()
+        self.widgets["interrupt_button"].config(state="disabled")
+        if self.scanwindow is None:
+            self.widgets["custom_loop_button"].config(state="disabled")
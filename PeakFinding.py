@@ -0,0 +1,212 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+
+class StreamingPeakFinder:
+    shape = (0, 0) # (# x pixels, # y pixels) of the scan.
+    min_sep = 3 # Same as peak_local_max's min_distance (pixels).
+    band = 32 # Columns that have to be ready before a band is processed (fewer only when finishing).
+    processed = None # Bool per x index: True once the column's local maxima have been found.
+    candidates = None # (n, 3) array of (x index, y index, value) of every local maximum found so far.
+
+    def __init__(self, shape, min_sep=3):
+        ##
+        ## FINDS PEAKS WHILE A SCAN IS RUNNING, GIVING THE SAME PEAKS AS peak_local_max(scan_data, min_sep,
+        ## threshold) ON THE FINISHED SCAN. THE LOCAL MAXIMA OF A COLUMN ARE FINAL ONCE ALL THE COLUMNS WITHIN
+        ## min_sep OF IT ARE DONE, SO BANDS OF COLUMNS ARE SEARCHED AS THEY COMPLETE (WITH min_sep COLUMNS OF
+        ## OVERLAP) AND ONLY THE CHEAP PART - THRESHOLD & KEEPING PEAKS min_sep APART - IS REDONE IN getPeaks().
+        ##
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.min_sep = max(1, int(min_sep))
+        self.processed = np.zeros(self.shape[0], dtype=bool)
+        self.candidates = np.zeros((0, 3))
+
+    def update(self, scan_data, columns_done, finish=False):
+        ##
+        ## SEARCHES THE COLUMNS THAT HAVE BECOME READY. IF finish IS TRUE (SCAN OVER, MAYBE INTERRUPTED), EVERY
+        ## DONE COLUMN IS SEARCHED, AS IF THE COLUMNS THAT WERE NEVER DONE HELD THEIR CURRENT VALUES FOR GOOD.
+        ## RETURNS TRUE IF ANY COLUMNS WERE SEARCHED.
+        ##
+        done = np.asarray(columns_done, dtype=bool)
+        if finish:
+            ready = done & ~self.processed
+        else:
+            window = np.ones(2*self.min_sep + 1, dtype=int)
+            n_done = np.convolve(done.astype(int), window, mode="same")
+            n_columns = np.convolve(np.ones(len(done), dtype=int), window, mode="same") # Fewer at the edges.
+            ready = (n_done == n_columns) & ~self.processed
+            if ready.sum() < min(self.band, len(done)):
+                return False
+        columns = np.flatnonzero(ready)
+        if len(columns) == 0:
+            return False
+        # Search each run of consecutive ready columns in one go.
+        for run in np.split(columns, np.flatnonzero(np.diff(columns) > 1) + 1):
+            self.searchColumns(scan_data, run[0], run[-1] + 1)
+        self.processed[columns] = True
+        return True
+
+    def searchColumns(self, scan_data, first, last):
+        ##
+        ## ADDS THE LOCAL MAXIMA OF COLUMNS first..last-1 (LIKE peak_local_max: EQUAL TO THE MAXIMUM OF THE
+        ## (2 min_sep + 1)^2 PIXELS AROUND THEM, AND NOT WITHIN min_sep OF THE EDGE OF THE SCAN).
+        ##
+        block, x0 = self.getBlock(scan_data, first, last)
+        self.addCandidates(self.getLocalMaxima(block, first - x0, last - x0, self.min_sep), x0)
+
+    def getBlock(self, scan_data, first, last):
+        ##
+        ## COLUMNS first..last-1 WITH min_sep COLUMNS OF CONTEXT ON EACH SIDE (WHERE THERE ARE ANY), AND WHERE THEY START.
+        ##
+        x0, x1 = max(first - self.min_sep, 0), min(last + self.min_sep, self.shape[0])
+        return np.asarray(scan_data[x0:x1], dtype=float), x0
+
+    def addCandidates(self, maxima, x0):
+        maxima[:, 0] += x0
+        inside = (maxima[:, 0] >= self.min_sep) & (maxima[:, 0] < self.shape[0] - self.min_sep)
+        self.candidates = np.concatenate([self.candidates, maxima[inside]])
+
+    @staticmethod
+    def getLocalMaxima(block, first, last, min_sep):
+        ##
+        ## (x, y, value) OF THE LOCAL MAXIMA IN ROWS first..last-1 OF block, EXCEPT WITHIN min_sep OF ITS y EDGES.
+        ## A STATIC METHOD, SO THAT IT CAN RUN IN A WORKER PROCESS.
+        ##
+        is_max = block == ndimage.maximum_filter(block, size=2*min_sep + 1, mode="nearest")
+        is_max = is_max[first:last]
+        is_max[:, :min_sep] = False
+        is_max[:, block.shape[1] - min_sep:] = False
+        x, y = np.nonzero(is_max)
+        return np.column_stack([x + first, y, block[x + first, y]])
+
+    def searchAll(self, scan_data, n_workers=1, band=256):
+        ##
+        ## SEARCHES EVERY COLUMN NOT SEARCHED YET, IN OVERLAPPING BANDS OF band COLUMNS. WITH n_workers > 1 THE
+        ## BANDS ARE SPREAD OVER A POOL OF PROCESSES, A FEW AT A TIME SO THAT A HUGE (TileStore) SCAN IS NEVER
+        ## ALL IN RAM.
+        ##
+        columns = np.flatnonzero(~self.processed)
+        runs = [(run[i], run[min(i + band, len(run)) - 1] + 1)
+                for run in np.split(columns, np.flatnonzero(np.diff(columns) > 1) + 1) if len(run) > 0
+                for i in range(0, len(run), band)]
+        if n_workers <= 1:
+            for first, last in runs:
+                self.searchColumns(scan_data, first, last)
+        else:
+            with ProcessPoolExecutor(n_workers) as pool:
+                for i in range(0, len(runs), 2*n_workers):
+                    jobs = []
+                    for first, last in runs[i:i + 2*n_workers]:
+                        block, x0 = self.getBlock(scan_data, first, last)
+                        jobs.append((pool.submit(self.getLocalMaxima, block, first - x0, last - x0, self.min_sep), x0))
+                    for job, x0 in jobs:
+                        self.addCandidates(job.result(), x0)
+        self.processed[:] = True
+
+    def getPeaks(self, threshold):
+        ##
+        ## RETURNS THE PEAKS FOUND SO FAR AS AN (n, 2) ARRAY OF (x, y) INDICES, BRIGHTEST FIRST: THE LOCAL MAXIMA
+        ## ABOVE threshold, DROPPING ANY CLOSER THAN min_sep TO A BRIGHTER ONE THAT WAS KEPT.
+        ##
+        candidates = self.candidates[self.candidates[:, 2] > threshold]
+        candidates = candidates[np.lexsort((candidates[:, 1], candidates[:, 0], -candidates[:, 2]))]
+        coords = candidates[:, :2].astype(int)
+        if len(coords) < 2:
+            return coords
+        # Chebyshev distance < min_sep, which for whole pixels means <= min_sep - 0.5.
+        neighbours = cKDTree(coords).query_ball_point(coords, r=self.min_sep - 0.5, p=np.inf)
+        keep = np.ones(len(coords), dtype=bool)
+        for i in range(len(coords)):
+            if keep[i]:
+                for j in neighbours[i]:
+                    if j != i:
+                        keep[j] = False
+        return coords[keep]
+
+
+class PeakFinder:
+    n_workers = 1 # Processes to search big scans with.
+    pool_min_pixels = 4000000 # Smaller scans are searched in this process (faster than starting a pool).
+    band_pixels = 1000000 # About how many pixels each band of columns (one task for the pool) holds.
+    cache_size = 8 # How many parameter sets (and searched scans) are remembered.
+    searches = None # LRU of (scan_key, min_sep) -> (StreamingPeakFinder holding every local maximum, mean, constant).
+    results = None # LRU of (scan_key, min_sep, threshold) -> peaks.
+
+    def __init__(self, n_workers=None, cache_size=8):
+        ##
+        ## peak_local_max(scan_data, min_sep, threshold * mean) WITH CACHING. A SCAN IS SEARCHED FOR LOCAL MAXIMA
+        ## ONCE PER min_sep (IN TILES, ON A POOL OF PROCESSES IF IT'S BIG); A NEW THRESHOLD ONLY REDOES THE QUICK
+        ## FILTERING, AND A PARAMETER SET THAT WAS ALREADY USED IS INSTANT. scan_key MUST CHANGE WHENEVER THE
+        ## DATA DOES (e.g. (SCAN ID, DATA VERSION)).
+        ##
+        self.n_workers = (os.cpu_count() or 1) if n_workers is None else n_workers
+        self.cache_size = cache_size
+        self.searches = OrderedDict()
+        self.results = OrderedDict()
+
+    def getPeaks(self, scan_key, scan_data, min_sep, threshold):
+        ##
+        ## RETURNS THE PEAKS AS AN (n, 2) ARRAY OF (x, y) INDICES, BRIGHTEST FIRST, LIKE peak_local_max.
+        ##
+        key = (scan_key, min_sep, threshold)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+        finder, mean, constant = self.getSearch(scan_key, scan_data, min_sep)
+        # Like peak_local_max, a flat image has no peaks.
+        peaks = np.zeros((0, 2), dtype=int) if constant else finder.getPeaks(threshold * mean)
+        self.remember(self.results, key, peaks)
+        return peaks
+
+    def getSearch(self, scan_key, scan_data, min_sep):
+        key = (scan_key, max(1, int(min_sep)))
+        if key in self.searches:
+            self.searches.move_to_end(key)
+            return self.searches[key]
+        shape = (int(scan_data.shape[0]), int(scan_data.shape[1]))
+        finder = StreamingPeakFinder(shape, min_sep)
+        n_workers = self.n_workers if shape[0] * shape[1] >= self.pool_min_pixels else 1
+        finder.searchAll(scan_data, n_workers, band=max(1, self.band_pixels // shape[1]))
+        return self.addSearch(scan_key, finder, *self.getMean(scan_data))
+
+    def addSearch(self, scan_key, finder, mean, constant=False):
+        ##
+        ## REMEMBERS A FINISHED SEARCH (e.g. THE ONE DONE LIVE DURING A SCAN) SO THAT IT ISN'T REDONE.
+        ##
+        search = (finder, mean, constant)
+        self.remember(self.searches, (scan_key, finder.min_sep), search)
+        return search
+
+    def getMean(self, scan_data, band=256):
+        ##
+        ## MEAN OF THE SCAN, AND WHETHER IT'S FLAT, READ band COLUMNS AT A TIME.
+        ##
+        total, low, high = 0.0, np.inf, -np.inf
+        for x0 in range(0, scan_data.shape[0], band):
+            block = np.asarray(scan_data[x0:x0+band], dtype=float)
+            total += block.sum()
+            low, high = min(low, block.min()), max(high, block.max())
+        return total / (scan_data.shape[0] * scan_data.shape[1]), bool(low == high)
+
+    def remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
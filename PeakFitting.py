@@ -0,0 +1,191 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+class PeakFitter:
+    method = "gaussian" # "gaussian" (least squares fit) or "quadratic" (fast 3-point estimate).
+    radius = 2 # Fits use the (2*radius+1) x (2*radius+1) pixels around each peak.
+    n_iterations = 30 # Levenberg-Marquardt iterations for Gaussian fits.
+    n_workers = 1 # Processes to split big batches of Gaussian fits over.
+    pool_min_peaks = 1000 # Fewer peaks than this are fitted in this process (one batch is faster than starting a pool).
+
+    def __init__(self, method="gaussian", radius=2, n_workers=None):
+        ##
+        ## REFINES INTEGER PEAK POSITIONS (e.g. FROM peak_local_max) TO SUB-PIXEL ONES, FITTING ALL THE PEAKS
+        ## AT ONCE AS ONE BATCH OF ARRAYS. "gaussian" FITS EACH PEAK TO AN (AXIS-ALIGNED) 2D GAUSSIAN ON A
+        ## BACKGROUND; "quadratic" FITS A PARABOLA TO THE LOG OF THE 3 PIXELS AROUND THE MAXIMUM IN x AND y,
+        ## WHICH IS EXACT FOR A GAUSSIAN WITHOUT NOISE AND NEEDS NO ITERATIONS.
+        ##
+        if method not in ["gaussian", "quadratic"]:
+            raise ValueError(f"Unknown peak fitting method: {method}")
+        self.method = method
+        self.radius = max(1, int(radius))
+        self.n_workers = (os.cpu_count() or 1) if n_workers is None else n_workers
+
+    def fit(self, data, peak_x, peak_y):
+        ##
+        ## FITS THE PEAKS AT INTEGER INDICES (peak_x, peak_y) OF data [x][y]. RETURNS A DICTIONARY OF ARRAYS,
+        ## ONE ENTRY PER PEAK: "x", "y" (SUB-PIXEL INDICES), "sigma_x", "sigma_y" (PIXELS), "amplitude" &
+        ## "offset" (DATA UNITS, ABOVE & OF THE BACKGROUND), AND "converged" (False IF THE GAUSSIAN FIT FAILED
+        ## AND THE QUADRATIC ESTIMATE WAS KEPT INSTEAD).
+        ##
+        peak_x = np.asarray(peak_x, dtype=int)
+        peak_y = np.asarray(peak_y, dtype=int)
+        patches = self.getPatches(np.asarray(data, dtype=float), peak_x, peak_y)
+        if self.method == "quadratic" or len(patches) == 0:
+            params = self.fitQuadratic(patches)
+            converged = np.ones(len(patches), dtype=bool)
+        elif self.n_workers > 1 and len(patches) >= self.pool_min_peaks:
+            chunks = np.array_split(patches, self.n_workers)
+            with ProcessPoolExecutor(self.n_workers) as pool:
+                results = list(pool.map(self.fitGaussian, chunks))
+            params = np.concatenate([r[0] for r in results])
+            converged = np.concatenate([r[1] for r in results])
+        else:
+            params, converged = self.fitGaussian(patches)
+        amplitude, dx, dy, sigma_x, sigma_y, offset = params.T
+        return {
+            "x": peak_x + dx,
+            "y": peak_y + dy,
+            "sigma_x": sigma_x,
+            "sigma_y": sigma_y,
+            "amplitude": amplitude,
+            "offset": offset,
+            "converged": converged
+        }
+
+    def getPatches(self, data, peak_x, peak_y):
+        ##
+        ## CUTS OUT THE (2r+1) x (2r+1) PIXELS AROUND EVERY PEAK AS ONE (n, 2r+1, 2r+1) ARRAY.
+        ## PEAKS NEAR THE EDGE GET THE EDGE PIXELS REPEATED.
+        ##
+        r = self.radius
+        padded = np.pad(data, r, mode="edge")
+        offsets = np.arange(2*r + 1)
+        x = (peak_x[:, np.newaxis] + offsets)[:, :, np.newaxis]
+        y = (peak_y[:, np.newaxis] + offsets)[:, np.newaxis, :]
+        return padded[x, y]
+
+    def fitQuadratic(self, patches):
+        ##
+        ## 3-POINT GAUSSIAN ESTIMATE (A PARABOLA THROUGH THE LOG OF THE BACKGROUND-SUBTRACTED COUNTS) IN x AND y.
+        ## RETURNS (n, 6) PARAMETERS: amplitude, dx, dy (FROM THE PATCH CENTER), sigma_x, sigma_y, offset.
+        ##
+        r = self.radius
+        offset = patches.min(axis=(1, 2))
+        log = np.log(np.maximum(patches - offset[:, np.newaxis, np.newaxis], 1e-9))
+        center = log[:, r, r]
+        params = [None, None, None, None, None, offset]
+        for axis, side in [(1, log[:, r-1:r+2, r]), (2, log[:, r, r-1:r+2])]:
+            curvature = side[:, 0] - 2*center + side[:, 2]
+            peaked = curvature < 0 # Otherwise the patch isn't peaked at the center along this axis.
+            safe = np.where(peaked, curvature, -1)
+            shift = np.where(peaked, np.clip((side[:, 0] - side[:, 2]) / (2*safe), -1, 1), 0)
+            sigma = np.where(peaked, np.clip(np.sqrt(-1 / safe), 0.3, 2*r), r)
+            params[axis] = shift
+            params[axis + 2] = sigma
+        params[0] = np.exp(center) * np.exp(params[1]**2 / (2*params[3]**2) + params[2]**2 / (2*params[4]**2))
+        return np.column_stack(params)
+
+    def getModel(self, params, u, v):
+        ##
+        ## THE GAUSSIANS (n, 2r+1, 2r+1) AND THEIR DERIVATIVES WITH RESPECT TO THE 6 PARAMETERS (n, 2r+1, 2r+1, 6).
+        ##
+        amplitude, x0, y0, sigma_x, sigma_y, offset = (p[:, np.newaxis, np.newaxis] for p in params.T)
+        dx, dy = u - x0, v - y0
+        g = np.exp(-dx**2 / (2*sigma_x**2) - dy**2 / (2*sigma_y**2))
+        ag = amplitude * g
+        jacobian = np.stack([g,
+                             ag * dx / sigma_x**2,
+                             ag * dy / sigma_y**2,
+                             ag * dx**2 / sigma_x**3,
+                             ag * dy**2 / sigma_y**3,
+                             np.ones_like(g)], axis=-1)
+        return ag + offset, jacobian
+
+    def fitGaussian(self, patches):
+        ##
+        ## LEVENBERG-MARQUARDT FIT OF EVERY PATCH AT ONCE, STARTING FROM THE QUADRATIC ESTIMATE. EACH PEAK HAS
+        ## ITS OWN DAMPING, SO ONE BAD FIT DOESN'T SLOW THE OTHERS DOWN. FITS THAT END UP OUTSIDE THE PATCH
+        ## (OR WITH A SILLY WIDTH) FALL BACK TO THE QUADRATIC ESTIMATE. RETURNS (params, converged).
+        ##
+        r = self.radius
+        n = len(patches)
+        u = np.arange(-r, r + 1, dtype=float)[np.newaxis, :, np.newaxis]
+        v = np.arange(-r, r + 1, dtype=float)[np.newaxis, np.newaxis, :]
+        start = self.fitQuadratic(patches)
+        params = start.copy()
+        damping = np.full(n, 1e-3)
+        model, jacobian = self.getModel(params, u, v)
+        residual = (patches - model).reshape(n, -1)
+        cost = (residual**2).sum(axis=1)
+        for _ in range(self.n_iterations):
+            J = jacobian.reshape(n, -1, 6)
+            JTJ = np.einsum("nmi,nmj->nij", J, J)
+            JTr = np.einsum("nmi,nm->ni", J, residual)
+            diagonal = np.einsum("nii->ni", JTJ)
+            A = JTJ + (damping[:, np.newaxis] * (diagonal + 1e-12))[:, :, np.newaxis] * np.eye(6)
+            try:
+                step = np.linalg.solve(A, JTr[:, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = np.einsum("nij,nj->ni", np.linalg.pinv(A), JTr) # Some fit is degenerate (e.g. a flat patch).
+            trial = params + step
+            trial[:, 3:5] = np.maximum(np.abs(trial[:, 3:5]), 1e-6) # Widths stay positive.
+            trial_model, trial_jacobian = self.getModel(trial, u, v)
+            trial_residual = (patches - trial_model).reshape(n, -1)
+            trial_cost = (trial_residual**2).sum(axis=1)
+            better = trial_cost < cost
+            params[better] = trial[better]
+            jacobian[better] = trial_jacobian[better]
+            residual[better] = trial_residual[better]
+            cost[better] = trial_cost[better]
+            damping = np.where(better, damping / 3, damping * 3)
+        converged = ((np.abs(params[:, 1:3]) <= r).all(axis=1)
+                     & (params[:, 3:5] >= 0.2).all(axis=1)
+                     & (params[:, 3:5] <= 4*r).all(axis=1)
+                     & (params[:, 0] > 0)
+                     & np.isfinite(params).all(axis=1))
+        params[~converged] = start[~converged]
+        return params, converged
+
+
+def getPeakData(data, peak_x, peak_y, x_axis, y_axis, x_step, y_step, method="none"):
+    ##
+    ## THE save_data["peak_finding"] ENTRIES FOR THE PEAKS AT INDICES (peak_x, peak_y) OF data [x][y]: THEIR
+    ## COORDINATES (V), AND WITH A FIT method ("gaussian" OR "quadratic") THE SUB-PIXEL FITTED COORDINATES (V),
+    ## WIDTHS (V), AMPLITUDES & BACKGROUNDS (COUNTS/S), WHICH FITS CONVERGED, AND THE GRID COORDINATES THE PEAKS
+    ## WERE FOUND AT.
+    ##
+    peak_x = np.asarray(peak_x, dtype=int)
+    peak_y = np.asarray(peak_y, dtype=int)
+    x_axis = np.asarray(x_axis)
+    y_axis = np.asarray(y_axis)
+    if method == "none" or len(peak_x) == 0:
+        return {"peaks_x_coords": x_axis[peak_x].tolist(), "peaks_y_coords": y_axis[peak_y].tolist()}
+    fit = PeakFitter(method).fit(data, peak_x, peak_y)
+    return {
+        "peaks_x_coords": np.interp(fit["x"], np.arange(len(x_axis)), x_axis).tolist(),
+        "peaks_y_coords": np.interp(fit["y"], np.arange(len(y_axis)), y_axis).tolist(),
+        "fit_method": method,
+        "grid_x_coords": x_axis[peak_x].tolist(),
+        "grid_y_coords": y_axis[peak_y].tolist(),
+        "sigma_x": (fit["sigma_x"] * x_step).tolist(),
+        "sigma_y": (fit["sigma_y"] * y_step).tolist(),
+        "amplitude": fit["amplitude"].tolist(),
+        "offset": fit["offset"].tolist(),
+        "converged": fit["converged"].tolist()
+    }
@@ -11,7 +11,8 @@
 ##############################################################
 
 
-from nidaqmx.constants import Edge, CountDirection
+from nidaqmx.constants import Edge, CountDirection, AcquisitionType, SampleTimingType
+import numpy as np
 import time
 
 
@@ -19,6 +20,11 @@ class PhotonCounter:
     read_task = None
     counter_channel = ""
     counter_terminal = ""
+    continuous = False # True while the count task is left running between readings (free-running mode).
+    last_count = 0 # Cumulative count at the previous free-running reading.
+    last_time = 0 # perf_counter() timestamp of the previous free-running reading.
+    gap_tolerance = 0.001 # (s) If the last reading is older than this, take a fresh one before integrating.
+    spin_time = 0.002 # (s) Final stretch of a wait that is spent spinning instead of sleeping.
 
     def __init__(self, task, counter_channel, counter_terminal):
         self.read_task = task
@@ -34,23 +40,22 @@ class PhotonCounter:
         )
         self.read_task.ci_channels[0].ci_count_edges_term = self.counter_terminal
 
-    def readCounts(self, integration_time=0, storage=[]):
+    def readCounts(self, integration_time=0):
         ##
         ## WAITS BY integration_time (s) THEN MEASURES COUNTS. RETURNS NUMBER OF COUNTS.
+        ## IF THE COUNTER IS FREE-RUNNING (startContinuous), RETURNS COUNTS/S INSTEAD OF RESTARTING THE TASK.
         ##
+        if self.continuous:
+            return self.readRate(integration_time)
         if integration_time == 0:  # instantaneous reading.
             self.start()
             counts = self.read()
-            storage.append(counts)
             self.stop()
             return counts
         else:
             self.start()
-            target_time = time.perf_counter() + integration_time
-            while time.perf_counter() < target_time:
-                pass
+            self.waitUntil(time.perf_counter() + integration_time)
             counts = self.read()
-            storage.append(counts / integration_time)
             self.stop()
             return int(counts / integration_time)
 
@@ -60,7 +65,89 @@ class PhotonCounter:
     def stop(self):
         self.read_task.stop()
 
-    def read(self, storage=[]):
-        c = self.read_task.read()
-        storage.append(c)
-        return c
+    def startContinuous(self):
+        ##
+        ## STARTS THE COUNT TASK ONCE AND LEAVES IT RUNNING; READINGS ARE THEN DIFFERENCES OF THE
+        ## CUMULATIVE COUNT (SEE readRate). CALL stopContinuous() WHEN THE SCAN IS OVER.
+        ##
+        self.start()
+        self.continuous = True
+        self.markCount()
+
+    def stopContinuous(self):
+        self.continuous = False
+        self.stop()
+
+    def markCount(self):
+        ##
+        ## TAKES A TIMESTAMPED READING OF THE CUMULATIVE COUNT.
+        ##
+        self.last_count = self.read()
+        self.last_time = time.perf_counter()
+
+    def readRate(self, integration_time):
+        ##
+        ## FREE-RUNNING READING: WAITS UNTIL integration_time (s) HAS PASSED SINCE THE PREVIOUS READING,
+        ## READS THE CUMULATIVE COUNT AND RETURNS COUNTS/S OVER THE ACTUAL ELAPSED TIME.
+        ## IF THE PREVIOUS READING IS STALE (e.g. THE MIRROR WAS MOVED OR THE UI WAS UPDATED IN BETWEEN),
+        ## A FRESH READING IS TAKEN FIRST SO THAT THE GAP IS NOT INTEGRATED.
+        ##
+        if time.perf_counter() - self.last_time > self.gap_tolerance:
+            self.markCount()
+        self.waitUntil(self.last_time + integration_time)
+        count = self.read()
+        now = time.perf_counter()
+        counts = (count - self.last_count) % 2**32 # Undo a rollover of the 32 bit counter register.
+        elapsed = now - self.last_time
+        self.last_count = count
+        self.last_time = now
+        if elapsed <= 0:
+            return counts
+        return int(counts / elapsed)
+
+    def waitUntil(self, target_time):
+        ##
+        ## WAITS UNTIL perf_counter() REACHES target_time. SLEEPS FOR MOST OF THE WAIT (LOW CPU) AND
+        ## ONLY SPINS FOR THE LAST spin_time SECONDS, SINCE time.sleep CAN OVERSHOOT BY ~1 ms.
+        ##
+        remaining = target_time - time.perf_counter()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < target_time:
+            pass
+
+    def startBuffered(self, clock_source, rate, n_samples):
+        ##
+        ## ARMS A BUFFERED COUNT: THE CUMULATIVE COUNT IS LATCHED INTO THE BUFFER ON EVERY
+        ## TICK OF clock_source (e.g. THE SCANNING MIRROR'S SAMPLE CLOCK). rate IS THE EXPECTED
+        ## MAXIMUM RATE OF THE EXTERNAL CLOCK.
+        ##
+        self.read_task.timing.cfg_samp_clk_timing(rate,
+                                                  source=clock_source,
+                                                  active_edge=Edge.RISING,
+                                                  sample_mode=AcquisitionType.FINITE,
+                                                  samps_per_chan=n_samples)
+        self.read_task.start()
+
+    def readBuffered(self, n_samples, timeout=10.0):
+        ##
+        ## BLOCKS UNTIL n_SAMPLES CUMULATIVE COUNTS ARE IN THE BUFFER, THEN RETURNS THEM AS AN ARRAY.
+        ##
+        return np.array(self.read_task.read(number_of_samples_per_channel=n_samples, timeout=timeout), dtype=np.int64)
+
+    def stopBuffered(self):
+        ##
+        ## STOPS THE BUFFERED COUNT AND RETURNS THE TASK TO ON-DEMAND READS (i.e. readCounts).
+        ##
+        self.read_task.stop()
+        self.read_task.timing.samp_timing_type = SampleTimingType.ON_DEMAND
+
+    def differenceCounts(self, cumulative, previous=0):
+        ##
+        ## TURNS AN ARRAY OF CUMULATIVE COUNTS INTO COUNTS PER SAMPLE INTERVAL.
+        ## THE COUNTER REGISTER IS 32 BITS, SO A ROLLOVER IS UNDONE WITH THE MODULO.
+        ##
+        return np.diff(np.concatenate(([previous], cumulative))) % 2**32
+
+    def read(self):
+        return self.read_task.read()
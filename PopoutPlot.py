@@ -11,11 +11,16 @@
 ##############################################################
 
 
+import queue
+import threading
+import time
 import tkinter as tk
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import os
+from DriftTracker import DriftTracker
+from CustomLoop import CustomLoop
 
 class PopoutPlot(tk.Toplevel):
     pixels = None # 2D numpy data.
@@ -25,9 +30,18 @@ class PopoutPlot(tk.Toplevel):
     scanwindow = None # ScanWindow object associated with the PopoutPlot.
     controlwindow = None # MainApp
     scan_num = 0 # Number of repetitions of the scan (for watching it over time).
-    save_data = {} # Dictionary that records the scan. Appended to the controlwindow save_data.
+    custom_loop = None # CustomLoop that runs the hardware loop; its save_data is added to the scan window's save_data.
+    scan_queue = None # Queue of measurements from the acquisition thread to the Tk thread.
+    scan_thread = None # Worker thread that runs the hardware loop.
+    drain_id = None # after() ID of the next scan_queue drain.
+    drain_interval = 50 # (ms) How often the Tk thread drains scan_queue.
+    join_timeout = 5 # (s) How long to wait for the worker thread to release the hardware when closing.
+    scatter = None # PathCollection of the custom points; made once, then recolored in place.
+    max_frame_rate = 10 # (Hz) The plot is redrawn at most this often during a loop.
+    last_draw = 0 # time.perf_counter() of the last redraw.
+    plot_pending = False # True if there are measurements that haven't been drawn yet.
 
-    def __init__(self, controlmenu, scanwindow, x_coords, y_coords, *args, **kwargs):
+    def __init__(self, controlmenu, scanwindow, x_coords, y_coords, *args, order=None, **kwargs):
         tk.Toplevel.__init__(self, *args, **kwargs)
         self.resizable(False, False)
         self.protocol("WM_DELETE_WINDOW", self.onClosing)
@@ -35,8 +49,8 @@ class PopoutPlot(tk.Toplevel):
         self.scanwindow = scanwindow
         self.x_coords = [round(x, 3) for x in x_coords]
         self.y_coords = [round(y, 3) for y in y_coords]
-        self.save_data = {"x_coords":self.x_coords, "y_coords":self.y_coords}
         self.scan_data = np.zeros(len(x_coords))
+        self.custom_loop = CustomLoop(scanwindow.DAQ, self.x_coords, self.y_coords, order=order)
 
         # Frame that holds the scan.
         frm_plot = tk.Frame(
@@ -56,50 +70,144 @@ class PopoutPlot(tk.Toplevel):
         # self.fig = plt.figure(figsize = (max(4, dimx), max(2, dimy)))
         self.fig = plt.figure()
         self.canvas = FigureCanvasTkAgg(self.fig, master=frm_plot)
+        self.generateScatter()
         # Put canvas on the GUI.
         self.canvas.draw()
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
+    def generateScatter(self):
+        ##
+        ## MAKES THE AXES AND THE SCATTER OF CUSTOM POINTS. plotScan ONLY CHANGES THEIR COLORS AFTERWARDS.
+        ##
+        ax = self.fig.add_subplot(111)
+        self.scatter = ax.scatter(self.x_coords,
+                                  self.y_coords,
+                                  s=100,
+                                  marker='H',
+                                  linewidths=0,
+                                  c=self.scan_data,
+                                  cmap="inferno")
+        # Set axis lims to preserve aspect ratio & make buffer room for the markers.
+        ax.set_xlim((min(self.x_coords)-0.02,max(self.x_coords)+0.02))
+        ax.set_ylim((min(self.y_coords)-0.02,max(self.y_coords)+0.02))
+        ax.set_facecolor("black")
+
     def takeScan(self):
         ##
-        ## TAKES A SCAN.
+        ## STARTS A SCAN. THE HARDWARE LOOP (custom_loop) RUNS IN A WORKER THREAD (acquire); THE TK SIDE
+        ## DRAINS scan_queue (drainScanQueue) AND REPLOTS AT ITS OWN RATE.
         ##
         self.scan_num += 1
         self.scanwindow.disablePeakFindingWidgets()
+        loop = self.custom_loop
+        track = False
+        if self.controlmenu.widgets["drift_track_int"].get() == 1:
+            if loop.drift_tracker is None:
+                loop.drift_tracker = self.makeDriftTracker()
+            loop.track_every = max(1, int(self.controlmenu.widgets["drift_track_every"].get()))
+            track = loop.isTrackingDue()
 
         # Scan start.
-        self.fig.clear()
         self.scan_data = np.zeros(len(self.x_coords))
-        for i, x, y in zip(range(len(self.scan_data)), self.x_coords, self.y_coords):
-            if str(self.controlmenu.widgets["interrupt_button"]["state"]) == "disabled":
-                    # If 'Interrupt' button is pressed, stop scan.
-                    break
-            self.scanwindow.moveScanningMirror(x, y)
-            self.scan_data[i] = self.scanwindow.measureCounts(x, y)
-            self.fig.clear()
-            ax = self.fig.add_subplot(111)
-            ax.scatter(self.x_coords,
-                       self.y_coords, 
-                       s=100,
-                       marker='H',
-                       linewidths=0,
-                       c=self.scan_data,
-                       cmap="inferno")
-            # Set axis lims to preserve aspect ratio & make buffer room for the markers.
-            ax.set_xlim((min(self.x_coords)-0.02,max(self.x_coords)+0.02))
-            ax.set_ylim((min(self.y_coords)-0.02,max(self.y_coords)+0.02))
-            ax.set_facecolor("black")
-            self.canvas.draw()
-            self.canvas.get_tk_widget().pack(expand=True)
-
-            # Update the UI... tkinter made me do it :/
-            self.update()
-            self.update_idletasks()
-
-        self.save_data[self.scan_num] = self.scan_data.tolist()
-        self.scanwindow.save_data["custom_points"] = self.save_data
+        self.plotScan()
+        int_time = float(self.controlmenu.widgets["int_time"].get()) / 1000 # Read once, not every point.
+        self.custom_loop.interrupt_event.clear()
+        self.scan_queue = queue.Queue()
+        self.scan_thread = threading.Thread(target=self.acquire, args=(int_time, track), daemon=True)
+        self.scan_thread.start()
+        self.drain_id = self.after(self.drain_interval, self.drainScanQueue)
+
+    def makeDriftTracker(self):
+        ##
+        ## TRACKS THE EMITTER UNDER THE CURSOR (IF ONE WAS PLACED), OTHERWISE THE FIRST CUSTOM POINT, WITH A
+        ## LOCAL SCAN AT THE MAIN SCAN'S STEP SIZE.
+        ##
+        s = self.scanwindow
+        if s.crosshair:
+            reference = (s.cursor_coordinates[0], s.cursor_coordinates[1])
+        else:
+            reference = (self.x_coords[0], self.y_coords[0])
+        step = min(abs(s.save_data["x_step"]), abs(s.save_data["y_step"]))
+        return DriftTracker(reference, step, voltage_range=s.scanning_mirror.getVoltageRange())
+
+    def acquire(self, int_time, track=False):
+        ##
+        ## [Worker thread] RUNS ONE LOOP OF custom_loop, PASSING ITS PROGRESS TO THE TK THREAD THROUGH scan_queue.
+        ## MUST NOT TOUCH ANY TK WIDGETS.
+        ##
+        try:
+            self.custom_loop.runLoop(int_time, track, post=self.scan_queue.put)
+        except Exception as e:
+            self.scan_queue.put(("error", e))
+        self.scan_queue.put(("done",))
+
+    def drainScanQueue(self):
+        ##
+        ## [Tk thread] MOVES THE NEW MEASUREMENTS INTO scan_data AND REPLOTS, AT MOST max_frame_rate TIMES A SECOND.
+        ##
+        scan_finished = False
+        while True:
+            try:
+                item = self.scan_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] == "point":
+                _, i, measurement = item
+                self.scan_data[i] = measurement
+                self.scanwindow.widgets["counts"].config(text=str(measurement))
+                self.plot_pending = True
+            elif item[0] == "tracked":
+                if not item[1]:
+                    print("Drift tracking lost the reference emitter; keeping the last offset.")
+            elif item[0] == "offset":
+                _, dx, dy = item
+                print(f"Loop {self.scan_num}: points offset by ({dx:.4f}, {dy:.4f}) V for drift.")
+            elif item[0] == "error":
+                print(f"Scan stopped by an error: {item[1]}")
+            elif item[0] == "done":
+                scan_finished = True
+
+        if self.plot_pending and (scan_finished or time.perf_counter() - self.last_draw >= 1 / self.max_frame_rate):
+            self.plotScan()
+        if scan_finished:
+            self.finishScan()
+            return
+        self.drain_id = self.after(self.drain_interval, self.drainScanQueue)
+
+    def plotScan(self):
+        ##
+        ## RECOLORS THE CUSTOM POINTS BY THEIR COUNTS AND REDRAWS.
+        ##
+        self.scatter.set_array(self.scan_data)
+        self.scatter.set_clim(self.scan_data.min(), self.scan_data.max())
+        self.canvas.draw()
+        self.last_draw = time.perf_counter()
+        self.plot_pending = False
+
+    def finishScan(self):
+        ##
+        ## [Tk thread] SCAN END: RECORDS THE DATA AND HANDS CONTROL BACK TO THE CONTROL MENU.
+        ##
+        self.drain_id = None
+        self.scan_thread = None
+        self.controlmenu.hardware_lock.release("custom loop")
+        self.scanwindow.save_data["custom_points"] = self.custom_loop.save_data # Including this loop's counts.
 
         self.scanwindow.enablePeakFindingWidgets()
+        self.controlmenu.finishCustomLoopEvent()
+
+    def stopAcquisition(self):
+        ##
+        ## INTERRUPTS THE WORKER THREAD (IF RUNNING) AND WAITS FOR IT TO RELEASE THE HARDWARE.
+        ##
+        if self.drain_id is not None:
+            self.after_cancel(self.drain_id)
+            self.drain_id = None
+        if self.scan_thread is not None:
+            self.custom_loop.interrupt_event.set()
+            self.scan_thread.join(timeout=self.join_timeout)
+            self.scan_thread = None
+            self.controlmenu.hardware_lock.release("custom loop")
 
     def saveScan(self):
         ##
@@ -126,15 +234,34 @@ class PopoutPlot(tk.Toplevel):
         self.scanwindow.save_data["custom_points_"+str(i)] = self.scanwindow.save_data.pop("custom_points")
         plot_path = s.getPath(suffix="_custom_"+str(i))  
 
-        s.saveJson(data_path) # Add data from custom points to the overall datafile.
-        s.savePlot(plot_path, annotations=True) # Plot the main scan with the custom points mask on the plot.
+        snapshot = s.takeSnapshot(annotations=True)
+        s.saveData(data_path, snapshot) # Add data from custom points to the overall datafile.
+        s.savePlot(plot_path, snapshot=snapshot) # Plot the main scan with the custom points mask on the plot.
         slices_path = custom_slices_folder + "/" + s.getName() + "_custom_" + str(i) + "_" + str(self.scan_num)
-        self.fig.savefig(slices_path, dpi='figure') # Save the slice plot itself.
+        # Save the slice plot itself (rendered off-screen, like the main plot).
+        self.controlmenu.submitExport(slices_path, self.controlmenu.export_worker.renderScatter,
+                                      self.takeSnapshot(), slices_path)
+
+    def takeSnapshot(self):
+        ##
+        ## COPIES THE POINTS & THEIR COUNTS FOR ExportWorker.renderScatter.
+        ##
+        return {
+            "x_coords": list(self.x_coords),
+            "y_coords": list(self.y_coords),
+            "scan_data": np.array(self.scan_data),
+            "figsize": tuple(self.fig.get_size_inches()),
+            "dpi": self.fig.get_dpi(),
+            "xlim": (min(self.x_coords)-0.02, max(self.x_coords)+0.02),
+            "ylim": (min(self.y_coords)-0.02, max(self.y_coords)+0.02)
+        }
 
     def onClosing(self):
         ##
         ## [Event Handler] CLOSES THIS WINDOW AND ADJUSTS.
         ##
+        running = self.scan_thread is not None
+        self.stopAcquisition()
         s = self.scanwindow
         s.removeCrosshair()
         s.clearAnnotations()
@@ -142,8 +269,8 @@ class PopoutPlot(tk.Toplevel):
             s.placeCrosshair(s.cursor_coordinates[0], s.cursor_coordinates[1])
         
         self.controlmenu.miniplot = None
-        self.controlmenu.widgets["custom_loop_button"].config(state="normal")
-        self.controlmenu.interruptScanEvent()
+        if running:
+            self.controlmenu.resetScanInputs()
 
         self.destroy()
         self.update()
\ No newline at end of file
@@ -0,0 +1,147 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import math
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class RouteOptimizer:
+    x_coords = None # Numpy array of the points' x coordinates (file order).
+    y_coords = None # Numpy array of the points' y coordinates (file order).
+    tree = None # cKDTree of the points, for nearest neighbour lookups.
+    n_neighbours = 8 # 2-opt only tries joining each point to this many of its nearest neighbours.
+    time_limit = 1.0 # (s) 2-opt stops improving the route after this long.
+
+    def __init__(self, x_coords, y_coords, n_neighbours=8, time_limit=1.0):
+        ##
+        ## FINDS A SHORT ORDER TO VISIT CUSTOM POINTS IN (AN OPEN PATH, NOT A LOOP BACK TO THE START):
+        ## A GREEDY NEAREST NEIGHBOUR ROUTE, THEN IMPROVED BY 2-OPT MOVES RESTRICTED TO NEAR NEIGHBOURS,
+        ## SO THAT IT STAYS FAST FOR 10k+ POINTS.
+        ##
+        self.x_coords = np.asarray(x_coords, dtype=float)
+        self.y_coords = np.asarray(y_coords, dtype=float)
+        self.n_neighbours = n_neighbours
+        self.time_limit = time_limit
+        self.tree = cKDTree(np.column_stack([self.x_coords, self.y_coords]))
+
+    def getOrder(self, start=None):
+        ##
+        ## RETURNS THE POINT INDICES IN VISITING ORDER. THE ROUTE BEGINS AT THE POINT CLOSEST TO start = (x, y),
+        ## OR AT THE FIRST POINT IF start IS None.
+        ##
+        if len(self.x_coords) < 3:
+            return list(range(len(self.x_coords)))
+        first = 0 if start is None else int(self.tree.query(start)[1])
+        order = self.nearestNeighbour(first)
+        return self.twoOpt(order)
+
+    def getPathLength(self, order=None):
+        ##
+        ## TOTAL DISTANCE TRAVELLED VISITING THE POINTS IN order (DEFAULT: FILE ORDER).
+        ##
+        if order is None:
+            order = np.arange(len(self.x_coords))
+        order = np.asarray(order, dtype=int)
+        return float(np.hypot(np.diff(self.x_coords[order]), np.diff(self.y_coords[order])).sum())
+
+    def nearestNeighbour(self, first):
+        ##
+        ## GREEDY ROUTE: ALWAYS GO TO THE CLOSEST POINT NOT VISITED YET.
+        ##
+        n = len(self.x_coords)
+        points = self.tree.data
+        visited = np.zeros(n, dtype=bool)
+        order = [first]
+        visited[first] = True
+        current = first
+        for _ in range(n - 1):
+            # Look at more and more neighbours until an unvisited one turns up.
+            k = min(16, n)
+            while True:
+                _, neighbours = self.tree.query(points[current], k=k)
+                unvisited = [j for j in np.atleast_1d(neighbours) if not visited[j]]
+                if unvisited:
+                    current = unvisited[0]
+                    break
+                if k >= n:
+                    break
+                k = min(4*k, n)
+            if not unvisited:
+                # Shouldn't happen (k reached n), but fall back to a brute force search.
+                remaining = np.flatnonzero(~visited)
+                dists = np.hypot(self.x_coords[remaining] - points[current][0], self.y_coords[remaining] - points[current][1])
+                current = remaining[np.argmin(dists)]
+            order.append(int(current))
+            visited[current] = True
+        return order
+
+    def twoOpt(self, order):
+        ##
+        ## SHORTENS THE ROUTE WITH 2-OPT MOVES (REVERSING A STRETCH OF IT), ONLY TRYING TO JOIN EACH POINT
+        ## TO ONE OF ITS n_neighbours CLOSEST POINTS. STOPS WHEN NO MOVE HELPS OR time_limit RUNS OUT.
+        ##
+        n = len(order)
+        deadline = time.perf_counter() + self.time_limit
+        x, y = self.x_coords.tolist(), self.y_coords.tolist()
+        def dist(a, b):
+            return math.hypot(x[a] - x[b], y[a] - y[b])
+        k = min(self.n_neighbours + 1, n)
+        neighbours = self.tree.query(self.tree.data, k=k)[1][:, 1:].tolist() # Drop each point itself.
+        tour = np.array(order)
+        position = np.empty(n, dtype=int)
+        position[tour] = np.arange(n)
+
+        def reverse(i, j):
+            # Reverses tour[i..j] (positions), replacing edges (i-1, i) & (j, j+1) with (i-1, j) & (i, j+1).
+            tour[i:j+1] = tour[i:j+1][::-1].copy()
+            position[tour[i:j+1]] = np.arange(i, j+1)
+
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = False
+            for p in range(n):
+                a = int(tour[p])
+                # Try replacing the edge to a's successor (direction +1), then to its predecessor (-1),
+                # with an edge to a nearby point c (and joining the two points they leave behind).
+                for direction in [1, -1]:
+                    if not 0 <= p + direction < n:
+                        continue
+                    b = int(tour[p + direction])
+                    d_ab = dist(a, b)
+                    moved = False
+                    for c in neighbours[a]:
+                        d_ac = dist(a, c)
+                        if d_ac >= d_ab:
+                            break # Neighbours are sorted by distance, so no further c can help.
+                        q = int(position[c])
+                        if q == p + direction:
+                            continue
+                        if 0 <= q + direction < n:
+                            d = int(tour[q + direction])
+                            gain = d_ab + dist(c, d) - d_ac - dist(b, d)
+                        else: # c is an end of the route, so there is no edge c-d to remove.
+                            gain = d_ab - d_ac
+                        if gain > 1e-12:
+                            if direction == 1:
+                                reverse(min(p, q) + 1, max(p, q))
+                            else:
+                                reverse(min(p, q), max(p, q) - 1)
+                            improved = moved = True
+                            break
+                    if moved:
+                        break
+                if time.perf_counter() > deadline:
+                    break
+        return tour.tolist()
@@ -0,0 +1,558 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import os
+import json
+import queue
+import threading
+import numpy as np
+from datetime import datetime
+import nidaqmx
+from PhotonCounter import PhotonCounter
+from ScanningMirror import ScanningMirror
+from SettlingModel import SettlingModel
+from ScanFile import ScanFile
+from AdaptiveScan import AdaptiveScan
+from TimeLapse import TimeLapse
+
+
+class ScanSpec:
+    x_start = 0.0 # (V)
+    x_end = 0.0 # (V)
+    x_step = 0.0 # (V)
+    y_start = 0.0 # (V)
+    y_end = 0.0 # (V)
+    y_step = 0.0 # (V)
+    integration_time = 1.0 # (ms) Dwell per pixel.
+    scan_mode = "hardware-timed" # "hardware-timed", "free-running", "per-pixel" or "adaptive".
+    output = "" # Path of the .h5 file the scan is streamed into ("" to not save it).
+    n_frames = 1 # How many times the scan is repeated (time-lapse).
+    time_lapse_output = "" # Path of the time-lapse .h5 file ("" = next to output).
+    coarse_step = 8 # Adaptive scans: pixels between the points of the coarse pass.
+    refine_factor = 2.0 # Adaptive scans: cells brighter than this x the background are refined.
+    compression = "gzip" # Compression for the .h5 files ("gzip", "lzf" or None).
+    x_axis = None # X voltages (from x_start, x_end & x_step).
+    y_axis = None # Y voltages (from y_start, y_end & y_step).
+    scan_modes = ["hardware-timed", "free-running", "per-pixel", "adaptive"]
+
+    def __init__(self, x_start, x_end, x_step, y_start, y_end, y_step, integration_time, scan_mode="hardware-timed",
+                 output="", n_frames=1, time_lapse_output="", coarse_step=8, refine_factor=2.0, compression="gzip"):
+        ##
+        ## EVERYTHING THAT DEFINES A SCAN, WITHOUT ANY WIDGETS: THE SAME SETTINGS AS THE CONTROL MENU.
+        ## RAISES ValueError IF THE SETTINGS DON'T MAKE A SCAN.
+        ##
+        if scan_mode not in self.scan_modes:
+            raise ValueError(f"Unknown scan mode: {scan_mode}")
+        self.x_start, self.x_end, self.x_step = float(x_start), float(x_end), float(x_step)
+        self.y_start, self.y_end, self.y_step = float(y_start), float(y_end), float(y_step)
+        for axis, start, end, step in [("x", self.x_start, self.x_end, self.x_step),
+                                       ("y", self.y_start, self.y_end, self.y_step)]:
+            if step == 0:
+                raise ValueError(f"The {axis} step can't be 0.")
+            if (end - start) * step < 0:
+                raise ValueError(f"The {axis} step ({step}) goes the wrong way from {start} to {end}.")
+        self.integration_time = float(integration_time)
+        self.scan_mode = scan_mode
+        self.output = output
+        self.n_frames = max(1, int(n_frames))
+        self.time_lapse_output = time_lapse_output
+        self.coarse_step = int(coarse_step)
+        self.refine_factor = float(refine_factor)
+        self.compression = compression
+        self.x_axis = self.getAxis(self.x_start, self.x_end, self.x_step)
+        self.y_axis = self.getAxis(self.y_start, self.y_end, self.y_step)
+
+    @staticmethod
+    def getAxis(start, end, step):
+        ##
+        ## THE VOLTAGES FROM start TO end, step APART (THE LAST STEP SHRINKS SO THAT end IS INCLUDED).
+        ##
+        return np.linspace(start, end, int((end - start) / step)+1)
+
+    @staticmethod
+    def fromCheckpoint(path):
+        ##
+        ## THE ScanSpec OF THE SCAN BEING AUTOSAVED TO path (WRITING TO path AGAIN), TO RESUME IT.
+        ## RAISES ValueError IF path HASN'T GOT A CHECKPOINT.
+        ##
+        with ScanFile(path) as scan_file:
+            checkpoint = scan_file.getCheckpoint()
+        if checkpoint is None:
+            raise ValueError(f"{path} has no checkpoint to resume from.")
+        return ScanSpec.fromDict(dict(checkpoint["spec"], output=path))
+
+    @staticmethod
+    def fromDict(spec):
+        ##
+        ## MAKES A ScanSpec FROM A DICTIONARY WITH THE SAME KEYS AS toDict() (e.g. FROM A .json FILE).
+        ##
+        return ScanSpec(**spec)
+
+    def toDict(self):
+        return {
+            "x_start": self.x_start, "x_end": self.x_end, "x_step": self.x_step,
+            "y_start": self.y_start, "y_end": self.y_end, "y_step": self.y_step,
+            "integration_time": self.integration_time,
+            "scan_mode": self.scan_mode,
+            "output": self.output,
+            "n_frames": self.n_frames,
+            "time_lapse_output": self.time_lapse_output,
+            "coarse_step": self.coarse_step,
+            "refine_factor": self.refine_factor,
+            "compression": self.compression
+        }
+
+    def getTimeLapseOutput(self):
+        if self.time_lapse_output or not self.output:
+            return self.time_lapse_output
+        return os.path.splitext(self.output)[0] + "_timelapse.h5"
+
+    def getSaveData(self):
+        ##
+        ## THE SCAN SETTINGS IN THE save_data FORMAT OF THE .h5 & .json FILES.
+        ##
+        save_data = {
+            "integration_time": self.integration_time,
+            "x_axis": self.x_axis.tolist(),
+            "y_axis": self.y_axis.tolist(),
+            "x_step": self.x_step,
+            "y_step": self.y_step,
+            "scan_mode": self.scan_mode
+        }
+        if self.scan_mode == "adaptive":
+            save_data["adaptive"] = {"coarse_step": self.coarse_step, "refine_factor": self.refine_factor}
+        if self.n_frames > 1:
+            save_data["time_lapse"] = {
+                "n_frames": self.n_frames,
+                "file": self.getTimeLapseOutput(),
+                "drift_x": [], # (V) Drift of each frame since the first one.
+                "drift_y": []
+            }
+        return save_data
+
+
+class ScanCore:
+    spec = None # ScanSpec being scanned.
+    x_axis = None # X axis array.
+    y_axis = None # Y axis array.
+    photon_counter = None # from the DAQ
+    scanning_mirror = None # from the DAQ
+    save_data = {} # The scan's settings & results (save_data format), e.g. for the .h5 file's metadata.
+    interrupt_event = None # Set to stop the scan.
+    messages = None # Queue of pixels/columns/... from the worker thread to whoever is watching the scan.
+    thread = None # Worker thread that runs the hardware loop.
+    scan_file = None # ScanFile that finished columns are streamed into, or None.
+    time_lapse = None # TimeLapse that the frames are stored & drift-tracked in, or None for a single scan.
+    frame = 0 # [Worker thread] Index of the frame being scanned.
+    resume = False # True to carry on with the columns of spec.output that aren't done yet, instead of starting over.
+    columns_done = None # Resumed scans: bool per x index, True for the columns that were already done (& are skipped).
+    listeners = None # Functions that are also called with every message, from the worker thread (e.g. ScanServer).
+    band_pixels = 262144 # Hardware-timed scans write the mirror's path (and read the counter) this many pixels' worth of columns at a time.
+
+    def __init__(self, DAQ, spec, interrupt_event=None, resume=False):
+        ##
+        ## RUNS A SCAN ON THE HARDWARE IN A WORKER THREAD, WITHOUT ANY GUI. FINISHED COLUMNS ARE STREAMED TO
+        ## spec.output, AND EVERYTHING THAT'S MEASURED IS PUT ON messages AS TUPLES:
+        ##   ("pixel", x_i, y_i, counts/s)          ONE PIXEL (SOFTWARE-TIMED MODES)
+        ##   ("column", x_i, column, counts/s)      A WHOLE COLUMN (HARDWARE-TIMED MODE), counts/s OF ITS LAST PIXEL
+        ##   ("column_done", x_i, column)           A COLUMN MEASURED PIXEL BY PIXEL IS COMPLETE
+        ##   ("fill", x_i, column)                  ADAPTIVE SCANS: A COLUMN WITH THE UNMEASURED PIXELS INTERPOLATED
+        ##   ("adaptive", measured, summary)        ADAPTIVE SCANS: WHICH PIXELS WERE MEASURED
+        ##   ("frame_done", frame)                  TIME-LAPSE: A FRAME IS COMPLETE
+        ##   ("error", exception)
+        ##   ("done",)                              ALWAYS LAST
+        ## THE GUI DRAINS messages WITH getMessages(); A SCRIPT CAN SIMPLY ITERATE OVER THE ScanCore (OR columns()).
+        ## FUNCTIONS ADDED TO listeners BEFORE start() ARE ALSO CALLED WITH EVERY MESSAGE, AS IT'S POSTED.
+        ## WITH resume, spec.output MUST BE AN EARLIER AUTOSAVE OF THE SAME SCAN: ONLY ITS COLUMNS THAT AREN'T
+        ## DONE ARE SCANNED (IN THE SAME SERPENTINE DIRECTIONS), INTO THE SAME FILE.
+        ##
+        self.spec = spec
+        self.x_axis = spec.x_axis
+        self.y_axis = spec.y_axis
+        self.photon_counter = DAQ["Photon Counter"]
+        self.scanning_mirror = DAQ["Scanning Mirror"]
+        voltage_min, voltage_max = self.scanning_mirror.getVoltageRange()
+        for axis in [self.x_axis, self.y_axis]:
+            if len(axis) == 0 or axis.min() < voltage_min or axis.max() > voltage_max:
+                raise ValueError(f"Scan voltages must be within [{voltage_min}, {voltage_max}] V.")
+        if resume and (not spec.output or spec.scan_mode == "adaptive" or spec.n_frames > 1):
+            raise ValueError("Only saved, single-frame, non-adaptive scans can be resumed.")
+        self.resume = resume
+        self.save_data = spec.getSaveData()
+        self.save_data["settling"] = self.scanning_mirror.settling.getConfig()
+        self.interrupt_event = threading.Event() if interrupt_event is None else interrupt_event
+        self.messages = queue.Queue()
+        self.listeners = []
+
+    def start(self):
+        ##
+        ## OPENS THE OUTPUT FILES AND STARTS THE WORKER THREAD.
+        ##
+        if self.resume:
+            self.scan_file = self.openCheckpoint()
+        elif self.spec.output:
+            self.scan_file = self.openOutput()
+        if self.spec.n_frames > 1 and self.spec.getTimeLapseOutput():
+            self.time_lapse = self.openTimeLapse()
+        self.interrupt_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def interrupt(self):
+        self.interrupt_event.set()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def join(self, timeout=None):
+        ##
+        ## WAITS FOR THE WORKER THREAD. RETURNS TRUE IF IT HAS FINISHED.
+        ##
+        if self.thread is not None:
+            self.thread.join(timeout=timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def post(self, message):
+        ##
+        ## [Worker thread] PUTS message ON messages AND HANDS IT TO THE LISTENERS, WHICH MUST RETURN AT ONCE.
+        ##
+        self.messages.put(message)
+        for listener in self.listeners:
+            listener(message)
+
+    def getMessages(self):
+        ##
+        ## RETURNS (AND CLEARS) THE MESSAGES SINCE THE LAST CALL, WITHOUT WAITING.
+        ##
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def __iter__(self):
+        ##
+        ## YIELDS THE MESSAGES AS THEY ARRIVE, UNTIL (AND INCLUDING) ("done",).
+        ##
+        while True:
+            message = self.messages.get()
+            yield message
+            if message[0] == "done":
+                return
+
+    def columns(self):
+        ##
+        ## YIELDS (frame, x_i, column) FOR EVERY FINISHED COLUMN, IN THE ORDER THEY'RE MEASURED. ERRORS ARE RAISED.
+        ##
+        frame = 0
+        for message in self:
+            if message[0] in ["column", "column_done"]:
+                yield frame, message[1], message[2]
+            elif message[0] == "frame_done":
+                frame = message[1] + 1
+            elif message[0] == "error":
+                raise message[1]
+
+    def openOutput(self):
+        ##
+        ## CREATES THE .h5 FILE THAT FINISHED COLUMNS ARE STREAMED INTO DURING THE SCAN, SO THAT AN
+        ## INTERRUPTED OR CRASHED SCAN STILL LEAVES USABLE DATA ON DISK. RETURNS None IF IT CAN'T BE MADE.
+        ##
+        path = self.spec.output
+        try:
+            scan_file = ScanFile(path, "w")
+            scan_file.create(self.x_axis, self.y_axis, self.save_data, compression=self.spec.compression)
+            scan_file.writeCheckpoint(self.spec.toDict())
+            return scan_file
+        except OSError as e:
+            print(f"Could not create scan file {path}: {e}")
+            return None
+
+    def openCheckpoint(self):
+        ##
+        ## REOPENS THE .h5 FILE OF THE SCAN BEING RESUMED, AND READS WHICH COLUMNS ARE DONE.
+        ## RAISES ValueError IF IT ISN'T THE SAME SCAN (DIFFERENT AXES).
+        ##
+        scan_file = ScanFile(self.spec.output, "r+")
+        x_axis, y_axis = scan_file.getAxes()
+        if x_axis.shape != self.x_axis.shape or y_axis.shape != self.y_axis.shape \
+                or not np.allclose(x_axis, self.x_axis) or not np.allclose(y_axis, self.y_axis):
+            scan_file.close()
+            raise ValueError(f"{self.spec.output} is a different scan (its axes don't match).")
+        self.columns_done = scan_file.getColumnsDone()
+        previous = json.loads(scan_file.h5.attrs["save_data"])
+        remaining = np.flatnonzero(~self.columns_done)
+        self.save_data["resumed"] = previous.get("resumed", []) + [{
+            "column": int(remaining[0]) if len(remaining) > 0 else len(self.x_axis),
+            "columns_done": int(self.columns_done.sum()),
+            "time": datetime.now().isoformat(timespec="seconds")
+        }]
+        return scan_file
+
+    def getColumnsToScan(self):
+        ##
+        ## x INDICES OF THE COLUMNS THAT STILL NEED SCANNING, IN ORDER.
+        ##
+        if self.columns_done is None:
+            return np.arange(len(self.x_axis))
+        return np.flatnonzero(~self.columns_done)
+
+    def openTimeLapse(self):
+        ##
+        ## CREATES THE .h5 FILE THAT THE TIME-LAPSE FRAMES ARE STACKED IN. RETURNS None (AND THE FRAMES ARE
+        ## STILL SCANNED, JUST NOT KEPT) IF IT CAN'T BE MADE.
+        ##
+        path = self.spec.getTimeLapseOutput()
+        try:
+            return TimeLapse(path, self.x_axis, self.y_axis, self.save_data, compression=self.spec.compression)
+        except OSError as e:
+            print(f"Could not create time-lapse file {path}: {e}")
+            return None
+
+    def run(self):
+        ##
+        ## [Worker thread] RUNS THE HARDWARE LOOP (ONCE PER TIME-LAPSE FRAME).
+        ##
+        int_time = self.spec.integration_time / 1000
+        try:
+            for frame in range(self.spec.n_frames):
+                self.frame = frame
+                if self.time_lapse is not None:
+                    self.time_lapse.startFrame(frame)
+                self.scanFrame(self.spec.scan_mode, int_time)
+                if self.interrupt_event.is_set():
+                    break # An interrupted frame is left out of the drift tracking & average.
+                if self.time_lapse is not None:
+                    self.time_lapse.finishFrame(frame)
+                self.post(("frame_done", frame))
+            self.scanning_mirror.moveTo(0, 0)
+        except Exception as e:
+            self.post(("error", e))
+        finally:
+            if self.scan_file is not None:
+                self.scan_file.writeMetadata(self.save_data)
+                self.scan_file.close()
+            if self.time_lapse is not None:
+                self.time_lapse.close()
+        self.post(("done",))
+
+    def scanFrame(self, scan_mode, int_time):
+        ##
+        ## [Worker thread] SCANS THE WHOLE RASTER ONCE, IN THE GIVEN SCAN MODE.
+        ##
+        if scan_mode == "hardware-timed":
+            self.scanBuffered(int_time)
+        elif scan_mode == "adaptive":
+            self.photon_counter.startContinuous()
+            try:
+                self.scanAdaptive(int_time)
+            finally:
+                self.photon_counter.stopContinuous()
+        elif scan_mode == "free-running":
+            # Counter task is started once for the whole scan instead of once per pixel.
+            self.photon_counter.startContinuous()
+            try:
+                self.scanPerPixel(int_time)
+            finally:
+                self.photon_counter.stopContinuous()
+        else:
+            self.scanPerPixel(int_time)
+
+    def writeColumn(self, x_i, column):
+        ##
+        ## [Worker thread] STREAMS A FINISHED COLUMN TO THE OUTPUT FILE (AND THE TIME-LAPSE FRAME).
+        ##
+        if self.scan_file is not None:
+            self.scan_file.writeColumn(x_i, column)
+        if self.time_lapse is not None:
+            self.time_lapse.writeColumn(self.frame, x_i, column)
+
+    def scanPerPixel(self, int_time):
+        ##
+        ## [Worker thread] SOFTWARE-TIMED SCAN: MOVES THE MIRROR AND READS THE PHOTON COUNTER ONE
+        ## PIXEL AT A TIME. SLOWER THAN scanBuffered, BUT WORKS WITH ANY COUNTER (FALLBACK MODE).
+        ##
+        column = np.zeros(len(self.y_axis))
+        for x_i in self.getColumnsToScan():
+            for i in range(len(self.y_axis)):
+                if self.interrupt_event.is_set():
+                    # If 'Interrupt' button is pressed, stop scan.
+                    return
+                y_i = 0
+                # Change direction every column.
+                if x_i % 2 == 0: # Even: scan in the forward direction.
+                    y_i = i
+                else: # Odd: scan in the backward direction.
+                    y_i = -(i+1)
+
+                # Take measurement & record data.
+                column[y_i] = self.measurePixel(x_i, y_i, int_time)
+            self.writeColumn(x_i, column)
+            self.post(("column_done", x_i, column.copy()))
+
+    def measurePixel(self, x_i, y_i, int_time):
+        ##
+        ## [Worker thread] MOVES TO PIXEL (x_i, y_i), MEASURES IT AND SENDS IT ON.
+        ##
+        settle_time = self.scanning_mirror.moveTo(self.x_axis[x_i], self.y_axis[y_i])
+        if settle_time > 0 and self.photon_counter.continuous:
+            # Start the dwell now that the mirror has settled, not at the previous reading.
+            self.photon_counter.markCount()
+        measurement = self.photon_counter.readCounts(integration_time=int_time)
+        self.post(("pixel", x_i, y_i, measurement))
+        return measurement
+
+    def scanAdaptive(self, int_time):
+        ##
+        ## [Worker thread] ADAPTIVE SCAN: A COARSE PASS, THEN QUADTREE REFINEMENT OF ONLY THE CELLS WITH A
+        ## CORNER BRIGHTER THAN THE BACKGROUND (SEE AdaptiveScan), ONE LEVEL AT A TIME. AFTER EVERY LEVEL THE
+        ## WHOLE IMAGE IS SENT WITH THE UNMEASURED PIXELS INTERPOLATED, SO THE PLOT SHARPENS AS IT GOES.
+        ##
+        interrupt_event = self.interrupt_event
+        adaptive = AdaptiveScan((len(self.x_axis), len(self.y_axis)), int_time,
+                                coarse_step=self.spec.coarse_step, refine_factor=self.spec.refine_factor)
+        points = adaptive.getCoarsePoints()
+        while points:
+            for x_i, y_i in points:
+                if interrupt_event.is_set():
+                    # If 'Interrupt' button is pressed, stop scan.
+                    break
+                adaptive.record(x_i, y_i, self.measurePixel(x_i, y_i, int_time))
+            image = adaptive.getImage()
+            for x_i in range(len(self.x_axis)):
+                self.post(("fill", x_i, image[x_i]))
+            if interrupt_event.is_set():
+                break
+            points = adaptive.refine()
+        for x_i in range(len(self.x_axis)):
+            self.writeColumn(x_i, image[x_i])
+        if self.scan_file is not None:
+            self.scan_file.writeMeasured(adaptive.measured)
+        summary = adaptive.getSummary()
+        self.save_data["adaptive"].update(summary)
+        self.post(("adaptive", adaptive.measured, summary))
+        if not interrupt_event.is_set():
+            for x_i in range(len(self.x_axis)):
+                self.post(("column_done", x_i, image[x_i]))
+        print(f"Adaptive scan measured {100*adaptive.measured.mean():.1f}% of the pixels.")
+
+    def scanBuffered(self, int_time):
+        ##
+        ## [Worker thread] HARDWARE-TIMED SCAN: THE SERPENTINE PATH IS WRITTEN TO THE SCANNING MIRROR AS
+        ## SAMPLE-CLOCKED WAVEFORMS (ONE SAMPLE PER PIXEL), AND THE PHOTON COUNTER LATCHES ITS CUMULATIVE
+        ## COUNT ON THE SAME CLOCK. THE PATH IS MADE & WRITTEN band_pixels PIXELS' WORTH OF COLUMNS AT A TIME
+        ## (scanBand), SO EVEN A SCAN TOO BIG FOR RAM NEVER HOLDS MORE THAN ONE BAND OF IT. THE SCAN TAKES
+        ## (# PIXELS) x (INTEGRATION TIME), PLUS A TASK RESTART EVERY BAND.
+        ##
+        columns = self.getColumnsToScan()
+        band = max(1, self.band_pixels // len(self.y_axis))
+        for first in range(0, len(columns), band):
+            if self.interrupt_event.is_set():
+                break
+            self.scanBand(columns[first:first+band], int_time)
+
+    def scanBand(self, columns, int_time):
+        ##
+        ## [Worker thread] SCANS columns (x INDICES, IN ORDER) AS ONE WAVEFORM. COUNTS ARE READ BACK ONE
+        ## COLUMN AT A TIME WHILE THE MIRROR KEEPS MOVING. IF THE SETTLING MODEL SAYS SOME MOVES TAKE A LARGE
+        ## PART OF A DWELL, THE CLOCK TICKS SEVERAL TIMES PER DWELL, AND THOSE PIXELS ARE HELD FOR A FEW EXTRA
+        ## TICKS FIRST, WHOSE COUNTS ARE THROWN AWAY.
+        ##
+        interrupt_event = self.interrupt_event
+        n_x, n_y = len(columns), len(self.y_axis)
+        x_path, y_path = self.getSerpentinePath(columns)
+        n_ticks, n_extra = self.scanning_mirror.settling.getSettleTicks(x_path, y_path, int_time)
+        rate = n_ticks / int_time
+        repeats = n_extra + n_ticks # Clock ticks per pixel.
+        x_path = np.repeat(x_path, repeats)
+        y_path = np.repeat(y_path, repeats)
+        pixel = np.repeat(np.arange(len(repeats)) % n_y, repeats) # Per tick: the pixel (in scan order) of its column.
+        tick = np.arange(len(x_path)) - np.repeat(np.cumsum(repeats) - repeats, repeats) # Per tick: ticks since its pixel began.
+        measured = tick >= np.repeat(n_extra, repeats) # The last n_ticks of each pixel are the ones that are counted.
+        column_samples = repeats.reshape(n_x, n_y).sum(axis=1)
+        # Repeat the last pixel so its dwell is closed off by one more clock tick.
+        x_path = np.append(x_path, x_path[-1])
+        y_path = np.append(y_path, y_path[-1])
+
+        self.scanning_mirror.moveTo(x_path[0], y_path[0]) # Park on the first pixel before the clock starts.
+        self.scanning_mirror.loadWaveform(x_path, y_path, rate)
+        self.photon_counter.startBuffered(self.scanning_mirror.getSampleClockSource(), rate, len(x_path))
+        self.scanning_mirror.startWaveform()
+        try:
+            # First tick: count at the start of the first pixel.
+            previous = self.photon_counter.readBuffered(1, timeout=10)[0]
+            first_sample = 0
+            for k, x_i in enumerate(columns):
+                if interrupt_event.is_set():
+                    # If 'Interrupt' button is pressed, stop scan.
+                    break
+                n_samples = column_samples[k]
+                cumulative = self.photon_counter.readBuffered(n_samples, timeout=n_samples * int_time + 10)
+                counts = self.photon_counter.differenceCounts(cumulative, previous)
+                counted = measured[first_sample:first_sample+n_samples]
+                column = np.bincount(pixel[first_sample:first_sample+n_samples][counted], weights=counts[counted], minlength=n_y) / int_time
+                previous = cumulative[-1]
+                first_sample += n_samples
+                last_measurement = column[-1]
+                if x_i % 2 == 1: # Odd columns were scanned in the backward direction.
+                    column = column[::-1]
+                self.writeColumn(x_i, column)
+                self.post(("column", x_i, column, last_measurement))
+        finally:
+            self.photon_counter.stopBuffered()
+            self.scanning_mirror.stopWaveform()
+
+    def getSerpentinePath(self, columns=None):
+        ##
+        ## RETURNS THE FLATTENED (x, y) VOLTAGES OF THE SCAN (OR JUST OF THE COLUMNS WITH x INDICES columns),
+        ## IN THE ORDER THEY ARE VISITED. EVEN COLUMNS GO FORWARD IN y, ODD COLUMNS GO BACKWARD.
+        ##
+        columns = np.arange(len(self.x_axis)) if columns is None else np.asarray(columns)
+        y_grid = np.tile(self.y_axis, (len(columns), 1))
+        backward = columns % 2 == 1
+        y_grid[backward] = y_grid[backward, ::-1]
+        x_grid = np.repeat(self.x_axis[columns], len(self.y_axis))
+        return x_grid, y_grid.ravel()
+
+
+def openTasks(config, simulate=False):
+    ##
+    ## RETURNS THE (photon counter, scanning mirror) TASKS: NI-DAQmx TASKS, OR THE SIMULATED DAQ'S IF simulate
+    ## OR IF IT'S ENABLED IN THE "Simulation" SECTION OF config (HardwareConfig.json).
+    ##
+    simulation = config.get("Simulation", {})
+    if simulate or simulation.get("enabled", False):
+        from SimulatedDAQ import SimulatedRig
+        rig = SimulatedRig(simulation)
+        print("Running on the simulated DAQ.")
+        return rig.counterTask(), rig.analogTask()
+    return nidaqmx.Task(), nidaqmx.Task()
+
+
+def makeDAQ(config, photon_counter_task, scanning_mirror_task):
+    ##
+    ## THE DAQ DICTIONARY THAT HOSTS THE HARDWARE, SET UP FROM config (HardwareConfig.json).
+    ##
+    return {
+        "Photon Counter": PhotonCounter(photon_counter_task,
+                            config["Photon Counter"]["counter_channel"],
+                            config["Photon Counter"]["counter_terminal"]),
+        "Scanning Mirror": ScanningMirror(scanning_mirror_task,
+                            config["Scanning Mirror"]["x_channel"],
+                            config["Scanning Mirror"]["y_channel"],
+                            V_range=config["Scanning Mirror"]["V_range"],
+                            settling=SettlingModel(config["Scanning Mirror"].get("settling", {})))
+    }
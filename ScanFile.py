@@ -0,0 +1,154 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import json
+import h5py
+import numpy as np
+
+
+class ScanFile:
+    path = "" # Path of the .h5 file.
+    h5 = None # Open h5py.File.
+    format_version = 1
+
+    def __init__(self, path, mode="r"):
+        ##
+        ## OPENS A .h5 SCAN FILE. mode IS "r" (READ), "r+" (READ & WRITE) OR "w" (NEW FILE; CALL create() NEXT).
+        ##
+        ## LAYOUT:
+        ##   scan_data     int32 [x][y], counts/s, ONE (COMPRESSED) CHUNK PER COLUMN.
+        ##   columns_done  bool [x], TRUE ONCE A COLUMN IS COMPLETELY ON DISK.
+        ##   measured      bool [x][y], ONLY FOR ADAPTIVE SCANS: TRUE FOR MEASURED PIXELS, FALSE FOR INTERPOLATED ONES.
+        ##   x_axis, y_axis
+        ##   attrs["save_data"]  EVERYTHING ELSE IN ScanWindow.save_data (INTEGRATION TIME, PEAKS, CUSTOM POINTS...) AS JSON.
+        ##   attrs["checkpoint"] AUTOSAVES ONLY: WHAT'S NEEDED TO RESUME THE SCAN (SEE writeCheckpoint), AS JSON.
+        ##
+        self.path = path
+        self.h5 = h5py.File(path, mode)
+
+    def create(self, x_axis, y_axis, save_data, compression="gzip"):
+        ##
+        ## LAYS OUT AN EMPTY SCAN. compression IS ANY h5py FILTER ("gzip", "lzf") OR None.
+        ##
+        n_x, n_y = len(x_axis), len(y_axis)
+        self.h5.attrs["format_version"] = self.format_version
+        self.h5.create_dataset("scan_data", shape=(n_x, n_y), dtype=np.int32, chunks=(1, n_y),
+                               compression=compression, fillvalue=0)
+        self.h5["scan_data"].attrs["units"] = "counts/s"
+        self.h5.create_dataset("columns_done", shape=(n_x,), dtype=bool, fillvalue=False)
+        self.h5.create_dataset("x_axis", data=np.asarray(x_axis, dtype=float))
+        self.h5.create_dataset("y_axis", data=np.asarray(y_axis, dtype=float))
+        self.writeMetadata(save_data)
+
+    def writeMetadata(self, save_data):
+        ##
+        ## STORES save_data (MINUS THE BIG ARRAYS, WHICH HAVE THEIR OWN DATASETS) AS A JSON ATTRIBUTE.
+        ##
+        metadata = {k: v for k, v in save_data.items() if k not in ["scan_data", "x_axis", "y_axis"]}
+        self.h5.attrs["save_data"] = json.dumps(metadata, default=float)
+        self.h5.flush()
+
+    def writeCheckpoint(self, spec):
+        ##
+        ## STORES THE SCAN'S SETTINGS (ScanSpec.toDict()) AND ITS SERPENTINE DIRECTIONS (EVEN COLUMNS ARE SCANNED
+        ## FORWARD IN y, ODD ONES BACKWARD). WITH columns_done, WHICH IS WRITTEN WITH EVERY COLUMN, THAT'S ENOUGH
+        ## TO CARRY ON WITH AN INTERRUPTED OR CRASHED SCAN.
+        ##
+        self.h5.attrs["checkpoint"] = json.dumps({"spec": spec, "forward_columns": "even"}, default=float)
+        self.h5.flush()
+
+    def getCheckpoint(self):
+        ##
+        ## RETURNS THE DICTIONARY FROM writeCheckpoint, OR None IF THE FILE HASN'T GOT ONE.
+        ##
+        return json.loads(self.h5.attrs["checkpoint"]) if "checkpoint" in self.h5.attrs else None
+
+    def writeColumn(self, x_i, column):
+        ##
+        ## WRITES ONE FINISHED COLUMN AND FLUSHES, SO IT SURVIVES AN INTERRUPTED OR CRASHED SCAN.
+        ##
+        self.writeColumns(x_i, np.asarray(column)[np.newaxis, :])
+
+    def writeColumns(self, first, columns, done=None):
+        ##
+        ## WRITES A BLOCK OF COLUMNS STARTING AT x INDEX first. done (BOOL PER COLUMN) DEFAULTS TO ALL TRUE.
+        ##
+        columns = np.clip(np.rint(columns), np.iinfo(np.int32).min, np.iinfo(np.int32).max).astype(np.int32)
+        self.h5["scan_data"][first:first+len(columns)] = columns
+        self.h5["columns_done"][first:first+len(columns)] = True if done is None else done
+        self.h5.flush()
+
+    def writeMeasured(self, measured):
+        ##
+        ## STORES WHICH PIXELS OF AN ADAPTIVE SCAN WERE MEASURED (THE REST OF scan_data IS INTERPOLATED).
+        ##
+        if "measured" in self.h5:
+            del self.h5["measured"]
+        self.h5.create_dataset("measured", data=np.asarray(measured, dtype=bool), compression="gzip")
+        self.h5.flush()
+
+    def getMeasured(self):
+        ##
+        ## RETURNS THE MEASURED MASK OF AN ADAPTIVE SCAN, OR None FOR A FULLY MEASURED SCAN.
+        ##
+        return self.h5["measured"][...] if "measured" in self.h5 else None
+
+    def getScanData(self):
+        return self.h5["scan_data"][...]
+
+    def getColumns(self, first, last):
+        ##
+        ## scan_data COLUMNS first..last-1, WITHOUT READING THE REST OF A BIG SCAN.
+        ##
+        return self.h5["scan_data"][first:last]
+
+    def getColumnsDone(self):
+        return self.h5["columns_done"][...]
+
+    def getAxes(self):
+        return self.h5["x_axis"][...], self.h5["y_axis"][...]
+
+    def getSaveData(self):
+        ##
+        ## RETURNS THE SCAN IN THE SAME DICTIONARY FORMAT AS THE .json FILES (scan_data AS AN ARRAY).
+        ##
+        save_data = json.loads(self.h5.attrs["save_data"])
+        x_axis, y_axis = self.getAxes()
+        save_data["x_axis"] = x_axis.tolist()
+        save_data["y_axis"] = y_axis.tolist()
+        save_data["scan_data"] = self.getScanData()
+        if "measured" in self.h5:
+            save_data["measured"] = self.getMeasured()
+        return save_data
+
+    def exportJson(self, path):
+        ##
+        ## WRITES THE SCAN AS A .json FILE (THE OLD FORMAT) FOR EXISTING ANALYSIS SCRIPTS.
+        ##
+        save_data = self.getSaveData()
+        save_data["scan_data"] = save_data["scan_data"].tolist()
+        if "measured" in save_data:
+            save_data["measured"] = save_data["measured"].tolist()
+        with open(path, "w") as file:
+            file.write(json.dumps(save_data, indent=4))
+
+    def close(self):
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,411 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import json
+import time
+import socket
+import struct
+import asyncio
+import threading
+import collections
+import numpy as np
+from ScanCore import ScanCore, ScanSpec
+from HardwareLock import HardwareLock
+
+##
+## WIRE FORMAT. CLIENTS SEND ONE JSON COMMAND PER LINE, e.g. {"command": "move", "x": 0.1, "y": -0.2}.
+## THE SERVER SENDS BINARY FRAMES: A HEADER (1 BYTE TYPE, 4 BYTES PAYLOAD LENGTH, LITTLE-ENDIAN), THEN
+##   JSON     UTF-8 JSON: COMMAND REPLIES ({"reply": ..., "ok": ...}) AND EVENTS ({"event": ...})
+##   COLUMN   frame, x_i, n (3 x uint32), THEN n float32 COUNTS/s: A FINISHED SCAN COLUMN, IN y ORDER
+##   RATE     time (UNIX s), counts/s (2 x float64): THE LATEST COUNT RATE
+##
+FRAME_JSON = 0
+FRAME_COLUMN = 1
+FRAME_RATE = 2
+frame_header = struct.Struct("<BI")
+column_header = struct.Struct("<III")
+rate_payload = struct.Struct("<dd")
+
+
+def encodeFrame(frame_type, payload):
+    return frame_header.pack(frame_type, len(payload)) + payload
+
+
+def decodeFrame(frame_type, payload):
+    ##
+    ## ("json", dict) / ("column", frame, x_i, counts/s array) / ("rate", time, counts/s).
+    ##
+    if frame_type == FRAME_JSON:
+        return ("json", json.loads(payload.decode()))
+    if frame_type == FRAME_COLUMN:
+        frame, x_i, n = column_header.unpack_from(payload)
+        return ("column", frame, x_i, np.frombuffer(payload, dtype="<f4", count=n, offset=column_header.size))
+    if frame_type == FRAME_RATE:
+        return ("rate",) + rate_payload.unpack(payload)
+    raise ValueError(f"Unknown frame type {frame_type}.")
+
+
+class ScanServer:
+    DAQ = None # DAQ dictionary that hosts the hardware.
+    host = "127.0.0.1" # Interface to listen on ("0.0.0.0" for every machine on the network).
+    port = 0 # TCP port (0 picks a free one; the one in use is stored here once started).
+    interrupt_event = None # Stops the clients' scans (only theirs): set by the "interrupt" command and the app's Interrupt button.
+    loop = None # asyncio event loop, run by thread.
+    thread = None # Server thread; all networking & encoding happens here, never on the Tk or scan threads.
+    server = None # asyncio.Server.
+    clients = None # Set of _Client, one per connection.
+    scan_core = None # ScanCore being streamed, or None.
+    hardware_lock = None # HardwareLock shared with the GUI; commands that need the hardware are refused while someone else has it.
+    owner = "client" # What the clients hold hardware_lock as.
+    latest_rate = None # [Scan thread] (time, counts/s) of the latest measurement; sent at most every rate_interval.
+    rate_interval = 0.1 # (s)
+    client_queue_size = 256 # Frames held per client; a client that falls further behind loses the oldest ones.
+    ready = None # threading.Event, set once the server is listening (or failed to).
+    error = None # Why the server couldn't start, or None.
+
+    def __init__(self, DAQ, host="127.0.0.1", port=0, hardware_lock=None):
+        ##
+        ## LETS OTHER PROGRAMS & MACHINES WATCH AND CONTROL THE MICROSCOPE OVER TCP. ANY NUMBER OF CLIENTS CAN
+        ## SUBSCRIBE TO THE FINISHED SCAN COLUMNS AND THE COUNT RATE; EACH HAS ITS OWN QUEUE THAT DROPS ITS
+        ## OLDEST FRAMES WHEN THE CLIENT IS TOO SLOW, SO NOTHING EVER WAITS FOR A CLIENT. COMMANDS:
+        ##   {"command": "subscribe", "streams": ["columns", "rates", "events"]}  (DEFAULT: ALL THREE)
+        ##   {"command": "unsubscribe"}
+        ##   {"command": "status"}
+        ##   {"command": "start", "spec": {ScanSpec.toDict() KEYS}}  (NOT SAVED UNLESS "output" IS GIVEN)
+        ##   {"command": "interrupt"}
+        ##   {"command": "move", "x": V, "y": V}
+        ##   {"command": "counts", "integration_time": ms}
+        ## start, move AND counts TAKE hardware_lock (SHARED WITH THE GUI) AND ARE REFUSED IF SOMEONE ELSE HAS IT;
+        ## A CLIENT'S SCAN HOLDS IT UNTIL THE SCAN IS DONE. interrupt ONLY STOPS A SCAN THAT A CLIENT STARTED.
+        ## THERE IS NO AUTHENTICATION: ONLY LISTEN ON A NETWORK THAT IS TRUSTED.
+        ##
+        self.DAQ = DAQ
+        self.host = host
+        self.port = port
+        self.interrupt_event = threading.Event()
+        self.clients = set()
+        self.hardware_lock = HardwareLock() if hardware_lock is None else hardware_lock
+        self.ready = threading.Event()
+
+    def start(self):
+        ##
+        ## STARTS THE SERVER THREAD AND WAITS UNTIL IT'S LISTENING. RAISES OSError IF IT CAN'T (e.g. PORT IN USE).
+        ##
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def stop(self):
+        ##
+        ## DISCONNECTS EVERY CLIENT AND STOPS THE SERVER THREAD.
+        ##
+        if self.loop is not None and self.thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout=5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+
+    async def shutdown(self):
+        ##
+        ## [Server thread]
+        ##
+        self.server.close()
+        for client in list(self.clients):
+            client.writer.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self):
+        ##
+        ## [Server thread]
+        ##
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.onConnect, self.host, self.port))
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.create_task(self.sendRates())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def interrupt(self):
+        ##
+        ## STOPS THE SCAN A CLIENT STARTED, IF ONE IS RUNNING (THE NEXT ONE CLEARS THE EVENT WHEN IT STARTS).
+        ##
+        self.interrupt_event.set()
+
+    def isScanning(self):
+        return self.scan_core is not None and self.scan_core.isRunning()
+
+    def watch(self, scan_core):
+        ##
+        ## STREAMS scan_core (A SCAN FROM THE GUI OR A CLIENT) TO THE SUBSCRIBERS. CALL BEFORE scan_core.start().
+        ##
+        self.scan_core = scan_core
+        scan_core.listeners.append(lambda message: self.onScanMessage(scan_core, message))
+        spec = scan_core.spec.toDict()
+        self.loop.call_soon_threadsafe(self.broadcast, "events", self.encodeJson({"event": "scan_started", "spec": spec}))
+
+    def onScanMessage(self, scan_core, message):
+        ##
+        ## [Scan thread] HANDS A ScanCore MESSAGE TO THE SERVER THREAD. ONLY RECORDS PIXELS, SO THAT
+        ## PER-PIXEL SCANS DON'T WAKE THE SERVER UP FOR EVERY PIXEL.
+        ##
+        if message[0] == "pixel":
+            self.latest_rate = (time.time(), float(message[3]))
+            return
+        if message[0] == "column":
+            self.latest_rate = (time.time(), float(message[3]))
+        if message[0] in ["column", "column_done", "frame_done", "error", "done"]:
+            try:
+                self.loop.call_soon_threadsafe(self.onScanEvent, scan_core.frame, scan_core, message)
+            except RuntimeError:
+                pass # The server has stopped; the scan carries on without it.
+
+    def onScanEvent(self, frame, scan_core, message):
+        ##
+        ## [Server thread] ENCODES A FINISHED COLUMN / FRAME / THE END OF A SCAN FOR THE SUBSCRIBERS.
+        ##
+        if message[0] in ["column", "column_done"]:
+            column = np.ascontiguousarray(message[2], dtype="<f4")
+            payload = column_header.pack(frame, message[1], len(column)) + column.tobytes()
+            self.broadcast("columns", encodeFrame(FRAME_COLUMN, payload))
+        elif message[0] == "frame_done":
+            self.broadcast("events", self.encodeJson({"event": "frame_done", "frame": message[1]}))
+        elif message[0] == "error":
+            self.broadcast("events", self.encodeJson({"event": "error", "error": str(message[1])}))
+        elif message[0] == "done":
+            self.broadcast("events", self.encodeJson({"event": "scan_done", "interrupted": scan_core.interrupt_event.is_set()}))
+
+    async def sendRates(self):
+        ##
+        ## [Server thread] SENDS THE LATEST COUNT RATE, AT MOST EVERY rate_interval.
+        ##
+        last_sent = None
+        while True:
+            await asyncio.sleep(self.rate_interval)
+            rate = self.latest_rate
+            if rate is not None and rate is not last_sent:
+                last_sent = rate
+                self.broadcast("rates", encodeFrame(FRAME_RATE, rate_payload.pack(*rate)))
+
+    def encodeJson(self, message):
+        return encodeFrame(FRAME_JSON, json.dumps(message, default=float).encode())
+
+    def broadcast(self, stream, data):
+        ##
+        ## [Server thread] QUEUES data FOR EVERY CLIENT SUBSCRIBED TO stream.
+        ##
+        for client in self.clients:
+            if stream in client.streams:
+                client.send(data)
+
+    async def onConnect(self, reader, writer):
+        ##
+        ## [Server thread] ONE CONNECTION: READS COMMANDS UNTIL THE CLIENT HANGS UP.
+        ##
+        client = _Client(writer, self.client_queue_size)
+        self.clients.add(client)
+        sender = asyncio.ensure_future(client.sendLoop())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = {}
+                try:
+                    request = json.loads(line)
+                    reply = await self.runCommand(client, request)
+                except Exception as e:
+                    request = request if isinstance(request, dict) else {}
+                    reply = {"ok": False, "error": str(e)}
+                reply = dict({"reply": request.get("command")}, **reply)
+                if "id" in request:
+                    reply["id"] = request["id"]
+                client.send(self.encodeJson(reply))
+        except (ConnectionError, ValueError, asyncio.CancelledError):
+            pass # Hung up, sent a line longer than the stream's limit, or the server is stopping.
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            writer.close()
+
+    async def runCommand(self, client, request):
+        ##
+        ## [Server thread] RUNS ONE COMMAND. HARDWARE CALLS RUN ON A WORKER THREAD SO THE SERVER NEVER BLOCKS.
+        ##
+        command = request.get("command")
+        if command == "subscribe":
+            client.streams = set(request.get("streams", ["columns", "rates", "events"]))
+            return {"ok": True, "streams": sorted(client.streams)}
+        if command == "unsubscribe":
+            client.streams = set()
+            return {"ok": True}
+        if command == "status":
+            status = {"ok": True, "scanning": self.isScanning(), "hardware_owner": self.hardware_lock.getOwner(),
+                      "clients": len(self.clients), "dropped": client.dropped}
+            if self.isScanning():
+                status["spec"] = self.scan_core.spec.toDict()
+            return status
+        if command == "interrupt":
+            self.interrupt()
+            return {"ok": True}
+        if command not in ["start", "move", "counts"]:
+            return {"ok": False, "error": f"Unknown command {command!r}."}
+
+        if command == "start":
+            if not self.hardware_lock.acquire(self.owner):
+                return self.getBusyReply()
+            try:
+                scan_core = ScanCore(self.DAQ, ScanSpec.fromDict(dict({"output": ""}, **request["spec"])), self.interrupt_event)
+                # The scan keeps the hardware until its worker thread is done with it.
+                scan_core.listeners.append(lambda message: message[0] == "done" and self.hardware_lock.release(self.owner))
+                self.watch(scan_core)
+                scan_core.start()
+            except Exception:
+                self.hardware_lock.release(self.owner)
+                raise
+            return {"ok": True, "x_axis": scan_core.x_axis.tolist(), "y_axis": scan_core.y_axis.tolist()}
+        if command == "move":
+            x, y = float(request["x"]), float(request["y"])
+            voltage_min, voltage_max = self.DAQ["Scanning Mirror"].getVoltageRange()
+            if not (voltage_min <= x <= voltage_max and voltage_min <= y <= voltage_max):
+                return {"ok": False, "error": f"Voltages must be within [{voltage_min}, {voltage_max}] V."}
+            if not self.hardware_lock.acquire(self.owner):
+                return self.getBusyReply()
+            await self.loop.run_in_executor(None, self.useHardware, self.DAQ["Scanning Mirror"].moveTo, x, y)
+            return {"ok": True, "x": x, "y": y}
+        int_time = float(request.get("integration_time", 100)) / 1000
+        if not self.hardware_lock.acquire(self.owner):
+            return self.getBusyReply()
+        rate = await self.loop.run_in_executor(None, self.useHardware, self.DAQ["Photon Counter"].readCounts, int_time)
+        self.latest_rate = (time.time(), float(rate))
+        return {"ok": True, "counts": float(rate)}
+
+    def getBusyReply(self):
+        owner = self.hardware_lock.getOwner()
+        return {"ok": False, "error": f"The hardware is busy ({owner}).", "hardware_owner": owner}
+
+    def useHardware(self, function, *args):
+        ##
+        ## [Worker thread] RUNS A HARDWARE CALL THAT hardware_lock HAS ALREADY BEEN TAKEN FOR, THEN RELEASES IT.
+        ##
+        try:
+            return function(*args)
+        finally:
+            self.hardware_lock.release(self.owner)
+
+
+class _Client:
+    writer = None # asyncio.StreamWriter.
+    streams = None # Set of the streams ("columns", "rates", "events") the client is subscribed to.
+    frames = None # deque of encoded frames waiting to be sent; the oldest fall off when it's full.
+    waiting = None # asyncio.Event, set when there's something in frames.
+    dropped = 0 # Frames this client has lost by being too slow.
+
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.streams = set()
+        self.frames = collections.deque(maxlen=queue_size)
+        self.waiting = asyncio.Event()
+
+    def send(self, data):
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+        self.frames.append(data)
+        self.waiting.set()
+
+    async def sendLoop(self):
+        ##
+        ## [Server thread] WRITES THE QUEUED FRAMES AS FAST AS THE CLIENT TAKES THEM.
+        ##
+        try:
+            while True:
+                await self.waiting.wait()
+                self.waiting.clear()
+                while self.frames:
+                    self.writer.write(self.frames.popleft())
+                    await self.writer.drain()
+        except ConnectionError:
+            pass # onConnect notices the client is gone & cleans up.
+
+
+class ScanClient:
+    sock = None # Connected socket.
+    pushed = None # deque of frames that arrived while waiting for a reply.
+    next_id = 0
+
+    def __init__(self, host="127.0.0.1", port=0, timeout=10):
+        ##
+        ## A SIMPLE (BLOCKING) CLIENT FOR ScanServer, FOR SCRIPTS & TESTS:
+        ##     client = ScanClient("127.0.0.1", 5555)
+        ##     client.command("subscribe", streams=["columns"])
+        ##     client.command("start", spec={...})
+        ##     kind, *data = client.getFrame()
+        ##
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.pushed = collections.deque()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def command(self, command, **arguments):
+        ##
+        ## SENDS A COMMAND AND RETURNS THE REPLY (A DICT). FRAMES PUSHED IN THE MEANTIME ARE KEPT FOR getFrame().
+        ##
+        self.next_id += 1
+        request = dict(arguments, command=command, id=self.next_id)
+        self.sock.sendall((json.dumps(request) + "\n").encode())
+        while True:
+            frame = self.readFrame()
+            if frame[0] == "json" and frame[1].get("id") == self.next_id:
+                return frame[1]
+            self.pushed.append(frame)
+
+    def getFrame(self):
+        ##
+        ## THE NEXT PUSHED FRAME (SEE decodeFrame). RAISES socket.timeout IF NONE ARRIVES IN TIME.
+        ##
+        if self.pushed:
+            return self.pushed.popleft()
+        return self.readFrame()
+
+    def readFrame(self):
+        frame_type, length = frame_header.unpack(self.readExactly(frame_header.size))
+        return decodeFrame(frame_type, self.readExactly(length))
+
+    def readExactly(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("The server closed the connection.")
+            data += chunk
+        return data
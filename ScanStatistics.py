@@ -0,0 +1,114 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import numpy as np
+
+
+class ScanStatistics:
+    n = 0 # Number of values seen so far.
+    minimum = 0 # Running min.
+    maximum = 0 # Running max.
+    mean = 0.0 # Running mean.
+    m2 = 0.0 # Running sum of squared differences from the mean (for the variance).
+    histogram = None # Counts per bin over [0, upper).
+    upper = 0 # Upper edge of the histogram range; doubles whenever a larger value comes in.
+
+    def __init__(self, n_bins=1024, upper=1024):
+        ##
+        ## STREAMING STATISTICS OF THE SCAN DATA: MIN, MAX, MEAN, VARIANCE & A FIXED-BIN HISTOGRAM.
+        ## EVERY UPDATE COSTS O(# NEW VALUES), NO MATTER HOW MUCH DATA HAS ALREADY BEEN SEEN.
+        ## n_bins MUST BE EVEN (BINS ARE MERGED IN PAIRS WHEN THE RANGE GROWS).
+        ##
+        self.histogram = np.zeros(n_bins, dtype=np.int64)
+        self.upper = upper
+
+    def update(self, values):
+        ##
+        ## ADDS A NUMBER OR AN ARRAY OF NUMBERS (e.g. A COLUMN) TO THE STATISTICS.
+        ##
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        batch_n = len(values)
+        batch_mean = values.mean()
+        batch_m2 = ((values - batch_mean)**2).sum()
+        batch_min = values.min()
+        batch_max = values.max()
+
+        # Merge the batch into the running moments (Chan et al. parallel variance).
+        if self.n == 0:
+            self.minimum, self.maximum = batch_min, batch_max
+        else:
+            self.minimum = min(self.minimum, batch_min)
+            self.maximum = max(self.maximum, batch_max)
+        total = self.n + batch_n
+        delta = batch_mean - self.mean
+        self.mean += delta * batch_n / total
+        self.m2 += batch_m2 + delta**2 * self.n * batch_n / total
+        self.n = total
+
+        # Histogram: grow the range by doubling until the batch fits, then bin.
+        while batch_max >= self.upper:
+            self.histogram = np.concatenate((self.histogram[0::2] + self.histogram[1::2],
+                                             np.zeros(len(self.histogram)//2, dtype=np.int64)))
+            self.upper *= 2
+        bins = (np.clip(values, 0, None) * (len(self.histogram) / self.upper)).astype(np.int64)
+        self.histogram += np.bincount(bins, minlength=len(self.histogram))
+
+    def getVariance(self):
+        if self.n < 2:
+            return 0.0
+        return self.m2 / (self.n - 1)
+
+    def getStd(self):
+        return np.sqrt(self.getVariance())
+
+    def getPercentile(self, percent):
+        ##
+        ## RETURNS THE APPROXIMATE percent-TH PERCENTILE FROM THE HISTOGRAM (NO SORTING).
+        ## ACCURATE TO ONE BIN WIDTH (upper / n_bins), AND NEVER OUTSIDE [minimum, maximum].
+        ##
+        if self.n == 0:
+            return 0
+        target = self.n * percent / 100
+        cumulative = np.cumsum(self.histogram)
+        i = min(int(np.searchsorted(cumulative, target)), len(cumulative) - 1)
+        below = cumulative[i-1] if i > 0 else 0
+        in_bin = self.histogram[i]
+        fraction = (target - below) / in_bin if in_bin > 0 else 0
+        width = self.upper / len(self.histogram)
+        return float(np.clip((i + fraction) * width, self.minimum, self.maximum))
+
+    def getLimits(self, clip_percent=0):
+        ##
+        ## RETURNS (min, max) FOR THE COLORBAR. IF clip_percent > 0, CLIPS THAT PERCENTAGE OFF BOTH
+        ## ENDS (e.g. 1 -> 1ST TO 99TH PERCENTILE) SO A FEW HOT PIXELS DON'T WASH OUT THE IMAGE.
+        ##
+        if self.n == 0:
+            return 0, 0
+        if clip_percent <= 0:
+            return self.minimum, self.maximum
+        return self.getPercentile(clip_percent), self.getPercentile(100 - clip_percent)
+
+    def getSummary(self):
+        ##
+        ## RETURNS THE STATISTICS AS A DICTIONARY (FOR SAVING).
+        ##
+        return {
+            "n": int(self.n),
+            "min": float(self.minimum),
+            "max": float(self.maximum),
+            "mean": float(self.mean),
+            "std": float(self.getStd())
+        }
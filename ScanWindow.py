@@ -12,22 +12,33 @@
 
 
 import os
+import copy
 import json
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, StringVar
 from tkinter.filedialog import askdirectory
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.transforms import Bbox
 from datetime import datetime
-from skimage.feature import peak_local_max
+from ScanStatistics import ScanStatistics
+from TileStore import TileStore
+from ImagePyramid import ImagePyramid
+from PeakFitting import getPeakData
+from PeakFinding import StreamingPeakFinder
+from LineShift import LineShift
+from ScanCore import ScanCore, ScanSpec
+from ScanFile import ScanFile
 
 class ScanWindow(tk.Toplevel):
     controlmenu = None # Main App from which this object is instantiated.
     ID = "" # Unique ID for this scan.
     currently_scanning = False
-    scan_data = None # 2D numpy data.
-    datastream = [] # Contains all the data in a flattened list, appended as the scan progresses. For internal use, like min/max.
+    scan_data = None # 2D numpy data (or a TileStore for very large scans).
+    stats = None # ScanStatistics of the data, updated as the scan progresses. For internal use, like min/max.
     xy_range = [0, 0, 0, 0] # x range, y range.
     x_axis = None # X axis array.
     y_axis = None # Y axis array.
@@ -37,12 +48,40 @@ class ScanWindow(tk.Toplevel):
     save_data = {} # Dictionary that records scan & other data.
     fig = None # Matplotlib figure for the scan.
     ax = None # The actual plot.
+    image = None # Persistent imshow artist; updated in place with set_data/set_clim.
+    colorbar = None # Persistent colorbar attached to image.
     widgets = {} # Buttons, labels, entries, etc. relevant to the window.
     cursor_coordinates = [0,0] # Coordinates for the current placement of the clicked cursor.
     colorbar_minmax = [0,0] # Min and max values for the plotting colorbar.
     autoscale = True # True if autoscale; False if user input. For colorbar.
     aspectratio = 1.0
     crosshair = False # True if there is supposed to be a crosshair (i.e. if a crosshair has ever been placed).
+    fast_scan = 0 # 1 if only plotting at the end of the scan.
+    scan_core = None # ScanCore that runs the hardware loop (in its worker thread), until the scan has finished.
+    autosave_path = "" # .h5 file the scan's finished columns are streamed into, and that it's resumed from.
+    checkpoint_band = 256 # Columns read from the autosave at a time when resuming.
+    line_shift = None # LineShift that measures the forward/backward column shift during the scan, or None.
+    line_lag = None # (pixels) Lag the finished columns are being corrected by, or None until it's known.
+    line_lag_tolerance = 0.05 # (pixels) At the end, the scan is re-corrected (from the autosave) if the final lag differs by more.
+    drain_id = None # after() ID of the next drain of scan_core.messages.
+    drain_interval = 50 # (ms) How often the Tk thread drains scan_core.messages.
+    join_timeout = 15 # (s) How long to wait for the worker thread to release the hardware when closing.
+    columns_done = None # Bool per x index: True once the column has been completely measured.
+    save_compression = "gzip" # Compression for .h5 files ("gzip", "lzf" or None).
+    tile_store_threshold = 16000000 # Scans with more pixels than this are kept in a memory-mapped TileStore.
+    pyramid = None # ImagePyramid of scan_data: the plot only draws the visible part, at about screen resolution.
+    zoom_factor = 1.5 # How much one scroll of the mouse wheel zooms the plot in or out.
+    data_version = 0 # Bumped whenever scan_data changes, so that cached peaks of older data aren't reused.
+    peak_finder = None # StreamingPeakFinder while finding peaks live during a scan, or None.
+    live_peaks = None # Scatter artist marking the peaks found so far during a scan.
+    measured = None # Adaptive scans: bool [x][y], True for measured pixels (the rest are interpolated). None otherwise.
+    n_frames = 1 # How many times the scan is repeated (time-lapse).
+    time_lapse = None # TimeLapse that the frames are stored & drift-tracked in, or None for a single scan.
+    timelapse_poll_id = None # after() ID of the next check for drift results.
+    timelapse_poll_interval = 250 # (ms) How often the Tk thread checks for drift results.
+    calibration_thread = None # Worker thread measuring the mirror's settling (with the hardware), or None.
+    calibration_results = None # Queue the calibration thread puts its ("done", times) or ("error", exception) on.
+    calibration_poll_id = None # after() ID of the next check for the calibration result.
 
     def __init__(self, app, DAQ, x_screen, y_screen, *args, **kwargs):
         tk.Toplevel.__init__(self, *args, **kwargs)
@@ -90,11 +129,17 @@ class ScanWindow(tk.Toplevel):
         self.cursor_coordinates = [(self.xy_range[1]+self.xy_range[0])/2, (self.xy_range[3]+self.xy_range[2])/2]
 
         # X and Y voltage axes.
-        self.x_axis = np.linspace(x_start, x_end, int((x_end - x_start) / x_step)+1)
-        self.y_axis = np.linspace(y_start, y_end, int((y_end - y_start) / y_step)+1)
+        self.x_axis = ScanSpec.getAxis(x_start, x_end, x_step)
+        self.y_axis = ScanSpec.getAxis(y_start, y_end, y_step)
 
         # Initialize data array.
-        self.scan_data = np.zeros((len(self.x_axis), len(self.y_axis))) #  Data for plotting and saving.
+        if len(self.x_axis) * len(self.y_axis) > self.tile_store_threshold:
+            # Too big for RAM: keep the scan in fixed-size tiles on disk, with only the band being scanned in RAM.
+            tiles_path = os.path.join(self.getFolder(), "scan_" + self.ID + ".tiles.npy")
+            self.scan_data = TileStore(tiles_path, shape=(len(self.x_axis), len(self.y_axis)))
+        else:
+            self.scan_data = np.zeros((len(self.x_axis), len(self.y_axis))) #  Data for plotting and saving.
+        self.pyramid = ImagePyramid(self.scan_data)
         self.save_data = {
             "integration_time": float(self.controlmenu.widgets["int_time"].get()),
             "x_axis": self.x_axis.tolist(),
@@ -135,6 +180,14 @@ class ScanWindow(tk.Toplevel):
         ent_max.pack(padx=1, pady=1, side=tk.LEFT)
         lbl_colorbar_settings = tk.Label(master=frm_plot_settings, text="colorbar min/max:", padx=1, pady=1)
         btn_autoscale = tk.Button(master=frm_plot_settings, text="Autoscale", command=lambda: self.changePlotSettings(autoscale=True))
+        frm_clip = tk.Frame(master=frm_plot_settings, relief=tk.RAISED, borderwidth=0)
+        lbl_clip = tk.Label(master=frm_clip, text="autoscale clip (%):", padx=1, pady=1)
+        ent_clip = tk.Entry(master=frm_clip, width=5)
+        ent_clip.insert(0, "0") # 0 = min/max; e.g. 1 = 1st to 99th percentile.
+        ent_clip.bind('<Return>', lambda e: self.changePlotSettings(autoscale=True))
+        self.widgets["autoscale_clip"] = ent_clip
+        lbl_clip.pack(padx=1, pady=1, side=tk.LEFT)
+        ent_clip.pack(padx=1, pady=1, side=tk.LEFT)
         self.widgets["colorbar_palette"] = StringVar()
         cbox_colors = ttk.Combobox(master=frm_plot_settings,
                                    textvariable=self.widgets["colorbar_palette"],
@@ -159,6 +212,7 @@ class ScanWindow(tk.Toplevel):
         lbl_colorbar_settings.pack(padx=1, pady=1)
         frm_minmax.pack(padx=1, pady=1)
         btn_autoscale.pack(padx=1, pady=1)
+        frm_clip.pack(padx=1, pady=1)
         cbox_colors.pack(padx=1, pady=1)
         btn_replot.pack(padx=1, pady=1)
         frm_aspect.pack(padx=1, pady=1, side=tk.BOTTOM)
@@ -179,7 +233,15 @@ class ScanWindow(tk.Toplevel):
             font = ('TkDefaultFont', 20)
         )
         self.widgets["counts"] = lbl_counts_measure
+        frm_timelapse = tk.Frame(master=frm_counts, relief=tk.RAISED, borderwidth=0)
+        lbl_timelapse = tk.Label(master=frm_timelapse, text="", padx=1, pady=1)
+        btn_average = tk.Button(master=frm_timelapse, text="Show Average", state="disabled", command=self.onShowAverage)
+        self.widgets["timelapse_status"] = lbl_timelapse
+        self.widgets["timelapse_average_button"] = btn_average
+        lbl_timelapse.pack(padx=1, pady=1)
+        btn_average.pack(padx=1, pady=1)
         lbl_counts.pack(padx=1, pady=1)
+        frm_timelapse.pack(padx=1, pady=1, side=tk.BOTTOM)
         lbl_counts_measure.pack(padx=1, pady=1, side=tk.BOTTOM)
 
         # Cursor widgets frame.
@@ -205,10 +267,13 @@ class ScanWindow(tk.Toplevel):
         btn_cursor_center = tk.Button(master=frm_cursor, text="Center", command=self.moveToCenter)
         self.widgets["cursor_move_button"] = btn_cursor_move
         self.widgets["cursor_center_button"] = btn_cursor_center
+        btn_calibrate = tk.Button(master=frm_cursor, text="Calibrate Settling", command=self.onCalibrateSettling)
+        self.widgets["calibrate_settling_button"] = btn_calibrate
         lbl_cursor_controls.pack(padx=1, pady=1)
         frm_cursor_custom.pack(padx=1, pady=1)
         btn_cursor_move.pack(padx=1, pady=1)
-        btn_cursor_center.pack(padx=1, pady=1, side=tk.BOTTOM)
+        btn_cursor_center.pack(padx=1, pady=1)
+        btn_calibrate.pack(padx=1, pady=1, side=tk.BOTTOM)
 
         # Peak finding frame.
         frm_peakfind = tk.Frame(
@@ -232,6 +297,22 @@ class ScanWindow(tk.Toplevel):
         self.widgets["peak_threshold"] = ent_thresh
         lbl_thresh.pack(padx=1, pady=1, side=tk.LEFT)
         ent_thresh.pack(padx=1, pady=1, side=tk.LEFT)
+        frm_peakfit = tk.Frame(master=frm_peakfind, relief=tk.RAISED, borderwidth=0)
+        lbl_peakfit = tk.Label(master=frm_peakfit, text="sub-pixel fit:", padx=1, pady=1)
+        self.widgets["peak_fit"] = StringVar()
+        # "none": peaks at the grid pixel. "quadratic": fast 3-point estimate. "gaussian": 2D Gaussian fit.
+        cbox_peakfit = ttk.Combobox(master=frm_peakfit,
+                                    textvariable=self.widgets["peak_fit"],
+                                    values=["none", "quadratic", "gaussian"],
+                                    state="readonly",
+                                    width=9)
+        cbox_peakfit.current(0)
+        self.widgets["peak_fit_combobox"] = cbox_peakfit
+        lbl_peakfit.pack(padx=1, pady=1, side=tk.LEFT)
+        cbox_peakfit.pack(padx=1, pady=1, side=tk.LEFT)
+        self.widgets["live_peaks_int"] = tk.IntVar() # 1 to find (and show) peaks while the scan runs.
+        chkbox_livepeaks = tk.Checkbutton(master=frm_peakfind, text="find peaks during scan", variable=self.widgets["live_peaks_int"])
+        self.widgets["live_peaks_checkbox"] = chkbox_livepeaks
         frm_peakbtns = tk.Frame(master=frm_peakfind, relief=tk.RAISED, borderwidth=0)
         btn_findpeaks = tk.Button(master=frm_peakbtns, text="Find Peaks", command=self.plotPeaks)
         btn_savepeaks = tk.Button(master=frm_peakbtns, text="Save Peaks", command=self.onSavePeaks)
@@ -256,6 +337,8 @@ class ScanWindow(tk.Toplevel):
         lbl_peakfind.pack(padx=1, pady=1)
         frm_peaksep.pack(padx=1, pady=1)
         frm_thresh.pack(padx=1, pady=1)
+        frm_peakfit.pack(padx=1, pady=1)
+        chkbox_livepeaks.pack(padx=1, pady=1)
         frm_peakbtns.pack(padx=1, pady=1)
         frm_gopeak.pack(padx=1, pady=1, side=tk.BOTTOM)
 
@@ -277,6 +360,9 @@ class ScanWindow(tk.Toplevel):
         btn_save = tk.Button(master=frm_savebuttons, text="Save", command=self.onSaveScan)
         btn_save.pack(padx=1, pady=1, side=tk.LEFT)
         self.widgets["save_button"] = btn_save
+        self.widgets["export_json_int"] = tk.IntVar() # 1 to also write the (large, slow) .json next to the .h5 file.
+        chkbox_json = tk.Checkbutton(master=frm_savebuttons, text="export .json", variable=self.widgets["export_json_int"])
+        chkbox_json.pack(padx=1, pady=1, side=tk.LEFT)
         frm_savename.pack(padx=1, pady=1)
         frm_savebuttons.pack(padx=1, pady=1)
 
@@ -309,6 +395,8 @@ class ScanWindow(tk.Toplevel):
             dimx /= aspectratio
         else: # Landscape.
             dimy *= aspectratio
+        if self.fig is not None:
+            plt.close(self.fig) # Figure is being remade (e.g. new aspect ratio); free the old one.
         self.fig = plt.figure(figsize = (max(4, dimx), max(2, dimy)))
         canvas = FigureCanvasTkAgg(self.fig, master=frm_plot)
         self.ax = self.fig.add_subplot(111)
@@ -317,7 +405,8 @@ class ScanWindow(tk.Toplevel):
         canvas.draw()
         canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
         self.widgets["plot_clicker"] = None # Callback ID for the mouse clicking matplotlib event.
-        self.plotWithColorbar()
+        canvas.mpl_connect('scroll_event', lambda e: self.onScrollPlot(e))
+        self.plotWithColorbar(rebuild=True)
 
     def generateScanID(self):
         ##
@@ -326,9 +415,13 @@ class ScanWindow(tk.Toplevel):
         now = datetime.now()
         return str(now.year)+str(now.month)+str(now.day)+str(now.hour)+str(now.minute)+str(now.second)
 
-    def takeScan(self):
+    def takeScan(self, resume=False):
         ##
-        ## TAKES A SCAN & VISUALIZES IT ON THE CANVAS.
+        ## STARTS A SCAN. THE HARDWARE LOOP RUNS IN scan_core's WORKER THREAD, WHICH PUTS
+        ## PIXELS/COLUMNS ON scan_core.messages; THE TK SIDE DRAINS THEM (drainScanQueue) AND
+        ## VISUALIZES THE DATA ON THE CANVAS AT ITS OWN RATE.
+        ## WITH resume, CARRIES ON WITH THE SCAN IN autosave_path INSTEAD: THE COLUMNS THAT ARE DONE ARE LOADED,
+        ## AND ONLY THE REST ARE SCANNED, WITH THE SAME AXES, DWELL AND SERPENTINE DIRECTIONS.
         ##
 
         # Disable certain buttons while scan runs.
@@ -340,81 +433,377 @@ class ScanWindow(tk.Toplevel):
         self.disablePeakFindingWidgets()
 
         self.currently_scanning = True
-        self.datastream = []
-        fast_scan = self.controlmenu.widgets["fast_scan_int"].get() # 1 or 0
+        self.stats = ScanStatistics()
+        self.columns_done = np.zeros(len(self.x_axis), dtype=bool)
+        self.peak_finder = None
+        if self.widgets["live_peaks_int"].get() == 1:
+            self.peak_finder = StreamingPeakFinder((len(self.x_axis), len(self.y_axis)), int(self.widgets["peak_min_sep"].get()))
+        self.fast_scan = self.controlmenu.widgets["fast_scan_int"].get() # 1 or 0
+        if resume:
+            spec = ScanSpec.fromCheckpoint(self.autosave_path) # Whatever the control menu says now.
+        else:
+            spec = self.getScanSpec()
+            self.autosave_path = spec.output
+        self.line_shift = None
+        self.line_lag = None
+        if self.controlmenu.widgets["line_shift_int"].get() == 1 and spec.scan_mode != "adaptive":
+            self.line_shift = LineShift(len(self.y_axis))
+        if resume:
+            self.loadCheckpoint()
+        self.n_frames = spec.n_frames
+        self.scan_core = ScanCore(self.DAQ, spec, resume=resume) # With its own interrupt event (see MainApp.interruptScanEvent).
+        self.save_data.update(copy.deepcopy(self.scan_core.save_data))
+
+        if self.controlmenu.server is not None:
+            self.controlmenu.server.watch(self.scan_core) # Remote clients see the scan too.
 
         # Scan start.
-        for x_i in range(len(self.x_axis)):
-            for i in range(len(self.y_axis)):
-                if str(self.controlmenu.widgets["interrupt_button"]["state"]) == "disabled":
-                    # If 'Interrupt' button is pressed, stop scan.
-                    break
-                y_i = 0
-                # Change direction every column.
-                if x_i % 2 == 0: # Even: scan in the forward direction.
-                    y_i = i
-                else: # Odd: scan in the backward direction.
-                    y_i = -(i+1)
-
-                # Coordinates.
-                x = self.x_axis[x_i]
-                y = self.y_axis[y_i]
-                
-                # Take measurement & record data.
-                self.moveScanningMirror(x, y)
-                measurement = self.takeMeasurement()
-
-                self.scan_data[x_i][y_i] = measurement
-                self.datastream.append(measurement)
-
-                # Update UI (i.e. check for mouse activity) only every 3 pixels, to save computation.
-                if y_i % 3 == 0:
-                    if self.autoscale:
-                        self.colorbar_minmax[0] = min(self.datastream)
-                        self.colorbar_minmax[1] = max(self.datastream)
-
-                    self.update()
-                    self.update_idletasks()
+        self.scan_core.start()
+        if resume:
+            self.save_data["resumed"] = copy.deepcopy(self.scan_core.save_data["resumed"])
+            print(f"Resuming at column {self.save_data['resumed'][-1]['column']} of {len(self.x_axis)}.")
+        self.time_lapse = self.scan_core.time_lapse
+        self.drain_id = self.after(self.drain_interval, self.drainScanQueue)
+        if self.time_lapse is not None:
+            self.timelapse_poll_id = self.after(self.timelapse_poll_interval, self.pollTimeLapse)
+
+    def loadCheckpoint(self):
+        ##
+        ## [Tk thread] LOADS THE COLUMNS OF autosave_path THAT ARE ALREADY DONE, BEFORE A RESUMED SCAN CARRIES ON.
+        ##
+        with ScanFile(self.autosave_path) as scan_file:
+            self.columns_done = scan_file.getColumnsDone()
+            for first in range(0, len(self.x_axis), self.checkpoint_band):
+                last = min(first + self.checkpoint_band, len(self.x_axis))
+                columns = scan_file.getColumns(first, last)
+                self.scan_data[first:last] = columns
+                self.stats.update(columns[self.columns_done[first:last]])
+                if self.line_shift is not None:
+                    for x_i in np.flatnonzero(self.columns_done[first:last]) + first:
+                        self.line_shift.add(x_i, columns[x_i - first]) # The autosave holds the raw counts.
+        self.pyramid.markDirty(0, len(self.x_axis) - 1)
+        self.data_version += 1
+        if self.line_shift is not None:
+            self.line_lag = self.line_shift.getLag()
+            if self.line_lag is not None:
+                self.line_shift.correctImage(self.scan_data, self.line_lag, self.columns_done)
+        if self.autoscale and self.stats.n > 0:
+            self.colorbar_minmax = list(self.stats.getLimits(self.getAutoscaleClip()))
+        self.plotWithColorbar()
+
+    def isResumable(self):
+        ##
+        ## TRUE IF THE SCAN WAS CUT SHORT AND CAN BE CARRIED ON WITH takeScan(resume=True).
+        ##
+        return not self.currently_scanning and self.columns_done is not None and not self.columns_done.all() \
+            and self.n_frames == 1 and self.save_data.get("scan_mode") != "adaptive" and os.path.exists(self.autosave_path)
+
+    def getScanSpec(self):
+        ##
+        ## THE SCAN AS SET UP IN THE CONTROL MENU. FINISHED COLUMNS ARE AUTOSAVED TO autosave_<scan ID>.h5
+        ## (AND TIME-LAPSE FRAMES TO timelapse_<scan ID>.h5) IN THE SAVE FOLDER.
+        ##
+        ws = self.controlmenu.widgets
+        folder = self.getFolder()
+        return ScanSpec(self.xy_range[0], self.xy_range[1], self.save_data["x_step"],
+                        self.xy_range[2], self.xy_range[3], self.save_data["y_step"],
+                        float(ws["int_time"].get()),
+                        scan_mode=ws["scan_mode"].get(),
+                        output=os.path.join(folder, "autosave_" + self.ID + ".h5"),
+                        n_frames=int(ws["timelapse_frames"].get()),
+                        time_lapse_output=os.path.join(folder, "timelapse_" + self.ID + ".h5"),
+                        coarse_step=int(ws["adaptive_coarse_step"].get()),
+                        refine_factor=float(ws["adaptive_refine_factor"].get()),
+                        compression=self.save_compression)
+
+    def drainScanQueue(self):
+        ##
+        ## [Tk thread] MOVES EVERYTHING THE WORKER HAS ACQUIRED SO FAR INTO scan_data,
+        ## THEN REFRESHES THE COUNTS INDICATOR AND (IF A COLUMN FINISHED) THE PLOT.
+        ##
+        changed_columns = [] # x indices of the columns completed in this drain.
+        redraw_all = False # True if columns outside changed_columns changed too (e.g. line-shift corrected).
+        new_values = [] # Single pixels from this drain, added to the statistics in one go.
+        scan_finished = False
+        last_measurement = None
+        while True:
+            try:
+                item = self.scan_core.messages.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] == "pixel":
+                _, x_i, y_i, measurement = item
+                self.scan_data[x_i, y_i] = measurement
+                self.pyramid.markDirty(x_i)
+                self.data_version += 1
+                new_values.append(measurement)
+                last_measurement = measurement
+            elif item[0] == "column":
+                _, x_i, column, measurement = item
+                self.scan_data[x_i] = column
+                self.pyramid.markDirty(x_i)
+                self.data_version += 1
+                self.columns_done[x_i] = True
+                self.stats.update(column)
+                last_measurement = measurement
+                changed_columns.append(x_i)
+                if self.line_shift is not None:
+                    redraw_all = self.correctLineShift(x_i) or redraw_all
+            elif item[0] == "column_done":
+                self.columns_done[item[1]] = True
+                changed_columns.append(item[1])
+                if self.line_shift is not None:
+                    redraw_all = self.correctLineShift(item[1]) or redraw_all
+            elif item[0] == "fill":
+                # Interpolated (not measured) pixels: plotted, but kept out of the statistics.
+                _, x_i, column = item
+                self.scan_data[x_i] = column
+                self.pyramid.markDirty(x_i)
+                self.data_version += 1
+                changed_columns.append(x_i)
+            elif item[0] == "adaptive":
+                _, self.measured, summary = item
+                self.save_data["adaptive"].update(summary)
+            elif item[0] == "frame_done":
+                self.widgets["timelapse_status"].config(text=f"frame {item[1]+1}/{self.n_frames} done")
+                if item[1] + 1 < self.n_frames:
+                    # The next frame is scanned over this one.
+                    self.columns_done[:] = False
+                    self.stats = ScanStatistics()
+                    new_values = []
+                    self.resetPeakFinder()
+                    if self.line_shift is not None:
+                        self.line_shift.newFrame() # The lag carries over; the columns are scanned again.
+            elif item[0] == "error":
+                print(f"Scan stopped by an error: {item[1]}")
+            elif item[0] == "done":
+                scan_finished = True
+
+        if last_measurement is not None:
+            self.stats.update(new_values)
+            self.widgets["counts"].config(text=str(int(last_measurement)))
+            if self.autoscale and self.stats.n > 0: # (A new time-lapse frame keeps the last one's limits at first.)
+                self.colorbar_minmax = list(self.stats.getLimits(self.getAutoscaleClip()))
+        if scan_finished:
+            self.finishScan()
+            return
+        if changed_columns and self.fast_scan == 0: # Not a fast scan. Plot after every column.
+            columns = (min(changed_columns), max(changed_columns))
+            if self.updateLivePeaks() or redraw_all:
+                columns = None # Peak markers (or line-shift corrected columns) may have changed outside of these columns.
+            self.plotWithColorbar(columns=columns)
+        elif changed_columns and self.peak_finder is not None:
+            self.peak_finder.update(self.scan_data, self.columns_done)
+        self.drain_id = self.after(self.drain_interval, self.drainScanQueue)
+
+    def correctLineShift(self, x_i):
+        ##
+        ## [Tk thread] ADDS THE FINISHED (RAW) COLUMN x_i TO THE LINE-SHIFT ESTIMATE AND CORRECTS IT. UNTIL THE LAG
+        ## IS KNOWN THE COLUMNS ARE LEFT AS THEY ARE; THEN THEY'RE ALL CORRECTED AT ONCE (AND TRUE IS RETURNED).
+        ##
+        self.line_shift.add(x_i, self.scan_data[x_i])
+        if self.line_lag is not None:
+            self.scan_data[x_i] = LineShift.correct(self.scan_data[x_i], x_i, self.line_lag)
+            return False
+        self.line_lag = self.line_shift.getLag()
+        if self.line_lag is None:
+            return False
+        print(f"Line shift: {self.line_lag:+.2f} pixels.")
+        self.line_shift.correctImage(self.scan_data, self.line_lag, self.columns_done)
+        self.pyramid.markDirty(0, len(self.x_axis) - 1)
+        self.data_version += 1
+        self.resetPeakFinder() # Its local maxima are those of the raw columns.
+        return True
+
+    def finishLineShift(self):
+        ##
+        ## [Tk thread] AT THE END OF THE SCAN, RE-CORRECTS IT IF THE LAG FROM ALL OF ITS COLUMNS DIFFERS FROM THE ONE
+        ## USED DURING THE SCAN, AND RECORDS THE LAG IN save_data. IT STARTS OVER FROM THE RAW COLUMNS IN THE
+        ## AUTOSAVE (OR IN scan_data, IF NOTHING WAS CORRECTED YET), SO THE DATA ISN'T INTERPOLATED TWICE; WITHOUT
+        ## EITHER, THE LAG USED DURING THE SCAN IS KEPT.
+        ##
+        lag = self.line_shift.getLag()
+        if lag is not None and (self.line_lag is None or abs(lag - self.line_lag) > self.line_lag_tolerance):
+            if self.autosave_path and os.path.exists(self.autosave_path):
+                with ScanFile(self.autosave_path) as scan_file:
+                    for first in range(0, len(self.x_axis), self.checkpoint_band):
+                        last = min(first + self.checkpoint_band, len(self.x_axis))
+                        x_indices = np.flatnonzero(self.columns_done[first:last]) + first
+                        if len(x_indices) > 0:
+                            corrected = LineShift.correct(scan_file.getColumns(first, last), np.arange(first, last), lag)
+                            for x_i in x_indices:
+                                self.scan_data[x_i] = corrected[x_i - first]
+            elif self.line_lag is None:
+                self.line_shift.correctImage(self.scan_data, lag, self.columns_done) # Still the raw counts.
             else:
-                # The following block does not execute if the inner loop was broken with 'break'.
-                if fast_scan == 0: # Not a fast scan. Plot after every column.
-                    self.plotWithColorbar() 
-                continue
-            break
-        
-        # Scan end.
-        if fast_scan == 1: # Fast scan. Only plot at the end.
+                print(f"Line shift: the whole scan gives {lag:+.3f} pixels, but without the autosave it can't be re-corrected.")
+                lag = self.line_lag
+            if lag != self.line_lag:
+                self.pyramid.markDirty(0, len(self.x_axis) - 1)
+                self.data_version += 1
+                self.line_lag = lag
+                self.resetPeakFinder() # finishLivePeaks searches the re-corrected scan again.
+        self.save_data["line_shift"] = {
+            "lag_pixels": self.line_lag, # Columns were shifted back by this along their scan direction (None: not measurable).
+            "lag_ms": None if self.line_lag is None else self.line_lag * self.save_data["integration_time"],
+            "n_pairs": self.line_shift.n_pairs
+        }
+        print("Line shift: not enough signal to measure." if self.line_lag is None else f"Line shift: {self.line_lag:+.3f} pixels.")
+
+    def finishScan(self):
+        ##
+        ## [Tk thread] SCAN END: FINAL PLOT & RE-ENABLE THE UI.
+        ##
+        self.drain_id = None
+        self.scan_core = None
+        self.controlmenu.hardware_lock.release("scan window")
+        if self.line_shift is not None:
+            self.finishLineShift()
+            if self.fast_scan == 0:
+                self.plotWithColorbar()
+        if self.fast_scan == 1: # Fast scan. Only plot at the end.
             self.plotWithColorbar()
             
         print("Scan done.")
-        self.moveScanningMirror(0, 0)
         if self.currently_scanning == True: # Scan has ended without pressing the interrupt button.
-            self.controlmenu.interruptScanEvent()
+            self.controlmenu.resetScanInputs()
             # Now self.currently_scanning is also False.
-        self.save_data["scan_data"] = self.scan_data.tolist()
         # Enable buttons.
         self.widgets["cursor_center_button"].configure(state="normal")
         self.widgets["cursor_custom_x"].configure(state="normal")
         self.widgets["cursor_custom_y"].configure(state="normal")
         self.widgets["save_button"].configure(state="normal")
         self.enablePeakFindingWidgets()
+        self.finishLivePeaks()
         # Enable clicking the plot for placing cursor.
         self.connectPlotClicker()
 
-    def plotWithColorbar(self):
+    def pollTimeLapse(self):
+        ##
+        ## [Tk thread] SHOWS & RECORDS THE DRIFT OF EVERY FRAME THE TRACKER HAS FINISHED (IN V, SINCE THE FIRST
+        ## FRAME). ONCE THE TIME-LAPSE FILE IS CLOSED, THE DRIFT-CORRECTED AVERAGE CAN BE SHOWN.
+        ##
+        self.timelapse_poll_id = None
+        time_lapse_data = self.save_data["time_lapse"]
+        for result in self.time_lapse.getResults():
+            if result[0] == "drift":
+                _, frame, step, drift = result
+                drift_x, drift_y = drift[0] * self.save_data["x_step"], drift[1] * self.save_data["y_step"]
+                time_lapse_data["drift_x"].append(float(drift_x))
+                time_lapse_data["drift_y"].append(float(drift_y))
+                print(f"Frame {frame+1}: drift ({drift_x:.5f}, {drift_y:.5f}) V since frame 1.")
+                self.widgets["timelapse_status"].config(text=f"frame {frame+1}/{self.n_frames}, drift: ({drift_x:.4f}, {drift_y:.4f}) V")
+            elif result[0] == "error":
+                print(f"Drift estimation failed for frame {result[1]+1}: {result[2]}")
+            elif result[0] == "closed":
+                if len(time_lapse_data["drift_x"]) > 0:
+                    self.widgets["timelapse_average_button"].configure(state="normal")
+                return
+        self.timelapse_poll_id = self.after(self.timelapse_poll_interval, self.pollTimeLapse)
+
+    def onShowAverage(self):
+        ##
+        ## [Event Handler] REPLACES THE PLOTTED SCAN WITH THE DRIFT-CORRECTED AVERAGE OF THE TIME-LAPSE FRAMES,
+        ## SO THAT IT CAN BE SAVED AND SEARCHED FOR PEAKS LIKE ANY SCAN.
+        ##
+        if self.time_lapse is None or self.currently_scanning:
+            return
+        average = self.time_lapse.getAverage()
+        if self.line_lag is not None:
+            average = LineShift.correct(average, np.arange(len(average)), self.line_lag) # The frames are stored raw.
+        self.scan_data[:] = average
+        self.pyramid.markDirty(0, len(self.x_axis) - 1)
+        self.data_version += 1
+        self.stats = ScanStatistics()
+        self.stats.update(average)
+        self.save_data["time_lapse"]["shown"] = "average"
+        self.widgets["timelapse_average_button"].configure(state="disabled")
+        self.changePlotSettings()
+
+    def stopAcquisition(self):
+        ##
+        ## INTERRUPTS THE WORKER THREAD (IF RUNNING) AND WAITS FOR IT (OR A SETTLING CALIBRATION) TO RELEASE THE HARDWARE.
+        ##
+        if self.drain_id is not None:
+            self.after_cancel(self.drain_id)
+            self.drain_id = None
+        if self.scan_core is not None:
+            self.scan_core.interrupt()
+            self.scan_core.join(timeout=self.join_timeout)
+            self.scan_core = None
+            self.controlmenu.hardware_lock.release("scan window")
+        if self.calibration_thread is not None:
+            # The calibration can't be cut short, but it only takes a few seconds.
+            if self.calibration_poll_id is not None:
+                self.after_cancel(self.calibration_poll_id)
+                self.calibration_poll_id = None
+            self.calibration_thread.join(timeout=self.join_timeout)
+            self.calibration_thread = None
+            self.controlmenu.hardware_lock.release("scan window")
+
+    def plotWithColorbar(self, rebuild=False, columns=None):
+        ## 
+        ## REFRESHES THE PLOT. THE IMAGE & COLORBAR ARE MADE ONCE (rebuildPlot) AND THEN UPDATED IN PLACE.
+        ## IF ONLY THE DATA IN columns = (FIRST, LAST) x INDICES CHANGED, ONLY THAT REGION IS REDRAWN.
+        ## 
+        self.pyramid.refresh()
+        if self.image is None or rebuild:
+            self.rebuildPlot()
+            return
+        palette = self.widgets["colorbar_palette"].get()
+        clim = (self.colorbar_minmax[0], self.colorbar_minmax[1])
+        image, extent = self.getDisplayImage()
+        self.image.set_data(image)
+        self.image.set_extent(extent)
+        if palette != self.image.get_cmap().name or clim != self.image.get_clim():
+            # The colorbar changes too, so the whole canvas has to be drawn (but not remade).
+            self.image.set_cmap(palette)
+            self.image.set_clim(clim)
+            self.canvas.draw()
+        elif columns is None:
+            self.canvas.draw()
+        else:
+            self.blitColumns(columns[0], columns[1])
+
+    def getDisplayImage(self):
+        ##
+        ## RETURNS THE IMAGE TO PLOT (TRANSPOSED FOR imshow) AND ITS extent. ONLY THE PART OF THE SCAN IN VIEW
+        ## IS RETURNED, FROM THE PYRAMID LEVEL WITH ABOUT ONE PIXEL PER SCREEN PIXEL, SO REDRAWING TAKES ABOUT
+        ## THE SAME TIME HOWEVER BIG THE SCAN IS. ZOOMING IN SWITCHES TO FINER LEVELS, DOWN TO THE RAW DATA.
+        ##
+        x_start, x_end, y_start, y_end = self.xy_range
+        n_x, n_y = self.pyramid.shape
+        width = (x_end - x_start) / n_x
+        height = (y_end - y_start) / n_y
+        xlim = sorted(self.ax.get_xlim())
+        ylim = sorted(self.ax.get_ylim())
+        x0 = int(np.clip(np.floor((xlim[0] - x_start) / width), 0, n_x - 1))
+        x1 = int(np.clip(np.ceil((xlim[1] - x_start) / width), x0 + 1, n_x))
+        y0 = int(np.clip(np.floor((ylim[0] - y_start) / height), 0, n_y - 1))
+        y1 = int(np.clip(np.ceil((ylim[1] - y_start) / height), y0 + 1, n_y))
+        image, (x0, x1, y0, y1) = self.pyramid.getRegion(x0, x1, y0, y1, self.ax.bbox.width, self.ax.bbox.height)
+        extent = [x_start + x0*width, x_start + x1*width, y_start + y0*height, y_start + y1*height]
+        return image.T, extent
+
+    def rebuildPlot(self):
         ## 
-        ## REFRESH FIGURE BY CLEARING fig AND REMAKING ax. THEN PLOT.
+        ## REFRESH FIGURE BY CLEARING fig AND REMAKING ax, THE IMAGE AND THE COLORBAR. THEN PLOT.
         ## 
         self.fig.clear()
+        self.live_peaks = None
         self.ax = self.fig.add_subplot(111)
-        plot = self.ax.imshow(self.scan_data.T,
-                            extent=self.xy_range,
+        # Fixed limits (no autoscaling): the image only covers what's in view, and annotations mustn't stretch it.
+        self.ax.set_xlim((self.xy_range[0], self.xy_range[1]))
+        self.ax.set_ylim((self.xy_range[2], self.xy_range[3]))
+        image, extent = self.getDisplayImage()
+        self.image = self.ax.imshow(image,
+                            extent=extent,
                             aspect=self.aspectratio,
                             origin='lower',
                             cmap=self.widgets["colorbar_palette"].get(),
                             vmin=self.colorbar_minmax[0],
                             vmax=self.colorbar_minmax[1])
-        self.fig.colorbar(plot, ax=self.ax)
+        self.colorbar = self.fig.colorbar(self.image, ax=self.ax)
         self.canvas.draw()
         self.canvas.get_tk_widget().pack(expand=True)
 
@@ -422,11 +811,34 @@ class ScanWindow(tk.Toplevel):
         self.update()
         self.update_idletasks()
 
+    def blitColumns(self, first, last):
+        ##
+        ## REDRAWS THE IMAGE (AND THE ANNOTATIONS ON TOP OF IT), BUT ONLY COPIES THE SCREEN REGION
+        ## OF COLUMNS first..last (x INDICES) TO THE CANVAS.
+        ##
+        x_start, x_end, y_start, y_end = self.xy_range
+        width = (x_end - x_start) / len(self.x_axis)
+        corners = self.ax.transData.transform([(x_start + first*width, y_start),
+                                               (x_start + (last+1)*width, y_end)])
+        region = Bbox.from_extents(corners[:, 0].min() - 1, corners[:, 1].min() - 1,
+                                   corners[:, 0].max() + 1, corners[:, 1].max() + 1)
+        region = Bbox.intersection(region, self.ax.bbox)
+        if region is None: # Column is out of view (e.g. zoomed in elsewhere).
+            return
+        self.ax.draw_artist(self.image)
+        for line in self.ax.lines:
+            self.ax.draw_artist(line)
+        if self.live_peaks is not None:
+            self.ax.draw_artist(self.live_peaks)
+        for spine in self.ax.spines.values():
+            self.ax.draw_artist(spine)
+        self.canvas.blit(region)
+
     def onRePlot(self):
         ##
         ## [Event Handler] REMAKES THE PLOT, RESETTING ANNOTATIONS ETC. IF SCAN IS COMPLETE.
         ##
-        self.plotWithColorbar()
+        self.plotWithColorbar(rebuild=True)
         if not self.currently_scanning: # Scan is done; refresh annotations & relevant buttons.
             self.crosshair = False
             # Re-run peaks and re-upload custom coords to do anything with them on this fresh plot.
@@ -436,41 +848,52 @@ class ScanWindow(tk.Toplevel):
     def changePlotSettings(self, autoscale=None, aspectratio=None):
         ##
         ## [Event Handler] MAKES CHANGES TO COLORBAR SETTINGS (MIN/MAX) & REFRESHES PLOT IF NECESSARY.
+        ## THE FIGURE IS ONLY REMADE IF THE ASPECT RATIO ACTUALLY CHANGES.
         ##
         print(self.currently_scanning)
         if autoscale != None:
             self.autoscale = autoscale
-        if aspectratio != None:
-            self.aspectratio = aspectratio
-            self.canvas.get_tk_widget().destroy()
-            # self.canvas.get_tk_widget().delete("all")
-            if self.currently_scanning:
-                self.generatePlotHolder((self.xy_range[3]-self.xy_range[2]) / (self.xy_range[1]-self.xy_range[0]) * self.aspectratio)
 
         if self.autoscale:
             # Autoscale.
-            self.colorbar_minmax[0] = min(self.datastream)
-            self.colorbar_minmax[1] = max(self.datastream)
+            if self.stats is not None:
+                self.colorbar_minmax = list(self.stats.getLimits(self.getAutoscaleClip()))
             print(f"Min/max counts: {self.colorbar_minmax[0]}, {self.colorbar_minmax[1]}")
         else:
             # User min/max.
             self.colorbar_minmax[0] = float(self.widgets["user_min"].get())
             self.colorbar_minmax[1] = float(self.widgets["user_max"].get())
-            
+
+        if aspectratio == None or aspectratio == self.aspectratio:
+            # Colorbar/palette change: update the image in place. Annotations stay where they are.
+            self.plotWithColorbar()
+            return
+
+        # Need to remake figure if user has changed the aspect ratio.
+        # Replot with new settings and replace crosshairs/annotations if they exist.
+        self.aspectratio = aspectratio
+        lines = None
         if not self.currently_scanning:
-            # Only update plot if scan is done. While scan is currently running, the plot gets refreshed often enough.
-            # Replot with new settings and replace crosshairs/annotations if they exist.
             if self.crosshair:
                 self.removeCrosshair()
             lines = self.clearAnnotations()
-            if aspectratio != None: # Need to remake figure if user has changed the aspect ratio.
-                self.generatePlotHolder((self.xy_range[3]-self.xy_range[2]) / (self.xy_range[1]-self.xy_range[0]) * self.aspectratio)
-                self.connectPlotClicker()
-            self.plotWithColorbar()
+        self.canvas.get_tk_widget().destroy()
+        self.generatePlotHolder((self.xy_range[3]-self.xy_range[2]) / (self.xy_range[1]-self.xy_range[0]) * self.aspectratio)
+        if not self.currently_scanning:
+            self.connectPlotClicker()
             self.replotAnnotations(lines)
             if self.crosshair:
                 self.placeCrosshair(self.cursor_coordinates[0], self.cursor_coordinates[1])
 
+    def getAutoscaleClip(self):
+        ##
+        ## RETURNS THE % OF PIXELS TO CLIP OFF EACH END OF THE COLORBAR WHEN AUTOSCALING (0 = MIN/MAX).
+        ##
+        try:
+            return min(max(float(self.widgets["autoscale_clip"].get()), 0), 49)
+        except ValueError:
+            return 0
+
     def connectPlotClicker(self):
         ##
         ## CONNECTS THE MOUSE CLICK EVENT HANDLING CONNECTION TO THE MATPLOTLIB PLOT.
@@ -486,6 +909,30 @@ class ScanWindow(tk.Toplevel):
         cid = self.widgets["plot_clicker"]
         self.canvas.mpl_disconnect(cid)
         
+    def onScrollPlot(self, e):
+        ##
+        ## [Event Handler] ZOOMS THE PLOT IN (SCROLL UP) OR OUT (SCROLL DOWN) AROUND THE MOUSE, WITHIN THE SCAN RANGE.
+        ## THE IMAGE IS THEN REDRAWN FROM THE PYRAMID LEVEL THAT MATCHES THE NEW VIEW. "Re-plot" RESETS THE ZOOM.
+        ##
+        if e.inaxes is not self.ax or e.xdata is None or e.ydata is None:
+            return
+        scale = 1 / self.zoom_factor if e.button == "up" else self.zoom_factor
+        xlim = [e.xdata + (x - e.xdata) * scale for x in self.ax.get_xlim()]
+        ylim = [e.ydata + (y - e.ydata) * scale for y in self.ax.get_ylim()]
+        self.ax.set_xlim(self.clampLimits(xlim, self.xy_range[0], self.xy_range[1]))
+        self.ax.set_ylim(self.clampLimits(ylim, self.xy_range[2], self.xy_range[3]))
+        self.plotWithColorbar()
+
+    def clampLimits(self, limits, start, end):
+        ##
+        ## SHIFTS (low, high) AXIS LIMITS BACK INSIDE [start, end], OR RETURNS [start, end] IF THEY'RE WIDER.
+        ##
+        low, high = limits
+        if high - low >= end - start:
+            return (start, end)
+        shift = max(start - low, 0) + min(end - high, 0)
+        return (low + shift, high + shift)
+
     def onClickingPlot(self, e):
         ##
         ## [Event Handler] Refreshes the crosshair placement at the location of the mouse click.
@@ -504,15 +951,15 @@ class ScanWindow(tk.Toplevel):
             self.removeCrosshair()
             # Remove previous crosshair (if exists) then place the crosshair at the mouse click location.
             self.placeCrosshair(e.xdata, e.ydata)
-            if str(self.widgets["cursor_move_button"]["state"]) == "disabled":
+            if str(self.widgets["cursor_move_button"]["state"]) == "disabled" and not self.controlmenu.client_has_hardware:
                 self.widgets["cursor_move_button"].configure(state="normal")
 
     def placeCrosshair(self, x_coord, y_coord):
         ##
         ## PLACES A CROSSHAIR (MARKER + PREPENDICULAR LINES) ON THE PLOT AT (x_coord, y_coord).
         ##
-        x_coord = round(x_coord, 3)
-        y_coord = round(y_coord, 3)
+        x_coord = round(x_coord, 4)
+        y_coord = round(y_coord, 4)
         self.ax.axhline(y = y_coord, color = 'r', linestyle = '-', linewidth=1)
         self.ax.axvline(x = x_coord, color = 'r', linestyle = '-', linewidth=1)
         self.ax.plot([x_coord], [y_coord], "s", markersize=5.5, markerfacecolor="None", markeredgewidth=1, markeredgecolor="cyan")
@@ -537,17 +984,32 @@ class ScanWindow(tk.Toplevel):
         self.placeCrosshair(x_coord, y_coord)
         self.resetAxes() # Makes things neat again if user enters coordinate outside of data range.
 
+    def useHardware(self, function, *args):
+        ##
+        ## [Tk thread] RUNS A SHORT HARDWARE CALL (A MOVE, A READING...) UNLESS SOMEONE ELSE IS USING THE HARDWARE
+        ## (A SCAN, THE JOB QUEUE OR A REMOTE CLIENT). RETURNS ITS RESULT, OR None IF THE HARDWARE IS BUSY.
+        ##
+        hardware_lock = self.controlmenu.hardware_lock
+        if not hardware_lock.acquire("scan window"):
+            print(f"The hardware is busy ({hardware_lock.getOwner()}).")
+            return None
+        try:
+            return function(*args)
+        finally:
+            hardware_lock.release("scan window")
+
     def takeMeasurement(self):
         ##
         ## TAKES A MEASUREMENT FROM THE PHOTON COUNTER THEN DISPLAYS THE COUNTS.
         ##
         int_time = float(self.controlmenu.widgets["int_time"].get()) / 1000
-        measurement = self.photon_counter.readCounts(integration_time=int_time)
-        self.widgets["counts"].config(text=str(measurement))
+        measurement = self.useHardware(self.photon_counter.readCounts, int_time)
+        if measurement is not None:
+            self.widgets["counts"].config(text=str(measurement))
         return measurement
     
     def moveScanningMirror(self, x_coord, y_coord):
-        self.scanning_mirror.moveTo(x_coord, y_coord)
+        return self.useHardware(self.scanning_mirror.moveTo, x_coord, y_coord)
     
     def moveToCrosshair(self):
         ##
@@ -555,8 +1017,72 @@ class ScanWindow(tk.Toplevel):
         ##
         x_coord = self.cursor_coordinates[0]
         y_coord = self.cursor_coordinates[1]
-        self.moveScanningMirror(x_coord, y_coord)
-        self.takeMeasurement()
+        if self.moveScanningMirror(x_coord, y_coord) is not None:
+            self.takeMeasurement()
+
+    def onCalibrateSettling(self):
+        ##
+        ## [Event Handler] MEASURES HOW LONG THE MIRROR TAKES TO SETTLE AFTER STEPS OF DIFFERENT SIZES, USING THE
+        ## EMITTER UNDER THE CURSOR (PLACE IT ON A BRIGHT SPOT FIRST), AND USES THE RESULT FOR THE NEXT SCANS.
+        ## PRINTS THE "settling" SECTION TO PUT IN HardwareConfig.json TO KEEP IT.
+        ##
+        ## THE MEASUREMENT TAKES A FEW SECONDS, SO IT RUNS IN A WORKER THREAD (HOLDING THE HARDWARE, LIKE A SCAN).
+        ##
+        if self.currently_scanning or self.calibration_thread is not None:
+            print("Can't calibrate the settling while scanning.")
+            return
+        x_coord, y_coord = self.cursor_coordinates[0], self.cursor_coordinates[1]
+        voltage_min, voltage_max = self.scanning_mirror.getVoltageRange()
+        # Jump onto the spot from the side with more room, from one pixel up to the biggest jump the scan can make.
+        direction = 1 if voltage_max - x_coord >= x_coord - voltage_min else -1
+        room = voltage_max - x_coord if direction == 1 else x_coord - voltage_min
+        pixel = abs(self.x_axis[1] - self.x_axis[0]) if len(self.x_axis) > 1 else 0.01
+        largest = max(abs(self.x_axis[-1] - self.x_axis[0]), pixel)
+        steps = np.geomspace(min(pixel, room), min(largest, room), 6)
+        hardware_lock = self.controlmenu.hardware_lock
+        if not hardware_lock.acquire("scan window"):
+            print(f"The hardware is busy ({hardware_lock.getOwner()}).")
+            return
+        print("Calibrating the settling...")
+        self.widgets["calibrate_settling_button"].configure(state="disabled")
+        self.calibration_results = queue.Queue()
+        self.calibration_thread = threading.Thread(target=self.calibrateSettling, args=(x_coord, y_coord, steps, direction), daemon=True)
+        self.calibration_thread.start()
+        self.calibration_poll_id = self.after(self.drain_interval, self.pollCalibration)
+
+    def calibrateSettling(self, x_coord, y_coord, steps, direction):
+        ##
+        ## [Worker thread] RUNS THE CALIBRATION (SEE SettlingModel.calibrate), THEN PUTS THE MIRROR BACK ON THE CURSOR.
+        ##
+        try:
+            times = self.scanning_mirror.settling.calibrate(self.scanning_mirror, self.photon_counter, x_coord, y_coord,
+                                                            steps, direction=direction)
+            self.scanning_mirror.moveTo(x_coord, y_coord)
+            self.calibration_results.put(("done", steps, times))
+        except Exception as e:
+            self.calibration_results.put(("error", e))
+
+    def pollCalibration(self):
+        ##
+        ## [Tk thread] WAITS FOR THE CALIBRATION THREAD, THEN GIVES THE HARDWARE BACK AND PRINTS THE RESULT.
+        ##
+        try:
+            result = self.calibration_results.get_nowait()
+        except queue.Empty:
+            self.calibration_poll_id = self.after(self.drain_interval, self.pollCalibration)
+            return
+        self.calibration_poll_id = None
+        self.calibration_thread.join()
+        self.calibration_thread = None
+        self.controlmenu.hardware_lock.release("scan window")
+        self.widgets["calibrate_settling_button"].configure(state="normal")
+        if result[0] == "error":
+            print(f"Settling calibration failed: {result[1]}")
+            return
+        _, steps, times = result
+        for step, t in zip(steps, times):
+            print(f"step {step:.4f} V: settles in {1000*t:.3f} ms")
+        print("\"settling\": " + json.dumps(self.scanning_mirror.settling.getConfig()))
 
     def moveToCenter(self):
         ##
@@ -566,8 +1092,21 @@ class ScanWindow(tk.Toplevel):
         self.widgets["cursor_custom_y"].delete(0, tk.END)
         self.widgets["cursor_custom_x"].insert(0, "0")
         self.widgets["cursor_custom_y"].insert(0, "0")
-        self.moveScanningMirror(0, 0)
-        self.takeMeasurement()
+        if self.moveScanningMirror(0, 0) is not None:
+            self.takeMeasurement()
+
+    def setHardwareWidgets(self, enabled):
+        ##
+        ## [Tk thread] DISABLES THE BUTTONS THAT MOVE THE MIRROR OR READ THE COUNTER (WHILE A REMOTE CLIENT HAS THE
+        ## HARDWARE), OR PUTS THEM BACK.
+        ##
+        state = "normal" if enabled else "disabled"
+        self.widgets["cursor_center_button"].configure(state=state)
+        self.widgets["calibrate_settling_button"].configure(state=state)
+        self.widgets["cursor_move_button"].configure(state=state if self.crosshair else "disabled")
+        if "peak_finding" in self.save_data:
+            self.widgets["next_peak"].configure(state=state)
+            self.widgets["peak_index"].configure(state=state)
 
     def removeCrosshair(self):
         ##
@@ -625,26 +1164,81 @@ class ScanWindow(tk.Toplevel):
         ##
         ## [Event Handler] FINDS PEAKS IN THE DATA AND PLOTS THEM. Code adapted from Hope Lee.
         ##
+        # Same peaks as skimage's peak_local_max, but searched in tiles & cached (see PeakFinding.py).
+        detected_peaks = self.controlmenu.peak_cache.getPeaks((self.ID, self.data_version), self.scan_data,
+                                                              int(self.widgets["peak_min_sep"].get()),
+                                                              float(self.widgets["peak_threshold"].get()))
+        self.showPeaks(detected_peaks)
+
+    def showPeaks(self, detected_peaks):
+        ##
+        ## PLOTS THE PEAKS AT (x, y) INDICES detected_peaks (SUB-PIXEL FITTED FIRST IF SELECTED), STORES THEM
+        ## IN save_data AND ENABLES THE GO-TO-PEAK & SAVE BUTTONS.
+        ##
         self.removeCrosshair()
         self.clearAnnotations()
-        detected_peaks = peak_local_max(self.scan_data,
-                                        min_distance=int(self.widgets["peak_min_sep"].get()),
-                                        threshold_abs=float(self.widgets["peak_threshold"].get())*np.mean(self.scan_data))
-        peak_x, peak_y = detected_peaks.T # Indices.
-        x_coords = [self.x_axis[i] for i in peak_x]
-        y_coords = [self.y_axis[i] for i in peak_y]
+        peak_x, peak_y = np.asarray(detected_peaks, dtype=int).reshape(-1, 2).T # Indices.
+        # Sub-pixel fitted first if selected (see PeakFitting.py).
+        peak_data = getPeakData(self.scan_data, peak_x, peak_y, self.x_axis, self.y_axis,
+                                self.save_data["x_step"], self.save_data["y_step"], self.widgets["peak_fit"].get())
+        x_coords, y_coords = peak_data["peaks_x_coords"], peak_data["peaks_y_coords"]
         # Swap x and y (since imshow plot is transposed).
         self.ax.plot(x_coords, y_coords, "*", markersize=5.5, markerfacecolor="None", markeredgewidth=1, markeredgecolor="cyan")
         if self.crosshair:
             self.placeCrosshair(self.cursor_coordinates[0], self.cursor_coordinates[1])
         self.canvas.draw()
 
-        peak_data = {'peaks_x_coords': x_coords, 'peaks_y_coords': y_coords}
         self.save_data["peak_finding"] = peak_data
         self.widgets["peak_index"].configure(state="normal")
         self.widgets["next_peak"].configure(state="normal")
         self.widgets["save_peaks"].configure(state="normal")
     
+    def updateLivePeaks(self):
+        ##
+        ## [Tk thread] SEARCHES THE COLUMNS THAT ARE READY FOR PEAKS AND MOVES THE LIVE PEAK MARKERS.
+        ## THE THRESHOLD USES THE MEAN OF THE DATA SO FAR. RETURNS TRUE IF THE MARKERS WERE UPDATED.
+        ##
+        if self.peak_finder is None or not self.peak_finder.update(self.scan_data, self.columns_done):
+            return False
+        peaks = self.peak_finder.getPeaks(float(self.widgets["peak_threshold"].get()) * self.stats.mean)
+        if self.live_peaks is None:
+            self.live_peaks = self.ax.scatter([], [], marker="*", s=5.5**2, facecolors="none", edgecolors="cyan", linewidths=1)
+        self.live_peaks.set_offsets(np.column_stack([self.x_axis[peaks[:, 0]], self.y_axis[peaks[:, 1]]]))
+        return True
+
+    def resetPeakFinder(self):
+        ##
+        ## [Tk thread] STARTS THE LIVE PEAK SEARCH OVER, FOR WHEN COLUMNS THAT WERE ALREADY SEARCHED HAVE CHANGED
+        ## (A NEW TIME-LAPSE FRAME, OR THE LINE SHIFT CORRECTING THE SCAN SO FAR).
+        ##
+        if self.peak_finder is not None:
+            self.peak_finder = StreamingPeakFinder(self.peak_finder.shape, self.peak_finder.min_sep)
+        if self.live_peaks is not None:
+            self.live_peaks.set_offsets(np.zeros((0, 2)))
+
+    def finishLivePeaks(self):
+        ##
+        ## [Tk thread] AT THE END OF A SCAN, FINISHES THE LIVE PEAK SEARCH AND SHOWS THE PEAKS LIKE "Find Peaks"
+        ## WOULD (SAME PEAKS, WITH THE THRESHOLD FROM THE MEAN OF THE WHOLE SCAN), READY TO SAVE OR GO TO.
+        ##
+        if self.live_peaks is not None:
+            self.live_peaks.remove()
+            self.live_peaks = None
+        if self.peak_finder is None:
+            return
+        self.peak_finder.update(self.scan_data, self.columns_done, finish=True)
+        peak_cache = self.controlmenu.peak_cache
+        if self.columns_done.all():
+            # The whole scan has been searched, so "Find Peaks" with the same min. separation doesn't have to redo it.
+            peak_cache.addSearch((self.ID, self.data_version), self.peak_finder, *peak_cache.getMean(self.scan_data))
+            detected_peaks = peak_cache.getPeaks((self.ID, self.data_version), self.scan_data,
+                                                 self.peak_finder.min_sep, float(self.widgets["peak_threshold"].get()))
+        else:
+            mean, _ = peak_cache.getMean(self.scan_data)
+            detected_peaks = self.peak_finder.getPeaks(float(self.widgets["peak_threshold"].get()) * mean)
+        self.showPeaks(detected_peaks)
+        self.peak_finder = None
+
     def resetAxes(self):
         ##
         ## SETS THE PLOT AXES TO THE MIN AND MAX OF THE DATA RANGE
@@ -652,7 +1246,7 @@ class ScanWindow(tk.Toplevel):
         ##
         self.ax.set_xlim((self.xy_range[0], self.xy_range[1]))
         self.ax.set_ylim((self.xy_range[2], self.xy_range[3]))
-        self.canvas.draw()
+        self.plotWithColorbar() # The image may only cover a zoomed-in view.
         # Update the UI... tkinter made me do it :/
         self.update()
         self.update_idletasks()
@@ -663,6 +1257,8 @@ class ScanWindow(tk.Toplevel):
         ##
         self.widgets["peak_min_sep"].configure(state="readonly")
         self.widgets["peak_threshold"].configure(state="readonly")
+        self.widgets["peak_fit_combobox"].configure(state="disabled")
+        self.widgets["live_peaks_checkbox"].configure(state="disabled")
         self.widgets["find_peaks"].configure(state="disabled")
         self.widgets["save_peaks"].configure(state="disabled")
         self.widgets["next_peak"].configure(state="disabled")
@@ -674,6 +1270,8 @@ class ScanWindow(tk.Toplevel):
         ##
         self.widgets["peak_min_sep"].configure(state="normal")
         self.widgets["peak_threshold"].configure(state="normal")
+        self.widgets["peak_fit_combobox"].configure(state="readonly")
+        self.widgets["live_peaks_checkbox"].configure(state="normal")
         self.widgets["find_peaks"].configure(state="normal")
         if "peak_finding" in self.save_data: # If the user has already saved peak data:
             self.widgets["save_peaks"].configure(state="normal")
@@ -687,8 +1285,8 @@ class ScanWindow(tk.Toplevel):
         peaks_x_coords = self.save_data["peak_finding"]["peaks_x_coords"]
         peaks_y_coords = self.save_data["peak_finding"]["peaks_y_coords"]
         real_index = index % len(peaks_x_coords) # Wrap around list if user enters an index out of bounds.
-        x_coord = round(peaks_x_coords[real_index], 3)
-        y_coord = round(peaks_y_coords[real_index], 3)
+        x_coord = round(peaks_x_coords[real_index], 4)
+        y_coord = round(peaks_y_coords[real_index], 4)
         if index != real_index:
             self.widgets["peak_index"].delete(0, tk.END)
             self.widgets["peak_index"].insert(0, str(real_index))
@@ -739,43 +1337,90 @@ class ScanWindow(tk.Toplevel):
         path = os.path.join(self.getFolder(),file_name)
         return path
 
+    def takeSnapshot(self, annotations=False):
+        ##
+        ## COPIES EVERYTHING A SAVE NEEDS (DATA, METADATA & PLOT SETTINGS) SO THAT THE EXPORT WORKER CAN WRITE
+        ## AND RENDER IT IN THE BACKGROUND WITHOUT TOUCHING THE LIVE SCAN OR CANVAS.
+        ## IF annotations IS TRUE, THE PLOTTED LINES (MINUS THE CROSSHAIR) ARE INCLUDED IN THE PLOT.
+        ##
+        save_data = copy.deepcopy(self.save_data)
+        if self.stats is not None:
+            save_data["statistics"] = self.stats.getSummary()
+        lines = []
+        if annotations:
+            annotation_lines = self.ax.lines[:-3] if self.crosshair else self.ax.lines
+            for l in annotation_lines:
+                lines.append({"xdata": np.array(l.get_xdata()),
+                              "ydata": np.array(l.get_ydata()),
+                              "style": {"color": l.get_color(),
+                                        "marker": l.get_marker(),
+                                        "markersize": l.get_markersize(),
+                                        "markerfacecolor": l.get_markerfacecolor(),
+                                        "markeredgewidth": l.get_markeredgewidth(),
+                                        "markeredgecolor": l.get_markeredgecolor(),
+                                        "linestyle": l.get_linestyle()}})
+        return {
+            # A TileStore is too big to copy; it's read in place (nothing writes to it once the scan is over).
+            "scan_data": self.scan_data if isinstance(self.scan_data, TileStore) else np.array(self.scan_data),
+            "columns_done": np.array(self.columns_done),
+            "measured": None if self.measured is None else np.array(self.measured),
+            "x_axis": np.array(self.x_axis),
+            "y_axis": np.array(self.y_axis),
+            "save_data": save_data,
+            "image": np.array(self.image.get_array()),
+            "extent": list(self.image.get_extent()),
+            "aspectratio": self.aspectratio,
+            "palette": self.widgets["colorbar_palette"].get(),
+            "clim": (self.colorbar_minmax[0], self.colorbar_minmax[1]),
+            "figsize": tuple(self.fig.get_size_inches()),
+            "dpi": self.fig.get_dpi(),
+            "xlim": self.ax.get_xlim(),
+            "ylim": self.ax.get_ylim(),
+            "lines": lines
+        }
+
+    def saveData(self, path, snapshot=None):
+        ##
+        ## QUEUES THE SCAN DATA TO BE SAVED AS A .h5 FILE, AND ALSO AS A .json FILE IF "export .json" IS CHECKED.
+        ##
+        if snapshot is None:
+            snapshot = self.takeSnapshot()
+        worker = self.controlmenu.export_worker
+        self.controlmenu.submitExport(path+".h5", worker.writeScanFile, snapshot, path, self.save_compression)
+        if self.widgets["export_json_int"].get() == 1:
+            self.controlmenu.submitExport(path+".json", worker.writeJson, snapshot, path)
+
+    def saveScanFile(self, path):
+        ##
+        ## SAVES SCAN DATA (COUNTS AS int32) AND METADATA IN A .h5 FILE, RIGHT AWAY (NOT IN THE BACKGROUND).
+        ##
+        self.controlmenu.export_worker.writeScanFile(self.takeSnapshot(), path, self.save_compression)
+        print("Data file saved!")
+
     def saveJson(self, path):
         ##
-        ## SAVES SCAN DATA IN JSON FILE.
+        ## SAVES SCAN DATA IN JSON FILE, RIGHT AWAY (NOT IN THE BACKGROUND).
         ##
-        datafile_json = json.dumps(self.save_data, indent=4)
-        with open(path+".json", "w") as file:   
-            file.write(datafile_json)
+        self.controlmenu.export_worker.writeJson(self.takeSnapshot(), path)
         print("Data file saved!")
     
-    def savePlot(self, path, annotations=False):
+    def savePlot(self, path, annotations=False, snapshot=None):
         ##
-        ## SAVES PLOT AS PNG. IF annotations IS FALSE, SAVE A CLEAR PLOT.
+        ## QUEUES THE PLOT TO BE SAVED AS PNG. IF annotations IS FALSE, SAVE A CLEAR PLOT.
+        ## THE PNG IS RENDERED OFF-SCREEN FROM A SNAPSHOT, SO THE PLOT ON SCREEN IS LEFT ALONE.
         ##
-        lines = []
-        if self.crosshair:
-            self.removeCrosshair()
-        if annotations == False:
-            # Remove all annotations.
-            lines = self.clearAnnotations()
-
-        self.fig.savefig(path, dpi='figure')
-        print("Data plot saved!")
-
-        if annotations == False:
-            # Replace annotations.
-            self.replotAnnotations(lines)
-        if self.crosshair:
-            # Replace crosshair.
-            self.placeCrosshair(self.cursor_coordinates[0], self.cursor_coordinates[1])
+        if snapshot is None:
+            snapshot = self.takeSnapshot(annotations)
+        self.controlmenu.submitExport(path, self.controlmenu.export_worker.renderScan, snapshot, path)
 
     def onSaveScan(self):
         ##
         ## [Event Handler] SAVES THE DATA AND PLOT FOR THE SCAN (NO ANNOTATIONS).
         ##
         path = self.getPath()
-        self.saveJson(path)
-        self.savePlot(path)
+        snapshot = self.takeSnapshot()
+        self.saveData(path, snapshot)
+        self.savePlot(path, snapshot=snapshot)
     
     def onSavePeaks(self):
         ##
@@ -783,17 +1428,28 @@ class ScanWindow(tk.Toplevel):
         ##
         data_path = self.getPath()
         plot_path = self.getPath(suffix="_peakfinding")
-        self.saveJson(data_path)
-        self.savePlot(plot_path, annotations=True)
+        snapshot = self.takeSnapshot(annotations=True)
+        self.saveData(data_path, snapshot)
+        self.savePlot(plot_path, snapshot=snapshot)
 
     def onClosing(self):
         ##
         ## [Event Handler] CLOSES SCAN WINDOW & AJUSTS UI.
         ##
+        self.stopAcquisition()
         if self.currently_scanning:
             print("quit while scanning!")
-            self.controlmenu.interruptScanEvent()
+            self.controlmenu.resetScanInputs()
+        if self.timelapse_poll_id is not None:
+            self.after_cancel(self.timelapse_poll_id)
+            self.timelapse_poll_id = None
+        if isinstance(self.scan_data, TileStore):
+            # Saves in progress read the store in place.
+            self.controlmenu.export_worker.waitUntilDone()
+            self.scan_data.close()
         self.controlmenu.widgets["custom_json_button"].configure(state="disabled")
+        if self.isResumable():
+            self.controlmenu.last_autosave = self.autosave_path # 'Resume' can still carry on with it.
         self.controlmenu.scanwindow = None
         self.destroy()
         self.update()
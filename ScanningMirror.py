@@ -11,17 +11,27 @@
 ##############################################################
 
 
+from nidaqmx.constants import AcquisitionType, SampleTimingType
+import numpy as np
+import time
+from SettlingModel import SettlingModel
+
+
 class ScanningMirror():
     analog_task = None
     x_channel = ""
     y_channel = ""
     voltage_range = [] # Default range, but can be overwritten by the instantiation arguments.
+    settling = None # SettlingModel: how long to wait after each move before the mirror is on target.
+    position = None # (x, y) voltages last written, or None if unknown (e.g. after an interrupted waveform).
+    spin_time = 0.002 # (s) Final stretch of a settling wait that is spent spinning instead of sleeping.
 
-    def __init__(self, task, x_channel, y_channel, V_range=[-10, 10]):
+    def __init__(self, task, x_channel, y_channel, V_range=[-10, 10], settling=None):
         self.analog_task = task
         self.x_channel = x_channel
         self.y_channel = y_channel
         self.voltage_range = V_range
+        self.settling = SettlingModel() if settling is None else settling
 
         self.analog_task.ao_channels.add_ao_voltage_chan(self.x_channel)
         self.analog_task.ao_channels.add_ao_voltage_chan(self.y_channel)
@@ -38,5 +48,62 @@ class ScanningMirror():
         ##
         return self.voltage_range[0], self.voltage_range[1]
 
-    def moveTo(self, x_voltage, y_voltage):
-        self.analog_task.write([-x_voltage, y_voltage])
\ No newline at end of file
+    def moveTo(self, x_voltage, y_voltage, settle=True):
+        ##
+        ## MOVES THE MIRROR AND (IF settle) WAITS FOR IT TO SETTLE, FOR AS LONG AS THE SETTLING MODEL
+        ## SAYS A STEP OF THIS SIZE TAKES. RETURNS THE SETTLE TIME (s).
+        ##
+        if self.position is None:
+            settle_time = self.settling.getMaxSettleTime()
+        else:
+            settle_time = float(self.settling.getSettleTime(x_voltage - self.position[0], y_voltage - self.position[1]))
+        self.analog_task.write([-x_voltage, y_voltage])
+        self.position = (x_voltage, y_voltage)
+        if settle and settle_time > 0:
+            self.waitUntil(time.perf_counter() + settle_time)
+        return settle_time
+
+    def waitUntil(self, target_time):
+        ##
+        ## WAITS UNTIL perf_counter() REACHES target_time (SLEEPS, THEN SPINS FOR THE LAST spin_time SECONDS).
+        ##
+        remaining = target_time - time.perf_counter()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < target_time:
+            pass
+
+    def getSampleClockSource(self):
+        ##
+        ## RETURNS THE TERMINAL OF THE ANALOG OUTPUT SAMPLE CLOCK (e.g. "/Dev1/ao/SampleClock"),
+        ## SO THAT OTHER TASKS (i.e. THE PHOTON COUNTER) CAN BE CLOCKED OFF OF THE MIRROR MOVES.
+        ##
+        device = self.x_channel.split("/")[0]
+        return "/" + device + "/ao/SampleClock"
+
+    def loadWaveform(self, x_voltages, y_voltages, rate):
+        ##
+        ## SWITCHES THE TASK TO SAMPLE-CLOCKED OUTPUT AND WRITES THE (x, y) PATH INTO THE BUFFER.
+        ## ONE SAMPLE IS OUTPUT EVERY 1/rate SECONDS ONCE startWaveform() IS CALLED.
+        ##
+        waveform = np.array([-np.asarray(x_voltages, dtype=float), np.asarray(y_voltages, dtype=float)])
+        self.analog_task.stop()
+        self.analog_task.timing.cfg_samp_clk_timing(rate,
+                                                    sample_mode=AcquisitionType.FINITE,
+                                                    samps_per_chan=waveform.shape[1])
+        self.analog_task.write(waveform, auto_start=False)
+        self.position = None # Wherever the waveform leaves it; the next moveTo waits the longest settle time.
+
+    def startWaveform(self):
+        self.analog_task.start()
+
+    def waitUntilDone(self, timeout=10.0):
+        self.analog_task.wait_until_done(timeout=timeout)
+
+    def stopWaveform(self):
+        ##
+        ## STOPS THE WAVEFORM AND RETURNS THE TASK TO ON-DEMAND WRITES (i.e. moveTo).
+        ##
+        self.analog_task.stop()
+        self.analog_task.timing.samp_timing_type = SampleTimingType.ON_DEMAND
+        self.analog_task.start()
\ No newline at end of file
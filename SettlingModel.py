@@ -0,0 +1,131 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import numpy as np
+
+
+class SettlingModel:
+    steps = None # (V) Step sizes, increasing, that settle times are known for.
+    times = None # (s) Settle time after a step of each size.
+    max_dwell_fraction = 0.1 # In hardware-timed scans, moves that need longer than this fraction of a dwell are waited for, in ticks this long.
+    max_rate = 1000000 # (Hz) Fastest sample clock that hardware-timed dwells are split into ticks at.
+
+    def __init__(self, config=None):
+        ##
+        ## HOW LONG THE SCANNING MIRROR TAKES TO SETTLE AFTER A STEP, AS A FUNCTION OF THE STEP SIZE
+        ## (THE LARGER OF THE x AND y STEPS). SETTLE TIMES ARE INTERPOLATED BETWEEN THE CONFIGURED STEPS
+        ## AND HELD AT THE LAST ONE BEYOND THEM. config IS THE "settling" SECTION OF "Scanning Mirror"
+        ## IN HardwareConfig.json, e.g. {"steps_V": [0, 0.1, 1], "times_ms": [0, 0.1, 0.4]}, AS MEASURED BY
+        ## calibrate. WITHOUT ONE, MOVES ARE ASSUMED TO SETTLE INSTANTLY (THE OLD BEHAVIOR).
+        ##
+        config = {} if config is None else config
+        self.steps = np.asarray(config.get("steps_V", [0]), dtype=float)
+        self.times = np.asarray(config.get("times_ms", [0]), dtype=float) / 1000
+        self.max_dwell_fraction = config.get("max_dwell_fraction", 0.1)
+        self.max_rate = config.get("max_rate_Hz", 1000000)
+        if len(self.steps) != len(self.times):
+            raise ValueError("Settling model needs one time per step size.")
+
+    def getConfig(self):
+        ##
+        ## RETURNS THE MODEL IN THE HardwareConfig.json FORMAT.
+        ##
+        return {
+            "steps_V": self.steps.tolist(),
+            "times_ms": (self.times * 1000).tolist(),
+            "max_dwell_fraction": self.max_dwell_fraction,
+            "max_rate_Hz": self.max_rate
+        }
+
+    def getSettleTime(self, dx, dy):
+        ##
+        ## RETURNS THE SETTLE TIME(S) (s) FOR STEP(S) OF (dx, dy) VOLTS. WORKS ON ARRAYS OF STEPS TOO.
+        ##
+        step = np.maximum(np.abs(dx), np.abs(dy))
+        return np.interp(step, self.steps, self.times)
+
+    def getMaxSettleTime(self):
+        ##
+        ## SETTLE TIME FOR THE BIGGEST KNOWN STEP, FOR MOVES FROM AN UNKNOWN POSITION.
+        ##
+        return float(self.times.max())
+
+    def getSettleTicks(self, x_path, y_path, dwell):
+        ##
+        ## FOR A HARDWARE-TIMED PATH (ONE POINT EVERY dwell SECONDS), RETURNS (n_ticks, n_extra): EVERY DWELL IS
+        ## SPLIT INTO n_ticks CLOCK TICKS OF max_dwell_fraction OF A DWELL (OR LONGER, TO STAY UNDER max_rate),
+        ## AND EACH POINT IS HELD FOR n_extra MORE TICKS, WHOSE COUNTS ARE THROWN AWAY, BEFORE IT'S MEASURED.
+        ## SO A MOVE ONLY COSTS ITS SETTLE TIME ROUNDED UP TO A TICK, NOT A WHOLE DWELL. MOVES THAT SETTLE WITHIN
+        ## max_dwell_fraction OF A DWELL AREN'T WAITED FOR; IF NONE NEED IT, n_ticks IS 1 (ONE SAMPLE PER POINT).
+        ##
+        settle = self.getSettleTime(np.diff(x_path, prepend=x_path[0]), np.diff(y_path, prepend=y_path[0]))
+        waits = settle > self.max_dwell_fraction * dwell
+        if not waits.any():
+            return 1, np.zeros(len(settle), dtype=int)
+        n_ticks = int(self.max_rate * dwell)
+        if self.max_dwell_fraction > 0:
+            n_ticks = min(n_ticks, int(np.ceil(1 / self.max_dwell_fraction - 1e-9)))
+        n_ticks = max(n_ticks, 1)
+        n_extra = np.ceil(settle * n_ticks / dwell - 1e-9).astype(int)
+        n_extra[~waits] = 0
+        return n_ticks, n_extra
+
+    def calibrate(self, scanning_mirror, photon_counter, x, y, steps, rate=100000, n_samples=200, n_repeats=200, direction=1):
+        ##
+        ## MEASURES THE SETTLE TIME FOR EACH STEP SIZE IN steps WITH THE MIRROR AIMED AT A BRIGHT SPOT (x, y).
+        ## FOR EACH STEP, A HARDWARE-TIMED WAVEFORM JUMPS n_repeats TIMES FROM (x + step, y) ONTO THE SPOT
+        ## (FROM (x - step, y) IF direction IS -1, e.g. NEAR THE TOP OF THE VOLTAGE RANGE)
+        ## AND HOLDS IT FOR n_samples SAMPLES AT rate (Hz), WITH THE COUNTER LATCHED ON THE SAME CLOCK.
+        ## THE SETTLE TIME IS WHEN THE AVERAGED COUNT RATE REACHES (AND STAYS AT) ITS STEADY VALUE.
+        ## UPDATES THE MODEL AND RETURNS THE MEASURED TIMES (s).
+        ##
+        times = []
+        for step in steps:
+            x_path = np.tile(np.concatenate([np.full(n_samples, x + direction*step), np.full(n_samples, x)]), n_repeats)
+            y_path = np.full(len(x_path), y)
+            x_path, y_path = np.append(x_path, x), np.append(y_path, y) # Close off the last dwell.
+            scanning_mirror.moveTo(x + direction*step, y)
+            scanning_mirror.loadWaveform(x_path, y_path, rate)
+            photon_counter.startBuffered(scanning_mirror.getSampleClockSource(), rate, len(x_path))
+            scanning_mirror.startWaveform()
+            try:
+                cumulative = photon_counter.readBuffered(len(x_path), timeout=len(x_path) / rate + 10)
+            finally:
+                photon_counter.stopBuffered()
+                scanning_mirror.stopWaveform()
+            # Latch i is at the start of sample i, so sample i's counts are latch i+1 - latch i.
+            counts = photon_counter.differenceCounts(cumulative[1:], cumulative[0]).reshape(n_repeats, 2, n_samples)[:, 1]
+            times.append(self.findSettleTime(counts.sum(axis=0), rate))
+        self.steps = np.asarray(steps, dtype=float)
+        self.times = np.maximum.accumulate(np.asarray(times)) # Bigger steps never settle faster.
+        if self.steps[0] > 0:
+            self.steps = np.insert(self.steps, 0, 0)
+            self.times = np.insert(self.times, 0, 0)
+        return times
+
+    def findSettleTime(self, counts, rate, window=5):
+        ##
+        ## counts ARE PHOTONS PER SAMPLE AFTER A JUMP (SUMMED OVER REPEATS). THE STEADY VALUE IS THE MEAN OF
+        ## THE SECOND HALF; THE MIRROR HAS SETTLED FROM THE FIRST SAMPLE AFTER WHICH THE COUNTS (AVERAGED OVER
+        ## window SAMPLES TO BEAT DOWN THE SHOT NOISE) STAY WITHIN 4 SIGMA OF IT.
+        ##
+        counts = np.asarray(counts, dtype=float)
+        half = len(counts) // 2
+        steady = counts[half:].mean()
+        averaged = np.convolve(counts[:half], np.ones(window) / window, mode="valid")
+        tolerance = 4 * np.sqrt(max(steady, 1) / window)
+        outside = np.flatnonzero(np.abs(averaged - steady) > tolerance)
+        if len(outside) == 0:
+            return 0.0
+        # The average over samples i..i+window-1 is off, so the mirror was still moving by sample i+window-1 at the latest.
+        return (outside[-1] + window) / rate
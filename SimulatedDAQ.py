@@ -0,0 +1,381 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import json
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+from scipy.signal import lfilter
+from nidaqmx.constants import SampleTimingType
+
+
+class SimulatedSample:
+    emitters_x = None # X voltages of the Gaussian emitters.
+    emitters_y = None # Y voltages of the Gaussian emitters.
+    amplitudes = None # Peak count rate (counts/s) of every emitter.
+    sigma = 0.03 # Emitter (PSF) width, in volts.
+    background_rate = 0 # Counts/s everywhere on the sample.
+
+    def __init__(self, n_emitters=40, emitter_rate=50000, emitter_sigma=0.03, background_rate=500,
+                 field=[-1, 1, -1, 1], seed=0):
+        ##
+        ## A FIELD OF n_emitters GAUSSIAN EMITTERS SCATTERED RANDOMLY OVER field = [x_min, x_max, y_min, y_max].
+        ##
+        rng = np.random.default_rng(seed)
+        self.emitters_x = rng.uniform(field[0], field[1], n_emitters)
+        self.emitters_y = rng.uniform(field[2], field[3], n_emitters)
+        self.amplitudes = emitter_rate * rng.uniform(0.5, 1.5, n_emitters)
+        self.sigma = emitter_sigma
+        self.background_rate = background_rate
+
+    def getRate(self, x, y):
+        ##
+        ## RETURNS THE (NOISELESS) COUNT RATE AT VOLTAGES (x, y). x AND y CAN BE ARRAYS.
+        ##
+        x = np.asarray(x, dtype=float)[..., np.newaxis]
+        y = np.asarray(y, dtype=float)[..., np.newaxis]
+        r2 = (x - self.emitters_x)**2 + (y - self.emitters_y)**2
+        return self.background_rate + (self.amplitudes * np.exp(-r2 / (2*self.sigma**2))).sum(axis=-1)
+
+
+class ReplaySample:
+    x_axis = None # X axis of the recorded scan.
+    y_axis = None # Y axis of the recorded scan.
+    scan_data = None # Recorded counts/s, indexed [x][y].
+    background_rate = 0 # Counts/s outside the recorded area.
+
+    def __init__(self, path):
+        ##
+        ## A SAMPLE THAT LOOKS LIKE A PREVIOUSLY SAVED SCAN (.json): EVERY POINT GIVES THE COUNT RATE
+        ## OF THE NEAREST RECORDED PIXEL.
+        ##
+        with open(path) as file:
+            save_data = json.load(file)
+        self.x_axis = np.array(save_data["x_axis"])
+        self.y_axis = np.array(save_data["y_axis"])
+        self.scan_data = np.array(save_data["scan_data"], dtype=float)
+        self.background_rate = float(self.scan_data.min())
+
+    def getRate(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        x_i = self.getNearestIndex(self.x_axis, x)
+        y_i = self.getNearestIndex(self.y_axis, y)
+        inside = (x >= self.x_axis.min()) & (x <= self.x_axis.max()) & (y >= self.y_axis.min()) & (y <= self.y_axis.max())
+        return np.where(inside, self.scan_data[x_i, y_i], self.background_rate)
+
+    def getNearestIndex(self, axis, values):
+        if len(axis) == 1:
+            return np.zeros(np.shape(values), dtype=int)
+        step = (axis[-1] - axis[0]) / (len(axis) - 1)
+        return np.clip(np.rint((values - axis[0]) / step), 0, len(axis) - 1).astype(int)
+
+
+class SimulatedRig:
+    sample = None # Something with a getRate(x, y) method, e.g. SimulatedSample.
+    dark_rate = 0 # Detector dark counts/s.
+    settling_tau = 0 # (s) Time constant of the mirror's exponential approach to a new position.
+    task_overhead = 0 # (s) Time that every task start() and stop() takes.
+    write_latency = 0 # (s) Time that an on-demand mirror write takes.
+    read_latency = 0 # (s) Time that an on-demand counter read takes.
+    rng = None
+    lock = None
+    # Mirror state (on-demand): moved from mirror_from towards mirror_target at mirror_time.
+    mirror_from = (0.0, 0.0)
+    mirror_target = (0.0, 0.0)
+    mirror_time = 0.0
+    # Mirror state (sample-clocked): one (x, y) sample per clock tick, starting at waveform_start.
+    waveform = None
+    waveform_rate = 1.0
+    waveform_start = None
+    waveform_from = None # Where the mirror actually is at each clock tick (it may not have settled on the previous sample).
+    # Counter state.
+    counter_total = 0 # Cumulative counts since the counter task was started.
+    counter_time = 0.0 # Time up to which counter_total has been integrated.
+    buffer_index = 0 # Next clock tick to be read from the buffered counter.
+
+    def __init__(self, config=None, sample=None):
+        ##
+        ## SIMULATED HARDWARE: A SAMPLE UNDER A SCANNING MIRROR AND A PHOTON COUNTER, WITH POISSON SHOT NOISE,
+        ## DARK COUNTS, MIRROR SETTLING AND TASK OVERHEAD. config IS THE "Simulation" ENTRY OF HardwareConfig.json.
+        ## counterTask() AND analogTask() RETURN STAND-INS FOR nidaqmx.Task, SO THE REAL PhotonCounter
+        ## AND ScanningMirror CLASSES RUN UNCHANGED ON TOP OF THEM. A sample (e.g. ReplaySample) CAN BE
+        ## GIVEN INSTEAD OF THE RANDOM FIELD OF EMITTERS.
+        ##
+        config = {} if config is None else config
+        self.sample = sample
+        if self.sample is None:
+            self.sample = SimulatedSample(n_emitters=config.get("n_emitters", 40),
+                                          emitter_rate=config.get("emitter_rate", 50000),
+                                          emitter_sigma=config.get("emitter_sigma", 0.03),
+                                          background_rate=config.get("background_rate", 500),
+                                          field=config.get("field", [-1, 1, -1, 1]),
+                                          seed=config.get("seed", 0))
+        self.dark_rate = config.get("dark_rate", 100)
+        self.settling_tau = config.get("settling_tau", 0.0002)
+        self.task_overhead = config.get("task_overhead", 0.002)
+        self.write_latency = config.get("write_latency", 0.0001)
+        self.read_latency = config.get("read_latency", 0.0001)
+        self.rng = np.random.default_rng(config.get("seed", 0))
+        self.lock = threading.RLock()
+        self.mirror_time = time.perf_counter()
+
+    def counterTask(self):
+        return SimulatedCounterTask(self)
+
+    def analogTask(self):
+        return SimulatedAnalogTask(self)
+
+    def getPosition(self, t):
+        ##
+        ## RETURNS THE (x, y) WHERE THE MIRROR IS POINTING AT TIME t.
+        ##
+        if self.waveform_start is not None and t >= self.waveform_start:
+            k = min(int((t - self.waveform_start) * self.waveform_rate), self.waveform.shape[1] - 1)
+            target = self.waveform[:, k]
+            start = self.waveform_from[:, k]
+            t_move = self.waveform_start + k / self.waveform_rate
+        else:
+            target = np.array(self.mirror_target)
+            start = np.array(self.mirror_from)
+            t_move = self.mirror_time
+        return target + (start - target) * self.settlingFactor(t - t_move)
+
+    def settlingFactor(self, dt):
+        ##
+        ## FRACTION OF A STEP THAT THE MIRROR STILL HAS TO TRAVEL, dt SECONDS AFTER THE STEP.
+        ##
+        if self.settling_tau <= 0:
+            return 0.0
+        return np.exp(-np.maximum(dt, 0) / self.settling_tau)
+
+    def startWaveform(self):
+        ##
+        ## STARTS THE WAVEFORM CLOCK NOW. THE MIRROR'S POSITION AT EVERY TICK IS WORKED OUT UP FRONT: EACH
+        ## TICK IT HEADS FOR THE NEW SAMPLE FROM WHEREVER IT GOT TO ON ITS WAY TO THE PREVIOUS ONE.
+        ##
+        now = time.perf_counter()
+        start = self.getPosition(now)
+        f = float(self.settlingFactor(1 / self.waveform_rate))
+        # pos[k] = f*pos[k-1] + (1-f)*waveform[k-1], starting from pos[0] = start.
+        moved = lfilter([1 - f], [1, -f], self.waveform[:, :-1], axis=1, zi=f * start[:, np.newaxis])[0]
+        self.waveform_from = np.concatenate([start[:, np.newaxis], moved], axis=1)
+        self.mirror_from = tuple(start)
+        self.waveform_start = now
+
+    def moveMirror(self, x, y):
+        with self.lock:
+            now = time.perf_counter()
+            self.mirror_from = tuple(self.getPosition(now))
+            self.mirror_target = (x, y)
+            self.mirror_time = now
+
+    def integrateCounts(self, t_a, t_b, n_points=8):
+        ##
+        ## RETURNS A (POISSON) NUMBER OF PHOTONS DETECTED BETWEEN TIMES t_a AND t_b,
+        ## FOLLOWING THE MIRROR ALONG ITS PATH.
+        ##
+        duration = t_b - t_a
+        if duration <= 0:
+            return 0
+        times = t_a + duration * (np.arange(n_points) + 0.5) / n_points
+        positions = np.array([self.getPosition(t) for t in times])
+        mean_rate = self.sample.getRate(positions[:, 0], positions[:, 1]).mean()
+        return int(self.rng.poisson((mean_rate + self.dark_rate) * duration))
+
+    def getIntervalCounts(self, first, n):
+        ##
+        ## RETURNS THE (POISSON) PHOTONS DETECTED IN CLOCK INTERVALS first..first+n-1 OF THE WAVEFORM.
+        ## THE MIRROR IS EVALUATED HALFWAY THROUGH EACH INTERVAL, ON ITS WAY FROM WHERE IT WAS AT THE TICK.
+        ##
+        dt = 1 / self.waveform_rate
+        indices = np.arange(first, first + n)
+        targets = self.waveform[:, indices]
+        starts = self.waveform_from[:, indices]
+        positions = targets + (starts - targets) * self.settlingFactor(dt / 2)
+        rates = self.sample.getRate(positions[0], positions[1]) + self.dark_rate
+        return self.rng.poisson(rates * dt)
+
+    def sleepUntil(self, target_time):
+        remaining = target_time - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+class SimulatedTask:
+    rig = None # SimulatedRig the task belongs to.
+    timing = None # Stand-in for task.timing.
+    running = False
+
+    def __init__(self, rig):
+        self.rig = rig
+        self.timing = SimpleNamespace(samp_timing_type=SampleTimingType.ON_DEMAND, rate=1.0, source="", samps_per_chan=1)
+        self.timing.cfg_samp_clk_timing = self.configureSampleClock
+
+    def configureSampleClock(self, rate, source="", active_edge=None, sample_mode=None, samps_per_chan=1000):
+        self.timing.samp_timing_type = SampleTimingType.SAMPLE_CLOCK
+        self.timing.rate = rate
+        self.timing.source = source
+        self.timing.samps_per_chan = samps_per_chan
+
+    def isSampleClocked(self):
+        return self.timing.samp_timing_type == SampleTimingType.SAMPLE_CLOCK
+
+    def close(self):
+        if self.running:
+            self.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SimulatedCounterTask(SimulatedTask):
+    ci_channels = None
+    armed_time = 0.0 # When a buffered count was started.
+
+    def __init__(self, rig):
+        SimulatedTask.__init__(self, rig)
+        self.ci_channels = SimulatedChannels()
+
+    def start(self):
+        time.sleep(self.rig.task_overhead)
+        rig = self.rig
+        with rig.lock:
+            rig.counter_total = 0 # Like the NI counter, the count restarts from initial_count=0.
+            rig.counter_time = time.perf_counter()
+            rig.buffer_index = 0
+            self.armed_time = rig.counter_time
+        self.running = True
+
+    def stop(self):
+        time.sleep(self.rig.task_overhead)
+        self.running = False
+
+    def read(self, number_of_samples_per_channel=None, timeout=10.0):
+        if number_of_samples_per_channel is None:
+            return self.readOnDemand()
+        return self.readBuffered(number_of_samples_per_channel, timeout)
+
+    def readOnDemand(self):
+        ##
+        ## LATCHES THE COUNT WHEN THE READ IS CALLED, THEN WAITS OUT THE READ LATENCY (THE NI COUNTER IS READ AT
+        ## THE CALL; ONLY GETTING THE VALUE BACK TAKES TIME), SO THE LATENCY DOESN'T INFLATE THE COUNTS.
+        ##
+        rig = self.rig
+        with rig.lock:
+            now = time.perf_counter()
+            rig.counter_total += rig.integrateCounts(rig.counter_time, now)
+            rig.counter_time = now
+            count = rig.counter_total % 2**32
+        time.sleep(rig.read_latency)
+        return count
+
+    def readBuffered(self, n, timeout):
+        ##
+        ## WAITS UNTIL THE MIRROR'S SAMPLE CLOCK HAS TICKED n MORE TIMES, THEN RETURNS THE CUMULATIVE
+        ## COUNT LATCHED AT EACH OF THOSE TICKS.
+        ##
+        rig = self.rig
+        deadline = time.perf_counter() + timeout
+        while rig.waveform_start is None: # Armed, but the mirror's clock hasn't started yet.
+            if time.perf_counter() > deadline:
+                raise TimeoutError("Simulated counter: sample clock never started.")
+            time.sleep(0.001)
+        last_tick = rig.buffer_index + n - 1
+        tick_time = rig.waveform_start + last_tick / rig.waveform_rate
+        if tick_time > deadline:
+            raise TimeoutError("Simulated counter: read timed out.")
+        rig.sleepUntil(tick_time)
+
+        with rig.lock:
+            latched = []
+            first = rig.buffer_index
+            if first == 0:
+                # Tick 0: photons counted while parked, between arming and the first tick.
+                rig.counter_total += rig.integrateCounts(self.armed_time, rig.waveform_start)
+                latched.append(rig.counter_total)
+                first = 1
+            if last_tick >= first:
+                intervals = rig.getIntervalCounts(first - 1, last_tick - first + 1)
+                latched.extend((rig.counter_total + np.cumsum(intervals)).tolist())
+                rig.counter_total = latched[-1]
+            rig.buffer_index = last_tick + 1
+            return [int(c) % 2**32 for c in latched]
+
+
+class SimulatedAnalogTask(SimulatedTask):
+    ao_channels = None
+
+    def __init__(self, rig):
+        SimulatedTask.__init__(self, rig)
+        self.ao_channels = SimulatedChannels()
+
+    def write(self, data, auto_start=True, timeout=10.0):
+        ##
+        ## ScanningMirror WRITES -x TO THE x CHANNEL, SO THE SIGN IS UNDONE HERE TO GET SAMPLE COORDINATES.
+        ##
+        rig = self.rig
+        data = np.asarray(data, dtype=float)
+        if self.isSampleClocked():
+            rig.waveform = np.array([-data[0], data[1]])
+            rig.waveform_rate = self.timing.rate
+            return data.shape[-1]
+        time.sleep(rig.write_latency)
+        rig.moveMirror(-data[0], data[1])
+        return 1
+
+    def start(self):
+        time.sleep(self.rig.task_overhead)
+        rig = self.rig
+        if self.isSampleClocked() and rig.waveform is not None:
+            with rig.lock:
+                rig.startWaveform()
+        self.running = True
+
+    def stop(self):
+        rig = self.rig
+        if rig.waveform_start is not None:
+            # Park the mirror wherever the waveform got to.
+            with rig.lock:
+                now = time.perf_counter()
+                k = min(int((now - rig.waveform_start) * rig.waveform_rate), rig.waveform.shape[1] - 1)
+                rig.mirror_from = tuple(rig.getPosition(now))
+                rig.mirror_target = tuple(rig.waveform[:, k])
+                rig.mirror_time = now
+                rig.waveform_start = None
+        time.sleep(rig.task_overhead)
+        self.running = False
+
+    def wait_until_done(self, timeout=10.0):
+        rig = self.rig
+        if rig.waveform_start is None:
+            return
+        end_time = rig.waveform_start + rig.waveform.shape[1] / rig.waveform_rate
+        if end_time - time.perf_counter() > timeout:
+            raise TimeoutError("Simulated mirror: waveform did not finish in time.")
+        rig.sleepUntil(end_time)
+
+
+class SimulatedChannels(list):
+    ##
+    ## STAND-IN FOR task.ci_channels / task.ao_channels.
+    ##
+    def add_ci_count_edges_chan(self, counter, **kwargs):
+        self.append(SimpleNamespace(name=counter, ci_count_edges_term=""))
+
+    def add_ao_voltage_chan(self, physical_channel, **kwargs):
+        self.append(SimpleNamespace(name=physical_channel))
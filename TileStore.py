@@ -0,0 +1,162 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import numpy as np
+
+
+class TileStore:
+    path = "" # Path of the backing .npy file.
+    shape = (0, 0) # (# x pixels, # y pixels) of the scan.
+    tile = 256 # Tiles are tile x tile pixels.
+    tiles = None # Memory-mapped array [tile x index][tile y index][x][y].
+    band = None # In-RAM copy of one band of tile columns (tile x # y pixels); the working set.
+    band_index = None # Which tile column band is in RAM.
+    band_dirty = False # True if band has changes that aren't in the memory map yet.
+    dtype = np.float32
+
+    def __init__(self, path, shape=None, tile=256, dtype=np.float32):
+        ##
+        ## 2D SCAN DATA BACKED BY A MEMORY-MAPPED .npy FILE OF FIXED-SIZE TILES, FOR SCANS TOO BIG FOR RAM.
+        ## IF shape IS GIVEN, A NEW (ZEROED) STORE IS CREATED AT path; OTHERWISE AN EXISTING ONE IS OPENED.
+        ## ONLY ONE BAND OF tile COLUMNS IS KEPT IN RAM (WHERE THE SCAN IS WRITING); IT IS WRITTEN TO THE
+        ## FILE AS SOON AS THE SCAN MOVES ON TO THE NEXT BAND. READS ONLY TOUCH THE TILES THEY OVERLAP.
+        ## INDEXED LIKE THE scan_data ARRAY: store[x_i] = column, store[x_i, y_i] = value, store[x0:x1].
+        ##
+        self.path = path
+        if shape is not None:
+            self.shape = (int(shape[0]), int(shape[1]))
+            self.tile = tile
+            self.dtype = dtype
+            n_tiles = (-(-self.shape[0] // tile), -(-self.shape[1] // tile)) # Ceiling division.
+            self.tiles = np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                                   shape=(n_tiles[0], n_tiles[1], tile, tile))
+            self.writeHeader()
+        else:
+            self.tiles = np.lib.format.open_memmap(path, mode="r+")
+            self.tile = self.tiles.shape[2]
+            self.dtype = self.tiles.dtype
+            self.readHeader()
+
+    def writeHeader(self):
+        ##
+        ## THE TRUE (UNPADDED) SHAPE IS KEPT IN A SMALL SIDECAR FILE NEXT TO THE TILES.
+        ##
+        np.save(self.path + ".shape.npy", np.array(self.shape))
+
+    def readHeader(self):
+        self.shape = tuple(int(n) for n in np.load(self.path + ".shape.npy"))
+
+    def loadBand(self, band_index):
+        ##
+        ## MAKES band_index THE BAND IN RAM, WRITING THE PREVIOUS ONE TO THE FILE FIRST.
+        ##
+        if band_index == self.band_index:
+            return
+        self.flush()
+        # tiles[b] is [tile y index][x][y]; lay it out as [x][y] over the full (padded) y range.
+        self.band = np.array(self.tiles[band_index].transpose(1, 0, 2).reshape(self.tile, -1))
+        self.band_index = band_index
+
+    def flush(self):
+        ##
+        ## WRITES THE BAND IN RAM TO THE MEMORY MAP AND THE MEMORY MAP TO DISK.
+        ##
+        if self.band_dirty:
+            n_tiles_y = self.tiles.shape[1]
+            self.tiles[self.band_index] = self.band.reshape(self.tile, n_tiles_y, self.tile).transpose(1, 0, 2)
+            self.tiles.flush()
+            self.band_dirty = False
+
+    def toRange(self, index, n):
+        ##
+        ## TURNS AN int OR slice (STEP 1) INTO (start, stop).
+        ##
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            if step != 1:
+                raise IndexError("TileStore only supports slices with step 1.")
+            return start, max(start, stop)
+        index = int(index)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError(f"Index {index} out of range for size {n}.")
+        return index, index + 1
+
+    def splitKey(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        x_key, y_key = key
+        return x_key, y_key, self.toRange(x_key, self.shape[0]), self.toRange(y_key, self.shape[1])
+
+    def __setitem__(self, key, values):
+        x_key, y_key, (x0, x1), (y0, y1) = self.splitKey(key)
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), (x1 - x0, y1 - y0))
+        for x in range(x0, x1):
+            self.loadBand(x // self.tile)
+            self.band[x % self.tile, y0:y1] = values[x - x0]
+            self.band_dirty = True
+
+    def __getitem__(self, key):
+        x_key, y_key, (x0, x1), (y0, y1) = self.splitKey(key)
+        region = self.read(x0, x1, y0, y1)
+        # Drop the dimensions that were indexed with an int, like numpy does.
+        if not isinstance(y_key, slice):
+            region = region[:, 0]
+        if not isinstance(x_key, slice):
+            region = region[0]
+        return region
+
+    def read(self, x0, x1, y0, y1, step=1):
+        ##
+        ## RETURNS pixels [x0:x1:step, y0:y1:step] AS AN ARRAY, ONLY TOUCHING THE TILES THAT OVERLAP THEM.
+        ##
+        t = self.tile
+        xs = np.arange(x0, x1, step)
+        ys = np.arange(y0, y1, step)
+        region = np.zeros((len(xs), len(ys)), dtype=self.dtype)
+        for tx in range(x0 // t, (x1 - 1) // t + 1 if x1 > x0 else 0):
+            in_x = (xs >= tx*t) & (xs < (tx+1)*t)
+            if not in_x.any():
+                continue
+            if tx == self.band_index: # Newest data for this band is in RAM.
+                region[in_x] = self.band[xs[in_x] - tx*t][:, ys]
+                continue
+            for ty in range(y0 // t, (y1 - 1) // t + 1 if y1 > y0 else 0):
+                in_y = (ys >= ty*t) & (ys < (ty+1)*t)
+                if not in_y.any():
+                    continue
+                block = self.tiles[tx, ty][xs[in_x] - tx*t][:, ys[in_y] - ty*t]
+                region[np.ix_(in_x, in_y)] = block
+        return region
+
+    def getDisplayImage(self, max_size=2000):
+        ##
+        ## RETURNS A DECIMATED COPY OF THE WHOLE SCAN, AT MOST max_size PIXELS ON A SIDE, FOR PLOTTING.
+        ##
+        step = max(1, -(-max(self.shape) // max_size))
+        return self.read(0, self.shape[0], 0, self.shape[1], step=step)
+
+    def __array__(self, dtype=None, copy=None):
+        ##
+        ## np.asarray(store) LOADS THE WHOLE SCAN INTO RAM; ONLY FOR THINGS THAT NEED ALL OF IT AT ONCE.
+        ##
+        data = self.read(0, self.shape[0], 0, self.shape[1])
+        return data if dtype is None else data.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        self.flush()
+        self.tiles = None
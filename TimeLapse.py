@@ -0,0 +1,184 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+
+import json
+import time
+import queue
+import threading
+import h5py
+import numpy as np
+from scipy import ndimage
+
+
+class TimeLapse:
+    path = "" # Path of the .h5 file that the frames are stored in.
+    h5 = None # Open h5py.File.
+    shape = (0, 0) # (# x pixels, # y pixels) of a frame.
+    current = None # [Worker thread] The frame being scanned, [x][y].
+    jobs = None # Queue of (frame index, frame) waiting for drift estimation; None closes the file.
+    results = None # Queue of ("drift", frame index, step, drift) / ("error", frame index, error) / ("closed",) for the Tk side.
+    thread = None # Drift tracker thread.
+    previous = None # [Tracker thread] Last frame seen, which the next one is compared to.
+    drift = None # (dx, dy) pixels the latest frame has moved by since the first one.
+    average_sum = None # Sum of the frames, each shifted back by its drift.
+    average_weight = None # How many frames cover each pixel of average_sum (frames shifted in from outside don't).
+    lock = None # Guards the average, which the Tk side reads while the tracker adds to it.
+    regularization = 0.01 # Phase correlation divides by |spectrum| + this x its max, so frequencies that are only noise aren't blown up.
+    format_version = 1
+
+    def __init__(self, path, x_axis, y_axis, save_data, compression="gzip"):
+        ##
+        ## RECORDS A TIME-LAPSE: THE SAME RASTER SCANNED OVER AND OVER INTO A STACK OF FRAMES ON DISK, WRITTEN
+        ## COLUMN BY COLUMN AS THEY ARE SCANNED. EACH FINISHED FRAME IS COMPARED TO THE ONE BEFORE IT BY FFT PHASE
+        ## CORRELATION IN A BACKGROUND THREAD, GIVING THE SAMPLE DRIFT, AND ADDED TO A DRIFT-CORRECTED AVERAGE.
+        ##
+        ## LAYOUT OF THE .h5 FILE:
+        ##   frames       int32 [frame][x][y], counts/s, ONE (COMPRESSED) CHUNK PER COLUMN.
+        ##   frames_done  bool [frame], TRUE ONCE A FRAME IS COMPLETELY ON DISK.
+        ##   frame_times  float [frame], WHEN EACH FRAME STARTED (UNIX TIME, s).
+        ##   drift        float [frame][2], (dx, dy) IN PIXELS SINCE THE FIRST FRAME (NaN UNTIL ESTIMATED).
+        ##   average      float32 [x][y], THE DRIFT-CORRECTED AVERAGE (WRITTEN WHEN THE TIME-LAPSE ENDS).
+        ##   x_axis, y_axis, attrs["save_data"] (JSON)
+        ##
+        self.path = path
+        self.shape = (len(x_axis), len(y_axis))
+        n_x, n_y = self.shape
+        self.h5 = h5py.File(path, "w")
+        self.h5.attrs["format_version"] = self.format_version
+        self.h5.attrs["save_data"] = json.dumps({k: v for k, v in save_data.items() if k not in ["x_axis", "y_axis"]}, default=float)
+        self.h5.create_dataset("frames", shape=(0, n_x, n_y), maxshape=(None, n_x, n_y), dtype=np.int32,
+                               chunks=(1, 1, n_y), compression=compression, fillvalue=0)
+        self.h5["frames"].attrs["units"] = "counts/s"
+        self.h5.create_dataset("frames_done", shape=(0,), maxshape=(None,), dtype=bool, fillvalue=False)
+        self.h5.create_dataset("frame_times", shape=(0,), maxshape=(None,), dtype=float)
+        self.h5.create_dataset("drift", shape=(0, 2), maxshape=(None, 2), dtype=float, fillvalue=np.nan)
+        self.h5.create_dataset("x_axis", data=np.asarray(x_axis, dtype=float))
+        self.h5.create_dataset("y_axis", data=np.asarray(y_axis, dtype=float))
+        self.h5.flush()
+        self.current = np.zeros(self.shape, dtype=np.float32)
+        self.drift = np.zeros(2)
+        self.average_sum = np.zeros(self.shape)
+        self.average_weight = np.zeros(self.shape)
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def startFrame(self, frame):
+        ##
+        ## [Worker thread] ADDS FRAME # frame TO THE STACK.
+        ##
+        for name in ["frames", "frames_done", "frame_times", "drift"]:
+            self.h5[name].resize(frame + 1, axis=0)
+        self.h5["frame_times"][frame] = time.time()
+        self.current[:] = 0
+
+    def writeColumn(self, frame, x_i, column):
+        ##
+        ## [Worker thread] WRITES ONE FINISHED COLUMN OF FRAME # frame AND FLUSHES, SO IT SURVIVES A CRASH.
+        ##
+        self.current[x_i] = column
+        self.h5["frames"][frame, x_i] = np.clip(np.rint(column), np.iinfo(np.int32).min, np.iinfo(np.int32).max).astype(np.int32)
+        self.h5.flush()
+
+    def finishFrame(self, frame):
+        ##
+        ## [Worker thread] MARKS FRAME # frame AS COMPLETE AND QUEUES IT FOR DRIFT ESTIMATION.
+        ##
+        self.h5["frames_done"][frame] = True
+        self.h5.flush()
+        self.jobs.put((frame, self.current.copy()))
+
+    def close(self):
+        ##
+        ## NO MORE FRAMES. THE TRACKER FINISHES THE ONES IT HAS, WRITES THE AVERAGE AND CLOSES THE FILE.
+        ##
+        self.jobs.put(None)
+
+    def run(self):
+        ##
+        ## [Tracker thread] ESTIMATES EACH FRAME'S DRIFT & ADDS IT TO THE AVERAGE, UNTIL close().
+        ##
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.h5.create_dataset("average", data=self.getAverage().astype(np.float32))
+                self.h5.close()
+                self.results.put(("closed",))
+                return
+            frame_index, frame = job
+            try:
+                step = np.zeros(2) if self.previous is None else np.asarray(self.getShift(self.previous, frame))
+                self.drift = self.drift + step
+                self.h5["drift"][frame_index] = self.drift
+                self.h5.flush()
+                self.addToAverage(frame, self.drift)
+                self.results.put(("drift", frame_index, step, self.drift.copy()))
+            except Exception as e:
+                self.results.put(("error", frame_index, e))
+            self.previous = frame
+
+    def getResults(self):
+        ##
+        ## RETURNS (AND CLEARS) THE TRACKER'S RESULTS SINCE THE LAST CALL.
+        ##
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def getShift(self, reference, frame):
+        ##
+        ## (dx, dy) PIXELS THAT frame IS SHIFTED BY RELATIVE TO reference, BY PHASE CORRELATION: THE PEAK OF THE
+        ## INVERSE FFT OF THE (REGULARIZED) NORMALIZED CROSS-POWER SPECTRUM, REFINED TO SUB-PIXEL BY A PARABOLA
+        ## THROUGH IT. BOTH FRAMES ARE WINDOWED FIRST SO THAT THEIR EDGES DON'T LOOK LIKE A FEATURE THAT NEVER MOVES.
+        ##
+        window = np.outer(np.hanning(self.shape[0]), np.hanning(self.shape[1]))
+        a = np.fft.rfft2((reference - reference.mean()) * window)
+        b = np.fft.rfft2((frame - frame.mean()) * window)
+        cross = b * np.conj(a)
+        magnitude = np.abs(cross)
+        correlation = np.fft.irfft2(cross / (magnitude + self.regularization * magnitude.max() + 1e-30), s=self.shape)
+        peak = np.unravel_index(np.argmax(correlation), self.shape)
+        shift = []
+        for axis in range(2):
+            n = self.shape[axis]
+            before, after = list(peak), list(peak)
+            before[axis] = (peak[axis] - 1) % n
+            after[axis] = (peak[axis] + 1) % n
+            left, center, right = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+            curvature = left - 2*center + right
+            offset = 0.5 * (left - right) / curvature if n > 2 and curvature < 0 else 0.0
+            position = peak[axis] + offset
+            shift.append(position - n if position > n / 2 else position) # Shifts past half the frame are negative.
+        return tuple(shift)
+
+    def addToAverage(self, frame, drift):
+        ##
+        ## [Tracker thread] SHIFTS frame BACK BY drift AND ADDS IT TO THE AVERAGE.
+        ##
+        shifted = ndimage.shift(frame.astype(float), -drift, order=1, mode="constant", cval=0)
+        weight = ndimage.shift(np.ones(self.shape), -drift, order=1, mode="constant", cval=0)
+        with self.lock:
+            self.average_sum += shifted
+            self.average_weight += weight
+
+    def getAverage(self):
+        ##
+        ## THE DRIFT-CORRECTED AVERAGE OF THE FRAMES SO FAR (0 WHERE NO FRAME COVERS THE PIXEL).
+        ##
+        with self.lock:
+            return np.where(self.average_weight > 1e-6, self.average_sum / np.maximum(self.average_weight, 1e-6), 0)
@@ -0,0 +1,278 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## SCAN THROUGHPUT & UI LATENCY BENCHMARKS, RUN ON THE SIMULATED DAQ.
+## DRIVES THE REAL MainApp/ScanWindow/PopoutPlot CODE, SO IT NEEDS A DISPLAY; ON A HEADLESS
+## MACHINE RUN IT UNDER A VIRTUAL ONE, e.g.:
+##     xvfb-run python benchmark.py --sizes 50 100 200 --dwells 0.1 1 --output bench.json
+##     xvfb-run python benchmark.py --replay old_scan.json
+## RESULTS ARE WRITTEN AS JSON SO THEY CAN BE COMPARED BETWEEN COMMITS.
+##
+
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import tkinter as tk
+import numpy as np
+from PhotonCounter import *
+from ScanningMirror import *
+from SimulatedDAQ import SimulatedRig, ReplaySample
+from MainApp import *
+
+
+class Stopwatch:
+    totals = {} # Category -> seconds spent in wrapped calls.
+    calls = {} # Category -> number of wrapped calls.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.calls = {}
+
+    def wrap(self, obj, name, category):
+        ##
+        ## REPLACES obj.name WITH A VERSION THAT ADDS ITS RUN TIME TO category.
+        ##
+        method = getattr(obj, name)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.totals[category] = self.totals.get(category, 0) + time.perf_counter() - start
+                self.calls[category] = self.calls.get(category, 0) + 1
+        setattr(obj, name, timed)
+
+    def get(self, category):
+        return self.totals.get(category, 0), self.calls.get(category, 0)
+
+
+def makeApp(config, sample=None):
+    ##
+    ## BUILDS THE APP ON A SIMULATED RIG AND HIDES THE CONTROL MENU.
+    ##
+    rig = SimulatedRig(config, sample)
+    DAQ = {
+        "Photon Counter": PhotonCounter(rig.counterTask(), "Dev1/ctr0", "PFI0"),
+        "Scanning Mirror": ScanningMirror(rig.analogTask(), "Dev1/ao0", "Dev1/ao1", V_range=[-10, 10])
+    }
+    DAQ["Scanning Mirror"].start()
+    app = MainApp(DAQ)
+    app.withdraw()
+    return app
+
+
+def setEntry(entry, value):
+    entry.config(state="normal")
+    entry.delete(0, tk.END)
+    entry.insert(0, str(value))
+
+
+def setScanParameters(app, x_axis, y_axis, dwell_ms, mode, fast_scan, folder):
+    ##
+    ## FILLS IN THE CONTROL MENU AS A USER WOULD.
+    ##
+    ws = app.widgets
+    for axis, name in [(x_axis, "x"), (y_axis, "y")]:
+        # Shave a hair off the step so that int((end - start) / step) + 1 doesn't round down a pixel.
+        step = (axis[-1] - axis[0]) / max(len(axis) - 1, 1) * (1 - 1e-9)
+        setEntry(ws[name+"_start"], axis[0])
+        setEntry(ws[name+"_end"], axis[-1])
+        setEntry(ws[name+"_step"], step)
+    setEntry(ws["int_time"], dwell_ms)
+    ws["scan_mode"].set(mode)
+    ws["fast_scan_int"].set(1 if fast_scan else 0)
+    ws["folder"].config(text=folder)
+
+
+def pumpUntil(app, done, timeout):
+    ##
+    ## RUNS THE TK EVENT LOOP UNTIL done() IS TRUE. PRESSES 'Interrupt' IF IT TAKES LONGER THAN timeout (s).
+    ## RETURNS TRUE IF IT HAD TO INTERRUPT.
+    ##
+    deadline = time.perf_counter() + timeout
+    interrupted = False
+    while not done():
+        app.update()
+        if not interrupted and time.perf_counter() > deadline:
+            app.interruptScanEvent()
+            interrupted = True
+        time.sleep(0.001)
+    return interrupted
+
+
+def benchmarkScan(app, stopwatch, x_axis, y_axis, dwell_ms, mode, fast_scan, options):
+    ##
+    ## TIMES ONE SCAN, THEN THE PEAK FINDING, SAVING AND CUSTOM LOOP THAT USUALLY FOLLOW IT.
+    ##
+    setScanParameters(app, x_axis, y_axis, dwell_ms, mode, fast_scan, options.folder)
+    pixels = len(x_axis) * len(y_axis)
+    result = {
+        "size": [len(x_axis), len(y_axis)],
+        "pixels": pixels,
+        "dwell_ms": dwell_ms,
+        "mode": mode,
+        "fast_scan": bool(fast_scan),
+        "theoretical_pixels_per_s": 1000 / dwell_ms
+    }
+    stopwatch.reset()
+    if options.memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    app.startScanEvent()
+    s = app.scanwindow
+    stopwatch.wrap(s, "plotWithColorbar", "redraw")
+    stopwatch.wrap(s.canvas, "draw", "canvas_draw")
+    stopwatch.wrap(s, "update", "tk_update")
+    stopwatch.wrap(s, "update_idletasks", "tk_update")
+    interrupted = pumpUntil(app, lambda: not s.currently_scanning and s.scan_core is None, options.timeout)
+    wall_time = time.perf_counter() - start
+
+    measured = s.stats.n if s.stats is not None else 0
+    result["interrupted"] = interrupted
+    result["wall_time_s"] = wall_time
+    result["pixels_measured"] = measured
+    result["pixels_per_s"] = measured / wall_time if wall_time > 0 else 0
+    result["efficiency"] = result["pixels_per_s"] / result["theoretical_pixels_per_s"]
+    for category in ["hardware", "redraw", "canvas_draw", "tk_update"]:
+        seconds, calls = stopwatch.get(category)
+        result[category+"_s"] = seconds
+        result[category+"_calls"] = calls
+    if options.memory:
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+    if options.extras:
+        # Peak finding.
+        t = time.perf_counter()
+        s.plotPeaks()
+        result["plot_peaks_s"] = time.perf_counter() - t
+        peaks = s.save_data["peak_finding"]
+        result["n_peaks"] = len(peaks["peaks_x_coords"])
+
+        # Saving.
+        path = os.path.join(options.folder, "bench_scan")
+        t = time.perf_counter()
+        s.saveJson(path)
+        result["save_json_s"] = time.perf_counter() - t
+        result["save_json_mb"] = os.path.getsize(path + ".json") / 1e6
+        t = time.perf_counter()
+        s.saveScanFile(path)
+        result["save_h5_s"] = time.perf_counter() - t
+        result["save_h5_mb"] = os.path.getsize(path + ".h5") / 1e6
+
+        # Custom loop over the peaks that were found (PopoutPlot needs 2+ points for its aspect ratio).
+        if result["n_peaks"] > 1:
+            result.update(benchmarkCustomLoop(app, peaks["peaks_x_coords"], peaks["peaks_y_coords"], options))
+    return result
+
+
+def benchmarkCustomLoop(app, x_coords, y_coords, options):
+    ##
+    ## TIMES ONE PopoutPlot LOOP OVER THE GIVEN POINTS.
+    ##
+    coords_path = os.path.join(options.folder, "bench_coords.json")
+    with open(coords_path, "w") as file:
+        json.dump({"x_coord": x_coords, "y_coord": y_coords}, file)
+    app.widgets["custom_coords_path"].config(text=coords_path)
+    start = time.perf_counter()
+    app.startCustomLoopEvent()
+    pumpUntil(app, lambda: app.miniplot.scan_thread is None, options.timeout)
+    wall_time = time.perf_counter() - start
+    app.miniplot.onClosing()
+    return {
+        "custom_loop_points": len(x_coords),
+        "custom_loop_s": wall_time,
+        "custom_loop_points_per_s": len(x_coords) / wall_time if wall_time > 0 else 0
+    }
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan throughput & UI latency benchmarks (simulated DAQ).")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 100, 200],
+                        help="scan sizes N (N x N pixels); e.g. 50 200 500 1000 2000")
+    parser.add_argument("--dwells", type=float, nargs="+", default=[0.1, 1.0], help="integration times (ms)")
+    parser.add_argument("--modes", nargs="+", default=["hardware-timed", "free-running", "per-pixel", "adaptive"])
+    parser.add_argument("--fast", choices=["on", "off", "both"], default="both", help="fast scan setting(s)")
+    parser.add_argument("--replay", help="replay a saved scan .json (its axes, dwell & mode) instead of the matrix")
+    parser.add_argument("--timeout", type=float, default=120, help="interrupt any scan that takes longer (s)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="don't trace peak memory")
+    parser.add_argument("--no-extras", dest="extras", action="store_false",
+                        help="skip the peak finding, saving & custom loop timings")
+    parser.add_argument("--output", default="bench_results.json")
+    options = parser.parse_args()
+
+    with open('HardwareConfig.json') as json_info:
+        config = json.load(json_info).get("Simulation", {})
+
+    results = []
+    stopwatch = Stopwatch()
+    with tempfile.TemporaryDirectory() as folder:
+        options.folder = folder
+        if options.replay:
+            with open(options.replay) as file:
+                recorded = json.load(file)
+            app = makeApp(config, sample=ReplaySample(options.replay))
+            runs = [(np.array(recorded["x_axis"]), np.array(recorded["y_axis"]),
+                     recorded["integration_time"], recorded.get("scan_mode", "per-pixel"), False)]
+        else:
+            app = makeApp(config)
+            fast_settings = {"on": [True], "off": [False], "both": [False, True]}[options.fast]
+            runs = [(np.linspace(-1, 1, n), np.linspace(-1, 1, n), dwell, mode, fast)
+                    for n in options.sizes for dwell in options.dwells
+                    for mode in options.modes for fast in fast_settings]
+
+        for name in ["readCounts", "readBuffered", "startBuffered", "stopBuffered", "startContinuous", "stopContinuous"]:
+            stopwatch.wrap(app.DAQ["Photon Counter"], name, "hardware")
+        for name in ["moveTo", "loadWaveform", "startWaveform", "stopWaveform"]:
+            stopwatch.wrap(app.DAQ["Scanning Mirror"], name, "hardware")
+
+        for x_axis, y_axis, dwell, mode, fast in runs:
+            result = benchmarkScan(app, stopwatch, x_axis, y_axis, dwell, mode, fast, options)
+            if options.replay:
+                result["replay"] = options.replay
+            print(f"{result['size']} {dwell} ms {mode}{' fast' if fast else ''}: "
+                  f"{result['pixels_per_s']:.0f} px/s ({100*result['efficiency']:.0f}% of theoretical)")
+            results.append(result)
+        app.destroy()
+
+    report = {
+        "commit": getCommit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results
+    }
+    with open(options.output, "w") as file:
+        file.write(json.dumps(report, indent=4))
+    print(f"Results written to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## CORRECTS THE LINE SHIFT (COMB) OF A SAVED SERPENTINE SCAN:
+##     python correct_lineshift.py scan.h5
+## MEASURES THE LAG FROM THE SCAN ITSELF AND WRITES THE CORRECTED SCAN TO scan_lineshift.h5; THE ORIGINAL IS
+## LEFT AS IT IS. --lag SKIPS THE MEASUREMENT (e.g. TO REUSE THE LAG OF A BRIGHTER SCAN WITH THE SAME DWELL TIME).
+##
+
+
+import argparse
+import json
+import shutil
+import sys
+import numpy as np
+from LineShift import LineShift
+from ScanFile import ScanFile
+
+
+def correctFile(path, output, lag=None, max_lag=5):
+    ##
+    ## WRITES THE CORRECTED COPY OF path TO output, A BAND OF COLUMNS AT A TIME. RETURNS THE LAG (PIXELS), OR
+    ## None (AND NOTHING IS WRITTEN) IF IT COULDN'T BE MEASURED.
+    ##
+    with ScanFile(path) as scan_file:
+        save_data = json.loads(scan_file.h5.attrs["save_data"])
+        if (save_data.get("line_shift") or {}).get("lag_pixels") is not None:
+            raise ValueError(f"{path} is already line-shift corrected.")
+        if scan_file.getMeasured() is not None:
+            raise ValueError(f"{path} is an adaptive scan; most of its pixels are interpolated, not scanned.")
+        columns_done = scan_file.getColumnsDone()
+        line_shift = LineShift(scan_file.h5["scan_data"].shape[1], max_lag)
+        n_pairs = int((columns_done[:-1] & columns_done[1:]).sum())
+        if lag is None:
+            lag = line_shift.estimate(scan_file.h5["scan_data"], columns_done)
+            if lag is None:
+                return None
+
+    shutil.copyfile(path, output)
+    with ScanFile(output, "r+") as scan_file:
+        n_x = len(columns_done)
+        for first in range(0, n_x, line_shift.band):
+            last = min(first + line_shift.band, n_x)
+            corrected = LineShift.correct(scan_file.getColumns(first, last), np.arange(first, last), lag)
+            scan_file.writeColumns(first, corrected, columns_done[first:last])
+        save_data["line_shift"] = {
+            "lag_pixels": lag,
+            "lag_ms": lag * save_data["integration_time"] if "integration_time" in save_data else None,
+            "n_pairs": n_pairs
+        }
+        scan_file.writeMetadata(save_data)
+        if "checkpoint" in scan_file.h5.attrs:
+            del scan_file.h5.attrs["checkpoint"] # Resuming would add raw columns to corrected ones.
+    return lag
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Corrects the forward/backward line shift of a saved scan.")
+    parser.add_argument("scan", help="the .h5 scan file")
+    parser.add_argument("--output", help="the corrected .h5 file (default SCAN_lineshift.h5)")
+    parser.add_argument("--lag", type=float, help="lag (pixels, along the scan direction) instead of measuring it")
+    parser.add_argument("--max-lag", type=int, default=5, help="largest lag (pixels) that is looked for")
+    args = parser.parse_args()
+
+    output = args.output or args.scan.rsplit(".h5", 1)[0] + "_lineshift.h5"
+    try:
+        lag = correctFile(args.scan, output, args.lag, args.max_lag)
+    except (ValueError, OSError, KeyError) as e:
+        parser.error(str(e))
+    if lag is None:
+        print("Couldn't measure the line shift (too few scanned columns or not enough contrast); try --lag.")
+        sys.exit(1)
+    print(f"Line shift {lag:+.3f} pixels; corrected scan written to {output}.")
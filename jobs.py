@@ -0,0 +1,90 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## RUNS THE JOB QUEUE WITHOUT THE GUI, e.g. OVERNIGHT:
+##     python jobs.py --add overnight.json
+## ADDS THE JOBS IN overnight.json (IF GIVEN) TO THE QUEUE IN job_queue.json AND RUNS EVERY PENDING JOB.
+## RUNNING IT AGAIN AFTER A CRASH OR CTRL+C CARRIES ON AT THE FIRST JOB THAT ISN'T DONE.
+##
+
+
+import argparse
+import json
+import sys
+import time
+from ScanCore import openTasks, makeDAQ
+from JobQueue import JobQueue, JobRunner
+
+
+def printEvents(runner):
+    ##
+    ## PRINTS THE JOBS THAT STARTED & FINISHED SINCE THE LAST CALL. RETURNS TRUE ONCE THE RUNNER HAS STOPPED.
+    ##
+    for event in runner.getEvents():
+        if event[0] == "started":
+            print(f"Job {event[1]['id']} ({event[1]['name']}) started.", flush=True)
+        elif event[0] == "done":
+            print(f"Job {event[1]['id']} ({event[1]['name']}) done: {event[1]['outputs']}", flush=True)
+        elif event[0] == "failed":
+            print(f"Job {event[1]['id']} ({event[1]['name']}) failed: {event[2]}", flush=True)
+        elif event[0] == "idle":
+            return True
+    return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the scan job queue without the GUI.")
+    parser.add_argument("--add", nargs="*", default=[], metavar="JOBS", help="job .json files to add to the queue first")
+    parser.add_argument("--queue", default="job_queue.json", help="the queue's state file")
+    parser.add_argument("--list", action="store_true", help="just list the jobs")
+    parser.add_argument("--clear", action="store_true", help="remove finished & failed jobs first")
+    parser.add_argument("--config", default="HardwareConfig.json", help="hardware config file")
+    parser.add_argument("--simulate", action="store_true", help="run on the simulated DAQ")
+    args = parser.parse_args()
+
+    job_queue = JobQueue(args.queue)
+    if args.clear:
+        job_queue.clearFinished()
+    for path in args.add:
+        try:
+            print(f"Added {len(job_queue.addFile(path))} job(s) from {path}.")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            sys.exit(f"Could not load jobs from {path}: {e}")
+    if args.list:
+        for job in job_queue.jobs:
+            print(f"{job['id']:4d}  {job['name']:20s} {job['status']:8s} {job['error'] or ''}")
+        sys.exit(0)
+
+    with open(args.config) as json_info:
+        channels = json.load(json_info)
+    photon_counter_task, scanning_mirror_task = openTasks(channels, simulate=args.simulate)
+    with photon_counter_task, scanning_mirror_task:
+        DAQ = makeDAQ(channels, photon_counter_task, scanning_mirror_task)
+        scanning_mirror = DAQ["Scanning Mirror"]
+        scanning_mirror.start()
+        runner = JobRunner(DAQ, job_queue).start()
+        try:
+            idle = False
+            while not idle:
+                time.sleep(0.2)
+                idle = printEvents(runner)
+        except KeyboardInterrupt:
+            print("Interrupted; the current job runs again next time.")
+            runner.interrupt_event.set()
+            runner.thread.join()
+        finally:
+            scanning_mirror.stop()
+
+    counts = job_queue.getCounts()
+    print(", ".join(f"{n} {status}" for status, n in counts.items()))
+    sys.exit(0 if counts["failed"] == 0 and counts["pending"] == 0 else 1)
@@ -11,31 +11,40 @@
 ##############################################################
 
 
-import nidaqmx
+import argparse
 import json
-from PhotonCounter import *
-from ScanningMirror import *
+from ScanCore import openTasks, makeDAQ
 from MainApp import *
 
-channels = {}
-with open('HardwareConfig.json') as json_info:
-    channels = json.load(json_info)
-
-with nidaqmx.Task() as photon_counter_task, nidaqmx.Task() as scanning_mirror_task:
-    DAQ = {
-        "Photon Counter": PhotonCounter(photon_counter_task,
-                            channels["Photon Counter"]["counter_channel"],
-                            channels["Photon Counter"]["counter_terminal"]),
-        "Scanning Mirror": ScanningMirror(scanning_mirror_task,
-                            channels["Scanning Mirror"]["x_channel"],
-                            channels["Scanning Mirror"]["y_channel"],
-                            V_range=channels["Scanning Mirror"]["V_range"])
-    }
-
-    scanning_mirror = DAQ["Scanning Mirror"]
-    scanning_mirror.start()
-
-    app = MainApp(DAQ)
-    app.mainloop()
-    
-    scanning_mirror.stop()
\ No newline at end of file
+# Guarded so that worker processes (e.g. for peak fitting) can import this module without opening the DAQ again.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confocal scan UI.")
+    parser.add_argument("--simulate", action="store_true",
+                        help="run on the simulated DAQ (see \"Simulation\" in HardwareConfig.json) instead of NI hardware")
+    parser.add_argument("--server", type=int, metavar="PORT",
+                        help="let other programs watch & control the scans over TCP on this port (see ScanServer.py)")
+    parser.add_argument("--server-host", default="127.0.0.1",
+                        help="interface for --server (default: this machine only; 0.0.0.0 for the whole network)")
+    args = parser.parse_args()
+
+    channels = {}
+    with open('HardwareConfig.json') as json_info:
+        channels = json.load(json_info)
+
+    photon_counter_task, scanning_mirror_task = openTasks(channels, simulate=args.simulate)
+    with photon_counter_task, scanning_mirror_task:
+        DAQ = makeDAQ(channels, photon_counter_task, scanning_mirror_task)
+
+        scanning_mirror = DAQ["Scanning Mirror"]
+        scanning_mirror.start()
+
+        app = MainApp(DAQ)
+        if args.server is not None:
+            app.startServer(args.server_host, args.server)
+        app.mainloop()
+        if app.server is not None:
+            app.server.stop()
+        # Let any saves that are still being written finish before the DAQ is released.
+        app.export_worker.waitUntilDone()
+
+        scanning_mirror.stop()
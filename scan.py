@@ -0,0 +1,113 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## RUNS ONE SCAN WITHOUT THE GUI (e.g. FROM A SCRIPT OR A CRON JOB), STREAMING IT TO AN .h5 FILE:
+##     python scan.py --x -1 1 0.01 --y -1 1 0.01 --dwell 1 --output scan.h5
+##     python scan.py --spec spec.json --simulate
+## A SPEC FILE HOLDS THE SAME KEYS AS ScanSpec.toDict(); OPTIONS GIVEN ON THE COMMAND LINE OVERRIDE IT.
+## CTRL+C STOPS THE SCAN, KEEPING THE COLUMNS THAT ARE DONE; CARRY ON WITH IT LATER (OR AFTER A CRASH) WITH
+##     python scan.py --resume scan.h5
+##
+
+
+import argparse
+import json
+import sys
+import time
+from ScanCore import ScanCore, ScanSpec, openTasks, makeDAQ
+from ScanFile import ScanFile
+
+
+def parseSpec(args):
+    ##
+    ## BUILDS THE ScanSpec FROM --spec AND THE COMMAND LINE OPTIONS.
+    ##
+    spec = {}
+    if args.spec:
+        with open(args.spec) as file:
+            spec = json.load(file)
+    for name, values in [("x", args.x), ("y", args.y)]:
+        if values is not None:
+            spec[name+"_start"], spec[name+"_end"], spec[name+"_step"] = values
+    options = {"integration_time": args.dwell, "scan_mode": args.mode, "output": args.output,
+               "n_frames": args.frames, "coarse_step": args.coarse_step, "refine_factor": args.refine_factor}
+    spec.update({k: v for k, v in options.items() if v is not None})
+    missing = [k for k in ["x_start", "y_start", "integration_time", "output"] if k not in spec]
+    if missing:
+        raise ValueError(f"Missing scan settings: {', '.join(missing)} (use --spec or --x/--y/--dwell/--output).")
+    return ScanSpec.fromDict(spec)
+
+
+def runScan(DAQ, spec, progress_interval=1.0, resume=False):
+    ##
+    ## RUNS spec TO THE END (OR UNTIL CTRL+C), PRINTING THE PROGRESS. RETURNS THE NUMBER OF COLUMNS FINISHED
+    ## (INCLUDING, WITH resume, THE ONES THAT WERE ALREADY DONE).
+    ##
+    core = ScanCore(DAQ, spec, resume=resume).start()
+    n_columns = len(spec.x_axis) * spec.n_frames
+    done = 0 if core.columns_done is None else int(core.columns_done.sum())
+    start = last_print = time.perf_counter()
+    try:
+        for frame, x_i, column in core.columns():
+            done += 1
+            if time.perf_counter() - last_print >= progress_interval:
+                last_print = time.perf_counter()
+                print(f"frame {frame+1}/{spec.n_frames}, column {x_i+1}/{len(spec.x_axis)} "
+                      f"({100*done/n_columns:.0f}%, {last_print - start:.0f} s)", flush=True)
+    except KeyboardInterrupt:
+        print("Interrupted; stopping the scan.")
+        core.interrupt()
+        for _ in core:
+            pass # Wait for the worker to finish writing & release the hardware.
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a confocal scan without the GUI.")
+    parser.add_argument("--spec", help="scan spec .json file (keys as in ScanSpec.toDict())")
+    parser.add_argument("--x", nargs=3, type=float, metavar=("START", "END", "STEP"), help="x voltages (V)")
+    parser.add_argument("--y", nargs=3, type=float, metavar=("START", "END", "STEP"), help="y voltages (V)")
+    parser.add_argument("--dwell", type=float, help="integration time per pixel (ms)")
+    parser.add_argument("--mode", choices=ScanSpec.scan_modes, help="scan mode (default hardware-timed)")
+    parser.add_argument("--frames", type=int, help="repeat the scan this many times (time-lapse)")
+    parser.add_argument("--coarse-step", type=int, help="adaptive scans: coarse step (pixels)")
+    parser.add_argument("--refine-factor", type=float, help="adaptive scans: refine cells brighter than this x background")
+    parser.add_argument("--output", help="the .h5 file to write")
+    parser.add_argument("--resume", metavar="FILE", help="carry on with the interrupted scan in this .h5 file (other settings are ignored)")
+    parser.add_argument("--json", action="store_true", help="also write the scan as a .json file")
+    parser.add_argument("--config", default="HardwareConfig.json", help="hardware config file")
+    parser.add_argument("--simulate", action="store_true", help="run on the simulated DAQ")
+    args = parser.parse_args()
+
+    try:
+        spec = ScanSpec.fromCheckpoint(args.resume) if args.resume else parseSpec(args)
+    except (ValueError, TypeError, OSError) as e:
+        parser.error(str(e))
+    with open(args.config) as json_info:
+        channels = json.load(json_info)
+
+    photon_counter_task, scanning_mirror_task = openTasks(channels, simulate=args.simulate)
+    with photon_counter_task, scanning_mirror_task:
+        DAQ = makeDAQ(channels, photon_counter_task, scanning_mirror_task)
+        scanning_mirror = DAQ["Scanning Mirror"]
+        scanning_mirror.start()
+        try:
+            done = runScan(DAQ, spec, resume=bool(args.resume))
+        finally:
+            scanning_mirror.stop()
+
+    print(f"{done} of {len(spec.x_axis) * spec.n_frames} columns scanned into {spec.output}.")
+    if args.json:
+        with ScanFile(spec.output) as scan_file:
+            scan_file.exportJson(spec.output.rsplit(".h5", 1)[0] + ".json")
+    sys.exit(0 if done == len(spec.x_axis) * spec.n_frames else 1)
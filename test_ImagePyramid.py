@@ -0,0 +1,115 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## CHECKS THAT AN ImagePyramid REFRESHED COLUMN BY COLUMN DURING A SCAN ENDS UP THE SAME AS ONE BUILT FROM THE
+## FINISHED SCAN, AND THAT ITS LEVELS ARE THE 2^k x 2^k BLOCK AVERAGES.
+##     python -m unittest test_ImagePyramid      (OR python -m pytest test_ImagePyramid.py)
+##
+
+
+import os
+import tempfile
+import unittest
+import numpy as np
+from ImagePyramid import ImagePyramid
+from TileStore import TileStore
+
+
+def getBlockAverage(image, k):
+    ##
+    ## image AVERAGED OVER 2^k x 2^k BLOCKS, PADDING THE EDGES AT EVERY HALVING (LIKE ImagePyramid.reduce).
+    ##
+    image = np.asarray(image, dtype=float)
+    for _ in range(k):
+        image = np.pad(image, ((0, image.shape[0] % 2), (0, image.shape[1] % 2)), mode="edge")
+        image = (image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2]) / 4
+    return image
+
+
+def getFullBuild(source, pyramid_class=ImagePyramid):
+    pyramid = pyramid_class(source)
+    pyramid.markDirty(0, len(source) - 1)
+    pyramid.refresh()
+    return pyramid
+
+
+class SmallLevels(ImagePyramid):
+    max_level_pixels = 5000 # Only the coarse levels are kept, so the others are computed from the source.
+
+
+class ImagePyramidTest(unittest.TestCase):
+    shape = (603, 301) # Odd at every level.
+
+    def setUp(self):
+        self.data = np.random.default_rng(0).uniform(0, 1000, self.shape).astype(np.float32)
+
+    def scanInto(self, source, pyramid, batches):
+        ##
+        ## WRITES THE DATA INTO source IN batches OF COLUMNS, REFRESHING THE PYRAMID AFTER EACH (OR EVERY OTHER) ONE.
+        ##
+        for i, columns in enumerate(batches):
+            for x_i in columns:
+                source[x_i] = self.data[x_i]
+                pyramid.markDirty(x_i)
+            if i % 2 == 1:
+                pyramid.refresh()
+        pyramid.refresh()
+
+    def assertSameLevels(self, pyramid, expected):
+        self.assertEqual(len(pyramid.levels), len(expected.levels))
+        for k in range(1, len(pyramid.levels)):
+            if expected.levels[k] is not None:
+                np.testing.assert_allclose(pyramid.levels[k], expected.levels[k], rtol=1e-6, err_msg=f"level {k}")
+
+    def testIncrementalSameAsFullBuild(self):
+        for pyramid_class in [ImagePyramid, SmallLevels]:
+            source = np.zeros(self.shape, dtype=np.float32)
+            pyramid = pyramid_class(source)
+            columns = np.arange(self.shape[0])
+            batches = [columns[0:1], columns[1:40], columns[40:300], columns[300:301], columns[301:][::-1]]
+            self.scanInto(source, pyramid, batches)
+            expected = getFullBuild(self.data, pyramid_class)
+            self.assertSameLevels(pyramid, expected)
+            for k in range(1, len(pyramid.levels)):
+                np.testing.assert_allclose(pyramid.getBlock(k, 0, pyramid.getLevelShape(k)[0]),
+                                           getBlockAverage(self.data, k), rtol=1e-5, err_msg=f"level {k}")
+
+    def testRescannedColumns(self):
+        ##
+        ## COLUMNS THAT ARE WRITTEN AGAIN (TIME-LAPSE FRAMES, LINE SHIFT CORRECTION) REPLACE THEIR OLD BLOCKS.
+        ##
+        source = np.zeros(self.shape, dtype=np.float32)
+        pyramid = ImagePyramid(source)
+        self.scanInto(source, pyramid, [np.arange(self.shape[0])])
+        self.data = self.data[::-1].copy()
+        self.scanInto(source, pyramid, [np.arange(100, 200), np.arange(0, 100), np.arange(200, self.shape[0])])
+        self.assertSameLevels(pyramid, getFullBuild(self.data))
+
+    def testTileStoreSource(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        store = TileStore(os.path.join(folder.name, "scan.npy"), self.shape, tile=64)
+        self.addCleanup(store.close)
+        pyramid = SmallLevels(store)
+        self.scanInto(store, pyramid, np.array_split(np.arange(self.shape[0]), 9))
+        self.assertSameLevels(pyramid, getFullBuild(self.data, SmallLevels))
+        # A level that isn't kept is subsampled straight from the store.
+        k = next(k for k in range(1, len(pyramid.levels)) if pyramid.levels[k] is None)
+        width, height = self.shape[0] // 2**k, self.shape[1] // 2**k
+        image, covered = pyramid.getRegion(0, self.shape[0], 0, self.shape[1], width, height)
+        self.assertEqual(covered, (0, self.shape[0], 0, self.shape[1]))
+        np.testing.assert_array_equal(image, self.data[::2**k, ::2**k])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## CHECKS THAT LineShift FINDS (AND UNDOES) A KNOWN LINE SHIFT IN A SYNTHETIC SERPENTINE SCAN.
+##     python -m unittest test_LineShift      (OR python -m pytest test_LineShift.py)
+##
+
+
+import unittest
+import numpy as np
+from LineShift import LineShift
+
+
+def makeScan(lag, shape=(60, 200), seed=0):
+    ##
+    ## (TRUE IMAGE, RAW SCAN) OF GAUSSIAN SPOTS, WHERE EVERY RAW COLUMN SEES THE SAMPLE lag PIXELS BEHIND THE
+    ## MIRROR ALONG ITS SCAN DIRECTION: +y FOR EVEN COLUMNS, -y FOR ODD ONES.
+    ##
+    rng = np.random.default_rng(seed)
+    x = np.arange(shape[0])[:, np.newaxis]
+    y = np.arange(shape[1])[np.newaxis, :].astype(float)
+    direction = np.where(x % 2 == 0, 1.0, -1.0)
+    spots = list(zip(rng.uniform(0, shape[0], 40), rng.uniform(0, shape[1], 40), rng.uniform(50, 200, 40)))
+
+    def sample(y):
+        image = np.full((shape[0], shape[1]), 10.0)
+        for x0, y0, amplitude in spots:
+            image += amplitude * np.exp(-(x - x0)**2 / (2 * 4.0**2) - (y - y0)**2 / (2 * 2.0**2))
+        return image
+
+    return sample(y), sample(y - direction*lag)
+
+
+class LineShiftTest(unittest.TestCase):
+    lags = [0.0, 0.7, 1.5, -2.0, 3.25]
+
+    def testEstimate(self):
+        for lag in self.lags:
+            _, raw = makeScan(lag)
+            self.assertAlmostEqual(LineShift(raw.shape[1]).estimate(raw), lag, delta=0.1, msg=f"lag {lag}")
+
+    def testColumnByColumn(self):
+        ##
+        ## ADDING THE COLUMNS AS THEY'RE SCANNED (IN ANY ORDER) GIVES THE SAME LAG AS estimate.
+        ##
+        _, raw = makeScan(1.5)
+        line_shift = LineShift(raw.shape[1])
+        order = np.concatenate([np.arange(30, len(raw)), np.arange(30)])
+        for x_i in order:
+            line_shift.add(x_i, raw[x_i])
+        self.assertAlmostEqual(line_shift.getLag(), LineShift(raw.shape[1]).estimate(raw), places=9)
+        self.assertEqual(line_shift.n_pairs, len(raw) - 1)
+
+    def testPartialScan(self):
+        _, raw = makeScan(-2.0)
+        columns_done = np.zeros(len(raw), dtype=bool)
+        columns_done[:25] = True
+        raw[25:] = 0 # Not scanned yet.
+        self.assertAlmostEqual(LineShift(raw.shape[1]).estimate(raw, columns_done), -2.0, delta=0.1)
+        columns_done[:] = False
+        columns_done[:3] = True
+        self.assertIsNone(LineShift(raw.shape[1]).estimate(raw, columns_done)) # Too few pairs to tell.
+
+    def testNoStructure(self):
+        ##
+        ## NOISE WITH NOTHING IN IT HAS NO LAG, RATHER THAN A RANDOM ONE.
+        ##
+        raw = np.random.default_rng(0).poisson(10, (60, 200)).astype(float)
+        self.assertIsNone(LineShift(raw.shape[1]).estimate(raw))
+
+    def testCorrectImage(self):
+        for lag in [1.5, -2.0]:
+            true, raw = makeScan(lag)
+            LineShift(raw.shape[1]).correctImage(raw, lag)
+            inside = slice(5, -5) # The edges are repeated, so they aren't recovered.
+            np.testing.assert_allclose(raw[:, inside], true[:, inside], atol=0.05 * true.max())
+            self.assertAlmostEqual(LineShift(raw.shape[1]).estimate(raw), 0.0, delta=0.1) # Nothing left to correct.
+
+
+if __name__ == "__main__":
+    unittest.main()
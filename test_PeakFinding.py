@@ -0,0 +1,124 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## CHECKS THAT PeakFinder & StreamingPeakFinder GIVE THE SAME PEAKS AS scikit-image's peak_local_max.
+##     python -m unittest test_PeakFinding      (OR python -m pytest test_PeakFinding.py)
+##
+
+
+import unittest
+import numpy as np
+from skimage.feature import peak_local_max
+from PeakFinding import PeakFinder, StreamingPeakFinder
+
+
+def makeScan(shape=(150, 110), n_emitters=60, seed=0):
+    ##
+    ## A SCAN OF GAUSSIAN SPOTS (SOME CLOSE TOGETHER, SOME AT THE EDGES) ON A NOISY BACKGROUND. NO TWO PIXELS
+    ## ARE EQUAL, SO THAT THE ORDER OF THE PEAKS (BRIGHTEST FIRST) IS WELL DEFINED.
+    ##
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+    scan = rng.uniform(0, 20, shape)
+    for x0, y0, amplitude in zip(rng.uniform(-2, shape[0] + 2, n_emitters), rng.uniform(-2, shape[1] + 2, n_emitters),
+                                 rng.uniform(20, 200, n_emitters)):
+        scan += amplitude * np.exp(-((x - x0)**2 + (y - y0)**2) / (2 * 1.5**2))
+    return scan
+
+
+def getExpected(scan, min_sep, threshold):
+    return peak_local_max(scan, min_distance=min_sep, threshold_abs=threshold * scan.mean())
+
+
+class PeakFinderTest(unittest.TestCase):
+    settings = [(1, 1.0), (2, 1.0), (3, 1.5), (5, 2.0), (8, 1.0)] # (min_sep, threshold) pairs.
+
+    def testSameAsPeakLocalMax(self):
+        scan = makeScan()
+        peak_finder = PeakFinder(n_workers=1)
+        for min_sep, threshold in self.settings:
+            peaks = peak_finder.getPeaks("scan", scan, min_sep, threshold)
+            np.testing.assert_array_equal(peaks, getExpected(scan, min_sep, threshold), f"min_sep {min_sep}")
+
+    def testCachedResults(self):
+        scan = makeScan()
+        peak_finder = PeakFinder(n_workers=1)
+        peaks = peak_finder.getPeaks("scan", scan, 3, 1.0)
+        self.assertIs(peak_finder.getPeaks("scan", scan, 3, 1.0), peaks)
+        # A new threshold reuses the search; new data needs a new scan_key.
+        np.testing.assert_array_equal(peak_finder.getPeaks("scan", scan, 3, 2.0), getExpected(scan, 3, 2.0))
+        other = makeScan(seed=1)
+        np.testing.assert_array_equal(peak_finder.getPeaks("other", other, 3, 1.0), getExpected(other, 3, 1.0))
+
+    def testPool(self):
+        ##
+        ## A BIG SCAN IS SEARCHED IN BANDS OF COLUMNS ON A POOL OF PROCESSES (HERE FORCED ON A SMALL SCAN).
+        ##
+        scan = makeScan((300, 80), n_emitters=120)
+        peak_finder = PeakFinder(n_workers=2)
+        peak_finder.pool_min_pixels = 0
+        peak_finder.band_pixels = 20 * scan.shape[1]
+        for min_sep, threshold in self.settings:
+            peaks = peak_finder.getPeaks("scan", scan, min_sep, threshold)
+            np.testing.assert_array_equal(peaks, getExpected(scan, min_sep, threshold), f"min_sep {min_sep}")
+
+    def testFlatScan(self):
+        self.assertEqual(len(PeakFinder(n_workers=1).getPeaks("flat", np.full((40, 30), 5.0), 3, 0.5)), 0)
+
+
+class StreamingPeakFinderTest(unittest.TestCase):
+
+    def scanLive(self, scan, min_sep, order, finish_after=None):
+        ##
+        ## FEEDS THE COLUMNS OF scan TO A StreamingPeakFinder IN order, AS A RUNNING SCAN DOES (THE COLUMNS
+        ## NOT DONE YET HOLD ZEROS). STOPS AFTER finish_after COLUMNS (AN INTERRUPTED SCAN).
+        ##
+        scan_data = np.zeros_like(scan)
+        columns_done = np.zeros(len(scan), dtype=bool)
+        finder = StreamingPeakFinder(scan.shape, min_sep)
+        for x_i in order[:finish_after]:
+            scan_data[x_i] = scan[x_i]
+            columns_done[x_i] = True
+            finder.update(scan_data, columns_done)
+        finder.update(scan_data, columns_done, finish=True)
+        return finder, scan_data
+
+    def testSameAsPeakLocalMax(self):
+        scan = makeScan()
+        for min_sep, threshold in PeakFinderTest.settings:
+            finder, _ = self.scanLive(scan, min_sep, np.arange(len(scan)))
+            np.testing.assert_array_equal(finder.getPeaks(threshold * scan.mean()), getExpected(scan, min_sep, threshold),
+                                          f"min_sep {min_sep}")
+
+    def testAnyColumnOrder(self):
+        ##
+        ## e.g. A RESUMED SCAN, OR ONE SCANNED BACKWARDS.
+        ##
+        scan = makeScan()
+        order = np.concatenate([np.arange(70, len(scan)), np.arange(70)[::-1]])
+        finder, _ = self.scanLive(scan, 3, order)
+        np.testing.assert_array_equal(finder.getPeaks(1.5 * scan.mean()), getExpected(scan, 3, 1.5))
+
+    def testInterrupted(self):
+        ##
+        ## AN INTERRUPTED SCAN GIVES THE PEAKS OF WHAT WAS SCANNED, AS IF THE REST OF THE SCAN WAS 0.
+        ##
+        scan = makeScan()
+        finder, scan_data = self.scanLive(scan, 3, np.arange(len(scan)), finish_after=77)
+        threshold = 1.5 * scan_data.mean()
+        np.testing.assert_array_equal(finder.getPeaks(threshold),
+                                      peak_local_max(scan_data, min_distance=3, threshold_abs=threshold))
+
+
+if __name__ == "__main__":
+    unittest.main()
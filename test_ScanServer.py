@@ -0,0 +1,152 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## LOOPBACK TEST OF THE REMOTE CONTROL: STARTS A ScanServer ON THE SIMULATED RIG AND DRIVES IT WITH ScanClient.
+##     python -m unittest test_ScanServer      (OR python -m pytest test_ScanServer.py)
+## NEEDS NO HARDWARE (AND NO DISPLAY).
+##
+
+
+import os
+import json
+import unittest
+from ScanCore import ScanCore, ScanSpec, openTasks, makeDAQ
+from ScanServer import ScanServer, ScanClient
+from HardwareLock import HardwareLock
+
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "HardwareConfig.json")
+scan_spec = {"x_start": -0.2, "x_end": 0.2, "x_step": 0.01, "y_start": -0.2, "y_end": 0.2, "y_step": 0.01,
+             "integration_time": 1} # 41 x 41 pixels, 1 ms each: long enough to still be running when it's probed.
+short_spec = dict(scan_spec, x_step=0.1, y_step=0.1) # 5 x 5 pixels: done in a moment.
+
+
+class ScanServerTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(config_path) as json_info:
+            config = json.load(json_info)
+        photon_counter_task, scanning_mirror_task = openTasks(config, simulate=True)
+        self.rig = scanning_mirror_task.rig
+        self.DAQ = makeDAQ(config, photon_counter_task, scanning_mirror_task)
+        self.DAQ["Scanning Mirror"].start()
+        self.hardware_lock = HardwareLock()
+        self.server = ScanServer(self.DAQ, port=0, hardware_lock=self.hardware_lock).start() # As MainApp.startServer does.
+        self.assertIsNone(self.server.error)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def connect(self):
+        client = ScanClient("127.0.0.1", self.server.port)
+        self.addCleanup(client.close)
+        return client
+
+    def waitForEvent(self, client, event):
+        ##
+        ## THE NEXT ("json", {"event": event, ...}) FRAME PUSHED TO client (SKIPPING THE OTHER FRAMES).
+        ##
+        while True:
+            frame = client.getFrame()
+            if frame[0] == "json" and frame[1].get("event") == event:
+                return frame[1]
+
+    def testStatusMoveCounts(self):
+        client = self.connect()
+        status = client.command("status")
+        self.assertTrue(status["ok"])
+        self.assertFalse(status["scanning"])
+        self.assertIsNone(status["hardware_owner"])
+
+        reply = client.command("move", x=0.1, y=-0.1)
+        self.assertTrue(reply["ok"])
+        self.assertEqual(self.rig.mirror_target, (0.1, -0.1))
+        self.assertFalse(client.command("move", x=100, y=0)["ok"]) # Out of the voltage range.
+
+        reply = client.command("counts", integration_time=10)
+        self.assertTrue(reply["ok"])
+        self.assertGreaterEqual(reply["counts"], 0)
+        self.assertIsNone(self.hardware_lock.getOwner()) # Single commands give the hardware straight back.
+
+    def testScanStartStop(self):
+        client = self.connect()
+        client.command("subscribe", streams=["columns", "events"])
+        reply = client.command("start", spec=scan_spec)
+        self.assertTrue(reply["ok"])
+        self.assertEqual(len(reply["x_axis"]), 41)
+        self.assertEqual(self.hardware_lock.getOwner(), "client")
+        self.assertTrue(client.command("status")["scanning"])
+
+        frame = client.getFrame()
+        while frame[0] != "column":
+            frame = client.getFrame()
+        self.assertEqual(len(frame[3]), len(reply["y_axis"]))
+
+        self.assertTrue(client.command("interrupt")["ok"])
+        done = self.waitForEvent(client, "scan_done")
+        self.assertTrue(done["interrupted"])
+        self.server.scan_core.join()
+        self.assertIsNone(self.hardware_lock.getOwner())
+        self.assertFalse(client.command("status")["scanning"])
+
+    def testSecondClientRefused(self):
+        first, second = self.connect(), self.connect()
+        first.command("subscribe", streams=["events"])
+        self.assertTrue(first.command("start", spec=scan_spec)["ok"])
+        for command, arguments in [("start", {"spec": scan_spec}), ("move", {"x": 0, "y": 0}), ("counts", {})]:
+            reply = second.command(command, **arguments)
+            self.assertFalse(reply["ok"], command)
+            self.assertIn("busy", reply["error"])
+            self.assertEqual(reply["hardware_owner"], "client")
+        self.assertFalse(self.hardware_lock.acquire("scan window")) # Nor can the GUI take it.
+
+        first.command("interrupt")
+        self.waitForEvent(first, "scan_done")
+        self.server.scan_core.join()
+        self.assertTrue(second.command("move", x=0, y=0)["ok"]) # Free again once the scan is done.
+        second.command("subscribe", streams=["events"])
+        self.assertTrue(second.command("start", spec=short_spec)["ok"]) # Not still interrupted by the first scan.
+        self.assertFalse(self.waitForEvent(second, "scan_done")["interrupted"])
+
+    def testRefusedWhileGuiHasHardware(self):
+        client = self.connect()
+        self.assertTrue(self.hardware_lock.acquire("scan window"))
+        reply = client.command("start", spec=scan_spec)
+        self.assertFalse(reply["ok"])
+        self.assertEqual(reply["hardware_owner"], "scan window")
+        self.assertEqual(client.command("status")["hardware_owner"], "scan window")
+        self.hardware_lock.release("scan window")
+        self.assertTrue(client.command("counts", integration_time=10)["ok"])
+
+    def testGuiDoesNotInterruptClientScan(self):
+        ##
+        ## THE GUI'S SCANS HAVE THEIR OWN INTERRUPT EVENT (AS IN ScanWindow.takeScan): A GUI SCAN THAT ENDS, OR ITS
+        ## WINDOW BEING CLOSED (stopAcquisition), RIGHT AS A CLIENT STARTS ITS SCAN MUST NOT STOP THE CLIENT'S SCAN.
+        ##
+        client = self.connect()
+        client.command("subscribe", streams=["events"])
+        self.assertTrue(self.hardware_lock.acquire("scan window"))
+        gui_core = ScanCore(self.DAQ, ScanSpec.fromDict(dict(short_spec, output=""))).start()
+        self.server.watch(gui_core)
+        self.assertFalse(self.waitForEvent(client, "scan_done")["interrupted"])
+        gui_core.join()
+        self.hardware_lock.release("scan window")
+
+        self.assertTrue(client.command("start", spec=scan_spec)["ok"])
+        gui_core.interrupt()
+        self.assertFalse(self.waitForEvent(client, "scan_done")["interrupted"])
+        self.server.scan_core.join()
+        self.assertIsNone(self.hardware_lock.getOwner())
+
+
+if __name__ == "__main__":
+    unittest.main()
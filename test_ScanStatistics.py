@@ -0,0 +1,101 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## CHECKS THE STREAMING ScanStatistics AGAINST numpy ON THE WHOLE DATA.
+##     python -m unittest test_ScanStatistics      (OR python -m pytest test_ScanStatistics.py)
+##
+
+
+import unittest
+import numpy as np
+from ScanStatistics import ScanStatistics
+
+
+class ScanStatisticsTest(unittest.TestCase):
+    percents = [0, 1, 5, 25, 50, 75, 95, 99, 100]
+
+    def getStats(self, columns):
+        stats = ScanStatistics()
+        for column in columns:
+            stats.update(column)
+        return stats
+
+    def assertMatchesNumpy(self, stats, values):
+        self.assertEqual(stats.n, len(values))
+        self.assertEqual(stats.minimum, values.min())
+        self.assertEqual(stats.maximum, values.max())
+        self.assertAlmostEqual(stats.mean, values.mean(), delta=1e-9 * abs(values.mean()))
+        self.assertAlmostEqual(stats.getVariance(), values.var(ddof=1), delta=1e-9 * values.var())
+        self.assertAlmostEqual(stats.getStd(), values.std(ddof=1), delta=1e-9 * values.std())
+        bin_width = stats.upper / len(stats.histogram)
+        for percent in self.percents:
+            # Accurate to a bin (plus the spacing of the data itself, which numpy interpolates over).
+            self.assertAlmostEqual(stats.getPercentile(percent), np.percentile(values, percent),
+                                   delta=1.5 * bin_width, msg=f"{percent}th percentile")
+
+    def testCounts(self):
+        ##
+        ## PHOTON COUNTS/s A COLUMN AT A TIME, MOSTLY BACKGROUND WITH A FEW BRIGHT SPOTS, FAR PAST THE FIRST
+        ## HISTOGRAM RANGE (SO ITS BINS ARE MERGED SEVERAL TIMES).
+        ##
+        rng = np.random.default_rng(0)
+        columns = rng.poisson(200, (120, 80)).astype(float)
+        columns[rng.random(columns.shape) < 0.02] *= 40
+        stats = self.getStats(columns)
+        self.assertGreater(stats.upper, 1024)
+        self.assertMatchesNumpy(stats, columns.ravel())
+
+    def testContinuous(self):
+        rng = np.random.default_rng(1)
+        columns = rng.lognormal(3, 1, (50, 200))
+        self.assertMatchesNumpy(self.getStats(columns), columns.ravel())
+
+    def testBatchSizes(self):
+        ##
+        ## THE SAME VALUES GIVE THE SAME STATISTICS HOWEVER THEY'RE SPLIT UP (SINGLE PIXELS, COLUMNS, ALL AT ONCE).
+        ##
+        values = np.random.default_rng(2).poisson(50, 600).astype(float)
+        whole = self.getStats([values]).getSummary()
+        for batches in [values, np.array_split(values, 7)]:
+            summary = self.getStats(batches).getSummary()
+            self.assertEqual(summary["n"], whole["n"])
+            for key in ["min", "max", "mean", "std"]:
+                self.assertAlmostEqual(summary[key], whole[key], places=9)
+
+    def testEdgeCases(self):
+        stats = ScanStatistics()
+        self.assertEqual(stats.getLimits(), (0, 0))
+        self.assertEqual(stats.getPercentile(50), 0)
+        stats.update([np.nan, np.inf]) # Not counted.
+        self.assertEqual(stats.n, 0)
+        stats.update(7.0)
+        self.assertEqual((stats.n, stats.mean, stats.getVariance()), (1, 7.0, 0.0))
+        stats.update([np.nan, 3.0])
+        self.assertEqual(stats.n, 2)
+        self.assertAlmostEqual(stats.getVariance(), 8.0)
+        self.assertEqual(stats.getLimits(), (3.0, 7.0))
+
+    def testLimits(self):
+        values = np.random.default_rng(3).poisson(100, 10000).astype(float)
+        values[:5] = 100000 # Hot pixels.
+        stats = self.getStats([values])
+        self.assertEqual(stats.getLimits(), (values.min(), 100000))
+        low, high = stats.getLimits(clip_percent=1)
+        self.assertLess(high, 1000) # The hot pixels don't wash out the colorbar.
+        bin_width = stats.upper / len(stats.histogram)
+        self.assertAlmostEqual(low, np.percentile(values, 1), delta=1.5 * bin_width)
+        self.assertAlmostEqual(high, np.percentile(values, 99), delta=1.5 * bin_width)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+##############################################################
+##############################################################
+###                                                        ###
+###                                                        ###
+###   Author: Hannah Kleidermacher                         ###
+###   To report bugs, questions, comments, please email:   ###
+###   kleid@stanford.edu                                   ###
+###                                                        ###
+###                                                        ###
+##############################################################
+##############################################################
+
+##
+## CHECKS THAT A TileStore HOLDS & READS BACK THE SAME DATA AS A numpy ARRAY, IN RAM AND AFTER REOPENING IT.
+##     python -m unittest test_TileStore      (OR python -m pytest test_TileStore.py)
+##
+
+
+import os
+import tempfile
+import unittest
+import numpy as np
+from TileStore import TileStore
+
+
+class TileStoreTest(unittest.TestCase):
+    shape = (300, 170) # Not a whole number of tiles either way.
+    tile = 64
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "scan.npy")
+        self.data = np.random.default_rng(0).uniform(0, 1000, self.shape).astype(np.float32)
+        self.store = TileStore(self.path, self.shape, tile=self.tile)
+        self.addCleanup(self.store.close)
+
+    def fill(self, order=None):
+        ##
+        ## WRITES THE DATA A COLUMN AT A TIME, LIKE A SCAN.
+        ##
+        for x_i in range(self.shape[0]) if order is None else order:
+            self.store[x_i] = self.data[x_i]
+
+    def testRoundTrip(self):
+        self.assertEqual(len(self.store), self.shape[0])
+        np.testing.assert_array_equal(np.asarray(self.store), np.zeros(self.shape)) # A new store is zeroed.
+        self.fill(np.r_[0:self.shape[0]:2, 1:self.shape[0]:2]) # Jumping between bands.
+        np.testing.assert_array_equal(np.asarray(self.store), self.data)
+        self.store.close()
+        reopened = TileStore(self.path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.shape, self.shape)
+        self.assertEqual(reopened.tile, self.tile)
+        np.testing.assert_array_equal(np.asarray(reopened), self.data)
+
+    def testIndexing(self):
+        self.fill()
+        data, store = self.data, self.store
+        np.testing.assert_array_equal(store[7], data[7])
+        np.testing.assert_array_equal(store[-1], data[-1])
+        self.assertEqual(store[70, 100], data[70, 100])
+        np.testing.assert_array_equal(store[60:130], data[60:130])
+        np.testing.assert_array_equal(store[60:130, 50:140], data[60:130, 50:140])
+        np.testing.assert_array_equal(store[:, 3], data[:, 3])
+        self.assertEqual(store[10:10].shape, (0, self.shape[1]))
+        with self.assertRaises(IndexError):
+            store[self.shape[0]]
+        with self.assertRaises(IndexError):
+            store[::2]
+
+        store[100:140, 20:30] = -1 # Broadcast, across a band edge.
+        data = data.copy()
+        data[100:140, 20:30] = -1
+        np.testing.assert_array_equal(np.asarray(store), data)
+
+    def testSteppedRead(self):
+        ##
+        ## read() WITH A STEP (AS FOR THE DISPLAY) IS THE SAME AS numpy's [x0:x1:step, y0:y1:step], BOTH FOR THE
+        ## BAND IN RAM (NOT WRITTEN TO THE FILE YET) AND THE REST.
+        ##
+        self.fill()
+        self.assertEqual(self.store.band_index, (self.shape[0] - 1) // self.tile)
+        for x0, x1, y0, y1 in [(0, 300, 0, 170), (5, 299, 3, 161), (63, 65, 64, 130), (250, 300, 0, 10), (40, 41, 7, 8)]:
+            for step in [1, 2, 3, 7, 64, 100]:
+                np.testing.assert_array_equal(self.store.read(x0, x1, y0, y1, step), self.data[x0:x1:step, y0:y1:step],
+                                              f"[{x0}:{x1}:{step}, {y0}:{y1}:{step}]")
+        display = self.store.getDisplayImage(max_size=100)
+        np.testing.assert_array_equal(display, self.data[::3, ::3])
+
+
+if __name__ == "__main__":
+    unittest.main()